@@ -0,0 +1,230 @@
+#!/usr/bin/env python3
+
+"""Offline benchmarks of the crawlers and the feeders, the crawlers talk to fake_hh_api.py
+
+    python3 benchmark.py --vacancies 2000 --latency 0.01 --output bench.json
+    python3 benchmark.py --baseline bench.json   # compare with a previous run
+
+The postgres feed runs only if BENCH_POSTGRES_HOST is set. It works in a temporary schema inside a
+transaction that is rolled back, so any database can be used. The parquet export runs only if
+pyspark is installed. Every scenario is run in its own process to measure its peak RSS.
+"""
+
+import sys
+import os
+import csv
+import glob
+import json
+import time
+import argparse
+import tempfile
+import subprocess
+
+from datetime import datetime
+
+from fake_hh_api import FakeApi, start_server, FIRST_ID
+
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# the crawlers are benchmarked, not the rate limits of hh.ru
+BENCH_RATE = 1000
+
+def log(*args, file=sys.stderr, **kwargs):
+    timestamp = datetime.strftime(datetime.now(), "%Y-%m-%d %H:%M:%S")
+    print(timestamp, *args, **kwargs, file=file, flush=True)
+
+
+def run_driver(code, cwd, env, log_filename):
+    """Runs python code in a child process, returns (wall secs, peak rss in MB, exit code)"""
+    start = time.monotonic()
+    with open(log_filename, "wb") as log_file:
+        process = subprocess.Popen([sys.executable, "-c", code], cwd=cwd, env=env,
+                                   stdout=log_file, stderr=subprocess.STDOUT)
+        _, status, rusage = os.wait4(process.pid, 0)
+    wall_secs = time.monotonic() - start
+
+    exit_code = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -1
+    return wall_secs, rusage.ru_maxrss / 1024, exit_code
+
+
+def count_csv_rows(filenames):
+    csv.field_size_limit(sys.maxsize)
+    rows = 0
+    for filename in filenames:
+        with open(filename, newline="", encoding="utf8") as f:
+            rows += sum(1 for _ in csv.DictReader(f))
+    return rows
+
+
+def bench_crawl_snapshot(api, work_dir, env, args):
+    cwd = os.path.join(work_dir, "snapshot")
+    os.makedirs(cwd)
+
+    code = (f"import sys; sys.path.insert(0, {ROOT_DIR!r}); import get_vacancies as g; "
+            f"g.INITIAL_RATE = g.MAX_RATE = {BENCH_RATE}; g.main()")
+
+    requests_before = api.requests
+    wall_secs, rss, exit_code = run_driver(code, cwd, env, os.path.join(work_dir, "crawl_snapshot.log"))
+
+    return {"wall_secs": wall_secs, "peak_rss_mb": rss, "exit_code": exit_code,
+            "requests": api.requests - requests_before,
+            "rows": count_csv_rows([os.path.join(cwd, "result.csv")]) if exit_code == 0 else 0}
+
+
+def bench_crawl_hist(api, work_dir, env, args):
+    cwd = os.path.join(work_dir, "hist")
+    os.makedirs(cwd)
+
+    bucket_size = max(1, args.vacancies // 4)
+    code = (f"import sys; sys.path.insert(0, {ROOT_DIR!r}); import get_hist_vacancies as g; "
+            f"g.INITIAL_RATE = g.MAX_RATE = {BENCH_RATE}; g.MIN_ID = {FIRST_ID}; "
+            f"g.MAX_ID = {FIRST_ID + args.vacancies}; g.BUCKET_SIZE = {bucket_size}; g.main()")
+
+    requests_before = api.requests
+    wall_secs, rss, exit_code = run_driver(code, cwd, env, os.path.join(work_dir, "crawl_hist.log"))
+
+    return {"wall_secs": wall_secs, "peak_rss_mb": rss, "exit_code": exit_code,
+            "requests": api.requests - requests_before,
+            "rows": count_csv_rows(glob.glob(os.path.join(cwd, "hist_data", "*.csv")))}
+
+
+def bench_feed_postgres(api, work_dir, env, args):
+    if not os.environ.get("BENCH_POSTGRES_HOST"):
+        return None
+
+    csv_filename = os.path.join(work_dir, "snapshot", "result.csv")
+    if not os.path.exists(csv_filename):
+        return None
+
+    env = dict(env)
+    for name in ("HOST", "USER", "PASSWORD", "DB"):
+        if f"BENCH_POSTGRES_{name}" in os.environ:
+            env[f"POSTGRES_{name}"] = os.environ[f"BENCH_POSTGRES_{name}"]
+
+    code = f"""
+import sys, os
+from datetime import date
+sys.path.insert(0, {ROOT_DIR!r})
+import db
+import feeder_postgres as f
+
+conn = db.connect()
+cursor = conn.cursor()
+cursor.execute("CREATE SCHEMA bench_{os.getpid()}")
+cursor.execute("SET search_path TO bench_{os.getpid()}")
+f.create_vacancy_table(cursor)
+
+with open(os.devnull, "w") as logfile:
+    f.feed_csv(f.read_csv_batches({csv_filename!r}), date.today(), cursor, logfile)
+
+# everything including the schema disappears
+conn.rollback()
+"""
+
+    wall_secs, rss, exit_code = run_driver(code, work_dir, env, os.path.join(work_dir, "feed_postgres.log"))
+    return {"wall_secs": wall_secs, "peak_rss_mb": rss, "exit_code": exit_code,
+            "rows": count_csv_rows([csv_filename])}
+
+
+def bench_parquet_export(api, work_dir, env, args):
+    try:
+        import pyspark
+    except ImportError:
+        return None
+
+    csv_filename = os.path.join(work_dir, "snapshot", "result.csv")
+    if not os.path.exists(csv_filename):
+        return None
+
+    code = f"""
+from pyspark.sql import SparkSession
+spark = SparkSession.builder.master('local').getOrCreate()
+df = spark.read.csv({csv_filename!r}, header=True, multiLine=True, escape='"')
+df.write.option("maxRecordsPerFile", 50000).parquet({os.path.join(work_dir, "vacancy.parquet")!r})
+"""
+
+    wall_secs, rss, exit_code = run_driver(code, work_dir, env, os.path.join(work_dir, "parquet_export.log"))
+    return {"wall_secs": wall_secs, "peak_rss_mb": rss, "exit_code": exit_code,
+            "rows": count_csv_rows([csv_filename])}
+
+
+SCENARIOS = [
+    ("crawl_snapshot", bench_crawl_snapshot),
+    ("crawl_hist", bench_crawl_hist),
+    ("feed_postgres", bench_feed_postgres),
+    ("parquet_export", bench_parquet_export),
+]
+
+
+def print_report(results, baseline):
+    header = f"{'scenario':16} {'status':8} {'wall s':>9} {'req/s':>9} {'rows/s':>9} {'rss MB':>8}"
+    if baseline:
+        header += f" {'rows/s vs base':>15}"
+    print(header)
+
+    for result in results:
+        line = (f"{result['scenario']:16} {result['status']:8} {result.get('wall_secs', 0):9.2f} "
+                f"{result.get('requests_per_sec', 0):9.1f} {result.get('rows_per_sec', 0):9.1f} "
+                f"{result.get('peak_rss_mb', 0):8.1f}")
+
+        base = baseline.get(result["scenario"]) if baseline else None
+        if base and base.get("rows_per_sec") and result.get("rows_per_sec"):
+            line += f" {result['rows_per_sec'] / base['rows_per_sec']:14.2f}x"
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--vacancies", type=int, default=2000)
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--pagination-cap", type=int, default=2000)
+    parser.add_argument("--scenario", action="append", help="run only these scenarios")
+    parser.add_argument("--output", help="save results as json")
+    parser.add_argument("--baseline", help="json of a previous run to compare with")
+    args = parser.parse_args()
+
+    log(f"Generating {args.vacancies} vacancies")
+    api = FakeApi(args.vacancies, args.latency, args.error_rate, args.pagination_cap)
+    server = start_server(api)
+
+    work_dir = tempfile.mkdtemp(prefix="vacancy-bench-")
+    env = dict(os.environ)
+    env["HH_API_URL"] = f"http://127.0.0.1:{server.server_port}"
+    env["PIPELINE_METRICS_DIR"] = os.path.join(work_dir, "metrics")
+    env["RAW_ARCHIVE"] = os.path.join(work_dir, "raw_archive.sqlite")
+
+    results = []
+    for name, func in SCENARIOS:
+        if args.scenario and name not in args.scenario:
+            continue
+
+        log(f"Running {name}, logs in {work_dir}")
+        result = func(api, work_dir, env, args)
+        if result is None:
+            results.append({"scenario": name, "status": "skipped"})
+            continue
+
+        result["scenario"] = name
+        result["status"] = "ok" if result["exit_code"] == 0 else "failed"
+        result["rows_per_sec"] = result["rows"] / result["wall_secs"]
+        if "requests" in result:
+            result["requests_per_sec"] = result["requests"] / result["wall_secs"]
+        results.append(result)
+
+    server.shutdown()
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = {r["scenario"]: r for r in json.load(f)}
+
+    print_report(results, baseline)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,304 @@
+#!/usr/bin/env python3
+
+"""Spreads a crawl over several workers with their own egress IPs
+
+    python3 crawl_coordinator.py hist      # id buckets of the historical scan, results go to hist_data/
+    python3 crawl_coordinator.py snapshot  # date windows of the listing, results go to data/YYYY-MM-DD/
+
+Workers (crawl_worker.py) lease work units over HTTP, crawl them with their own proxy and rate
+and upload the resulting csv and the raw responses, the responses go to the raw archive. A lease that is not completed in LEASE_SECS is given to another worker.
+Finished units are kept on disk, so a restarted coordinator continues where it stopped.
+Without CRAWL_TOKEN anyone could upload files, so the coordinator listens only on 127.0.0.1 then.
+"""
+
+import sys
+import os
+import csv
+import glob
+import io
+import gzip
+import json
+import time
+import threading
+import tempfile
+import traceback
+
+from datetime import datetime
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+from hh_vacancy import COLUMN_NAMES
+from raw_archive import RawArchive, HIST_SNAPSHOT
+
+PORT = int(os.environ.get("CRAWL_COORDINATOR_PORT", 8765))
+TOKEN = os.environ.get("CRAWL_TOKEN", "")
+
+LEASE_SECS = 3 * 60 * 60
+
+HIST_DIR = "hist_data"
+HIST_BUCKET_SIZE = 10000
+HIST_MAX_ID = 40_000_000
+
+DATA_DIR = "data"
+WINDOW_DAYS = 60
+SECONDS_IN_DAY = 24 * 60 * 60
+
+def log(*args, file=sys.stderr, **kwargs):
+    timestamp = datetime.strftime(datetime.now(), "%Y-%m-%d %H:%M:%S")
+    print(timestamp, *args, **kwargs, file=file, flush=True)
+
+
+def archive_raw(snapshot, raw_data):
+    """Puts the gzipped json lines of a worker into the raw archive, returns the number of responses"""
+    count = 0
+    with RawArchive(snapshot=snapshot) as archive:
+        for line in gzip.decompress(raw_data).splitlines():
+            kind, key, obj = json.loads(line)
+            archive.put(kind, key, obj)
+            count += 1
+    return count
+
+
+def write_file_atomic(dirname, filename, data: bytes):
+    fd, tempname = tempfile.mkstemp(prefix=f"{filename}-unfinished-", dir=dirname)
+    with open(fd, "wb") as f:
+        f.write(data)
+    os.chmod(tempname, 0o755)
+    os.rename(tempname, os.path.join(dirname, filename))
+
+
+class WorkQueue:
+    def __init__(self, units):
+        self.units = units
+        self.pending = list(units)
+        self.leases = {}
+        self.lock = threading.Lock()
+
+    def lease(self, worker):
+        with self.lock:
+            now = time.monotonic()
+            for unit_id, (lease_worker, expires) in list(self.leases.items()):
+                if expires < now:
+                    log(f"Lease of {unit_id} by {lease_worker} expired")
+                    del self.leases[unit_id]
+                    self.pending.append(unit_id)
+
+            if not self.pending:
+                return None
+
+            unit_id = self.pending.pop(0)
+            self.leases[unit_id] = (worker, now + LEASE_SECS)
+            return unit_id
+
+    def complete(self, unit_id):
+        with self.lock:
+            if unit_id in self.pending:
+                self.pending.remove(unit_id)
+            return self.leases.pop(unit_id, None) is not None
+
+    def fail(self, unit_id):
+        with self.lock:
+            if self.leases.pop(unit_id, None) is not None:
+                self.pending.append(unit_id)
+
+    def is_done(self):
+        with self.lock:
+            return not self.pending and not self.leases
+
+    def get_status(self):
+        with self.lock:
+            return {"total": len(self.units), "pending": len(self.pending), "leased": len(self.leases)}
+
+
+class HistJob:
+    """Id buckets of the historical scan, every finished bucket is saved as hist_data/{start_id}.csv"""
+
+    def __init__(self):
+        os.makedirs(HIST_DIR, exist_ok=True)
+
+        units = {}
+        for start_id in range(0, HIST_MAX_ID, HIST_BUCKET_SIZE):
+            if not os.path.exists(os.path.join(HIST_DIR, f"{start_id}.csv")):
+                units[str(start_id)] = {"kind": "ids", "start_id": start_id,
+                                        "end_id": start_id + HIST_BUCKET_SIZE, "it_only": True}
+        self.queue = WorkQueue(units)
+        self.snapshot = HIST_SNAPSHOT
+
+    def save_result(self, unit_id, csv_data):
+        write_file_atomic(HIST_DIR, f"{unit_id}.csv", csv_data)
+
+    def finish(self):
+        pass
+
+
+class SnapshotJob:
+    """Date windows of the listing, merged into data/YYYY-MM-DD/result.csv when all are finished"""
+
+    def __init__(self):
+        # an unfinished snapshot keeps its date after a restart on another day
+        unfinished = sorted(glob.glob(os.path.join(DATA_DIR, "*-coordinated")))
+        if unfinished:
+            self.dir_prefix = os.path.basename(unfinished[-1])[:-len("-coordinated")]
+            log(f"Resuming snapshot {self.dir_prefix}")
+        else:
+            self.dir_prefix = datetime.strftime(datetime.now(), "%Y-%m-%d")
+        self.snapshot = self.dir_prefix
+        self.work_dir = os.path.join(DATA_DIR, f"{self.dir_prefix}-coordinated")
+        self.parts_dir = os.path.join(self.work_dir, "parts")
+        os.makedirs(self.parts_dir, exist_ok=True)
+
+        # the windows are fixed at the first start, so a restart does not change them
+        windows_file = os.path.join(self.work_dir, "windows.json")
+        if os.path.exists(windows_file):
+            with open(windows_file) as f:
+                windows = json.load(f)
+        else:
+            now = int(time.time())
+            windows = [[None, now - WINDOW_DAYS * SECONDS_IN_DAY], [now, None]]
+            for day in range(WINDOW_DAYS):
+                windows.append([now - (day + 1) * SECONDS_IN_DAY, now - day * SECONDS_IN_DAY])
+            with open(windows_file, "w") as f:
+                json.dump(windows, f)
+
+        units = {}
+        for pos, (date_from, date_to) in enumerate(windows):
+            unit_id = f"window{pos:04d}"
+            if not os.path.exists(os.path.join(self.parts_dir, f"{unit_id}.csv")):
+                units[unit_id] = {"kind": "window", "date_from": date_from, "date_to": date_to}
+        self.queue = WorkQueue(units)
+
+    def save_result(self, unit_id, csv_data):
+        write_file_atomic(self.parts_dir, f"{unit_id}.csv", csv_data)
+
+    def finish(self):
+        """Windows can intersect on the borders, so the merge drops repeating vacancies"""
+        log(f"Merging parts into {self.dir_prefix}/result.csv")
+
+        known_ids = set()
+        with open(os.path.join(self.work_dir, "result.csv"), "w", newline="") as csv_file:
+            writer = csv.DictWriter(csv_file, fieldnames=COLUMN_NAMES)
+            writer.writeheader()
+
+            for part in sorted(os.listdir(self.parts_dir)):
+                with open(os.path.join(self.parts_dir, part), newline="", encoding="utf8") as part_file:
+                    for row in csv.DictReader(part_file):
+                        if row["id"] not in known_ids:
+                            known_ids.add(row["id"])
+                            writer.writerow(row)
+
+        os.rename(self.work_dir, os.path.join(DATA_DIR, self.dir_prefix))
+        log(f"Snapshot {self.dir_prefix} is ready, vacancies={len(known_ids)}")
+
+
+def make_handler(job):
+    class Handler(BaseHTTPRequestHandler):
+        def send_json(self, code, payload=None):
+            body = json.dumps(payload).encode() if payload is not None else b""
+            self.send_response(code)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def check_token(self):
+            if TOKEN and self.headers.get("X-Crawl-Token") != TOKEN:
+                self.send_json(403, {"error": "bad token"})
+                return False
+            return True
+
+        def do_GET(self):
+            if not self.check_token():
+                return
+
+            url = urlparse(self.path)
+            query = parse_qs(url.query)
+
+            if url.path == "/status":
+                self.send_json(200, job.queue.get_status())
+            elif url.path == "/lease":
+                if job.queue.is_done():
+                    self.send_json(410, {"status": "done"})
+                    return
+
+                worker = query.get("worker", ["unknown"])[0]
+                unit_id = job.queue.lease(worker)
+                if unit_id is None:
+                    self.send_json(204)
+                    return
+
+                log(f"Unit {unit_id} leased by {worker}")
+                self.send_json(200, {"unit_id": unit_id, "params": job.queue.units[unit_id]})
+            else:
+                self.send_json(404, {"error": "not found"})
+
+        def do_POST(self):
+            if not self.check_token():
+                return
+
+            url = urlparse(self.path)
+            unit_id = parse_qs(url.query).get("unit", [None])[0]
+            if unit_id not in job.queue.units:
+                self.send_json(404, {"error": "unknown unit"})
+                return
+
+            body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+            if url.path == "/raw":
+                count = archive_raw(job.snapshot, body)
+                log(f"Unit {unit_id}: {count} raw responses archived")
+                self.send_json(200, {})
+            elif url.path == "/fail":
+                log(f"Unit {unit_id} failed on a worker")
+                job.queue.fail(unit_id)
+                self.send_json(200, {})
+            elif url.path == "/complete":
+                csv_data = gzip.decompress(body)
+                header = next(csv.reader(io.StringIO(csv_data.decode("utf8"))), None)
+                if header != COLUMN_NAMES:
+                    self.send_json(400, {"error": "bad csv header"})
+                    return
+
+                job.save_result(unit_id, csv_data)
+                job.queue.complete(unit_id)
+                log(f"Unit {unit_id} completed, status {job.queue.get_status()}")
+                self.send_json(200, {})
+            else:
+                self.send_json(404, {"error": "not found"})
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+def main():
+    if len(sys.argv) != 2 or sys.argv[1] not in ("hist", "snapshot"):
+        print(f"Usage: {sys.argv[0]} hist|snapshot", file=sys.stderr)
+        sys.exit(1)
+
+    host = "0.0.0.0" if TOKEN else "127.0.0.1"
+    if not TOKEN:
+        log(f"CRAWL_TOKEN is not set, only local workers can connect")
+
+    job = HistJob() if sys.argv[1] == "hist" else SnapshotJob()
+    log(f"Starting {sys.argv[1]} coordinator on {host}:{PORT}, units to do: {job.queue.get_status()['total']}")
+
+    server = ThreadingHTTPServer((host, PORT), make_handler(job))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    while not job.queue.is_done():
+        time.sleep(10)
+
+    try:
+        job.finish()
+    except Exception:
+        log(traceback.format_exc())
+        sys.exit(1)
+
+    # the workers are told to exit on their next lease
+    time.sleep(60)
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+
+"""Worker of crawl_coordinator.py, run one per egress IP:
+
+    python3 crawl_worker.py --coordinator http://host:8765 --worker-id node1 --proxy socks5h://127.0.0.1:1080
+"""
+
+import sys
+import os
+import io
+import csv
+import gzip
+import json
+import time
+import argparse
+import traceback
+
+from datetime import datetime
+
+import requests
+
+from pipeline_metrics import StageMetrics
+from http_client import HttpClient, RateController
+from hh_vacancy import COLUMN_NAMES, gen_all_hh_vacancy_ids, dump_vacancies
+
+TOKEN = os.environ.get("CRAWL_TOKEN", "")
+
+TIMEOUT = 600
+NO_WORK_PAUSE_SEC = 60
+FAIL_PAUSE_SEC = 60
+
+def log(*args, file=sys.stderr, **kwargs):
+    timestamp = datetime.strftime(datetime.now(), "%Y-%m-%d %H:%M:%S")
+    print(timestamp, *args, **kwargs, file=file, flush=True)
+
+
+class RawResponses:
+    """Collects the raw responses of a unit as gzipped json lines, the coordinator puts them into its archive"""
+
+    def __init__(self):
+        self.buffer = io.BytesIO()
+        self.file = gzip.GzipFile(fileobj=self.buffer, mode="wb")
+
+    def put(self, kind, key, obj):
+        self.file.write(json.dumps([kind, str(key), obj], ensure_ascii=False).encode("utf8") + b"\n")
+
+    def get_data(self):
+        self.file.close()
+        return self.buffer.getvalue()
+
+
+def crawl_unit(client, params):
+    """Returns the csv and the gzipped raw responses of the unit"""
+    csv_file = io.StringIO()
+    writer = csv.DictWriter(csv_file, fieldnames=COLUMN_NAMES)
+    writer.writeheader()
+    raw = RawResponses()
+
+    if params["kind"] == "ids":
+        dump_vacancies(client, range(params["start_id"], params["end_id"]), writer, it_only=params["it_only"],
+                       archive=raw)
+    elif params["kind"] == "window":
+        vacancy_ids = gen_all_hh_vacancy_ids(client, date_from=params["date_from"], date_to=params["date_to"])
+        dump_vacancies(client, vacancy_ids, writer, archive=raw)
+    else:
+        raise Exception(f"Unknown unit kind {params['kind']}")
+
+    return csv_file.getvalue().encode("utf8"), raw.get_data()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--coordinator", required=True)
+    parser.add_argument("--worker-id", required=True)
+    parser.add_argument("--proxy", default=None, help="proxy for hh.ru requests, like socks5h://host:port")
+    parser.add_argument("--initial-rate", type=float, default=1)
+    parser.add_argument("--max-rate", type=float, default=5)
+    args = parser.parse_args()
+
+    proxies = {"http": args.proxy, "https": args.proxy} if args.proxy else None
+
+    metrics = StageMetrics(f"crawl_worker_{args.worker_id}")
+    client = HttpClient(requests.session(), RateController(initial_rate=args.initial_rate, max_rate=args.max_rate),
+                        metrics=metrics, proxies=proxies, timeout=TIMEOUT, log=log)
+
+    # the coordinator is reached directly, not through the proxy
+    coordinator = requests.session()
+    coordinator.headers["X-Crawl-Token"] = TOKEN
+
+    log(f"Worker {args.worker_id} started")
+
+    while True:
+        resp = coordinator.get(f"{args.coordinator}/lease", params={"worker": args.worker_id}, timeout=TIMEOUT)
+        if resp.status_code == 410:
+            log(f"All work is done, exiting")
+            break
+        if resp.status_code == 204:
+            time.sleep(NO_WORK_PAUSE_SEC)
+            continue
+        resp.raise_for_status()
+
+        unit = resp.json()
+        unit_id = unit["unit_id"]
+        log(f"Crawling unit {unit_id}: {unit['params']}")
+
+        try:
+            csv_data, raw_data = crawl_unit(client, unit["params"])
+        except Exception:
+            log(traceback.format_exc())
+            coordinator.post(f"{args.coordinator}/fail", params={"unit": unit_id}, timeout=TIMEOUT)
+            time.sleep(FAIL_PAUSE_SEC)
+            continue
+
+        # the raw responses go first, a unit is completed only with its archive
+        resp = coordinator.post(f"{args.coordinator}/raw", params={"unit": unit_id}, data=raw_data, timeout=TIMEOUT)
+        resp.raise_for_status()
+        resp = coordinator.post(f"{args.coordinator}/complete", params={"unit": unit_id},
+                                data=gzip.compress(csv_data), timeout=TIMEOUT)
+        resp.raise_for_status()
+        metrics.flush(force=True)
+        log(f"Unit {unit_id} uploaded")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,148 @@
+"""Shared access to postgres: a connection pool, prepared statements and batching helpers
+
+    pool = Pool(maxconn=4)
+    rows = pool.query("SELECT version FROM stats_meta WHERE id = %s", (1, ))
+
+    with pool.connection() as conn, conn.cursor() as cursor:
+        ensure_created(conn, "vacancy", create_vacancy_table)
+        execute_prepared(cursor, "get_vacancy", "SELECT name FROM vacancy WHERE id = $1", (42, ))
+        conn.commit()
+
+Prepared statements live in the session, so the connections of the pool keep them between runs.
+Cursors are plain ones returning tuples.
+"""
+
+import os
+import threading
+
+from contextlib import contextmanager
+
+import psycopg2
+import psycopg2.extensions
+import psycopg2.extras
+import psycopg2.pool
+import dotenv
+
+try:
+    dotenv.load_dotenv("postgres.env")
+except OSError:
+    pass
+
+HOST = os.environ.get("POSTGRES_HOST", "db")
+USER = os.environ.get("POSTGRES_USER", "vacancy")
+PASSWORD = os.environ.get("POSTGRES_PASSWORD", "psql")
+DB = os.environ.get("POSTGRES_DB", "vacancy")
+
+CONNECT_TIMEOUT = 10
+PAGE_SIZE = 1000
+
+
+class Connection(psycopg2.extensions.connection):
+    """Remembers the statements prepared in its session"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared = set()
+
+
+def get_connect_kwargs():
+    return {"dbname": DB, "user": USER, "password": PASSWORD, "host": HOST,
+            "connect_timeout": CONNECT_TIMEOUT, "connection_factory": Connection}
+
+
+def connect():
+    return psycopg2.connect(**get_connect_kwargs())
+
+
+class Pool:
+    """Thread safe pool, a thread waits for a free connection instead of getting an error
+
+    The connections are opened on demand, so a service starts even if postgres is down.
+    """
+
+    def __init__(self, maxconn, minconn=1):
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.pool = None
+        self.lock = threading.Lock()
+        # the pool raises instead of waiting when all connections are taken
+        self.slots = threading.BoundedSemaphore(maxconn)
+
+    def get_pool(self):
+        with self.lock:
+            if self.pool is None:
+                self.pool = psycopg2.pool.ThreadedConnectionPool(self.minconn, self.maxconn, **get_connect_kwargs())
+            return self.pool
+
+    @contextmanager
+    def connection(self):
+        """Yields a connection, what is not committed by the caller is rolled back"""
+        with self.slots:
+            pool = self.get_pool()
+            conn = pool.getconn()
+            try:
+                yield conn
+                conn.rollback()
+            except Exception:
+                # the connection may be broken, so it is not returned to the pool
+                pool.putconn(conn, close=True)
+                raise
+            pool.putconn(conn)
+
+    def query(self, sql, params=()):
+        with self.connection() as conn, conn.cursor() as cursor:
+            cursor.execute(sql, params)
+            return cursor.fetchall()
+
+    def close(self):
+        with self.lock:
+            if self.pool is not None:
+                self.pool.closeall()
+                self.pool = None
+
+
+def prepare(cursor, name, sql):
+    """Prepares the statement once per session, sql has $1, $2... placeholders"""
+    conn = cursor.connection
+    if name not in conn.prepared:
+        cursor.execute(f"PREPARE {name} AS {sql}")
+        conn.prepared.add(name)
+
+
+def get_execute_sql(name, params_count):
+    return f"EXECUTE {name} ({', '.join(['%s'] * params_count)})"
+
+
+def execute_prepared(cursor, name, sql, params):
+    prepare(cursor, name, sql)
+    cursor.execute(get_execute_sql(name, len(params)), params)
+
+
+def execute_batch_prepared(cursor, name, sql, params_list, page_size=PAGE_SIZE):
+    """Runs the prepared statement for every params, a page of them is sent in one round trip"""
+    if not params_list:
+        return
+    prepare(cursor, name, sql)
+    psycopg2.extras.execute_batch(cursor, get_execute_sql(name, len(params_list[0])), params_list,
+                                  page_size=page_size)
+
+
+def execute_values(cursor, sql, rows, page_size=PAGE_SIZE):
+    """Inserts rows with multirow VALUES, sql has a single %s for them"""
+    if rows:
+        psycopg2.extras.execute_values(cursor, sql, rows, page_size=page_size)
+
+
+created = set()
+created_lock = threading.Lock()
+
+
+def ensure_created(conn, name, create_func):
+    """Runs create_func(cursor) with the DDL once per process and commits"""
+    with created_lock:
+        if name in created:
+            return
+        with conn.cursor() as cursor:
+            create_func(cursor)
+        conn.commit()
+        created.add(name)
@@ -0,0 +1,321 @@
+#!/usr/bin/env python3
+
+"""Finds near duplicate vacancies (reposts under new ids, copies of agencies) with MinHash LSH
+
+A vacancy is the set of word 3-grams of its name and description. Its MinHash signature of
+NUM_PERM values is cut into BANDS bands, the vacancies sharing a band are candidates and they are
+duplicates if their estimated Jaccard similarity is at least SIMILARITY_THRESHOLD. The signatures
+and band keys are kept in db, so every snapshot only the new vacancies are hashed and looked up.
+
+A new vacancy is compared only with one representative of every cluster of its buckets (at most
+MAX_BUCKET_CLUSTERS of them), and a band key is stored once per cluster, so mass reposts of the same
+text do not grow the buckets.
+
+Vacancies of one cluster get the same vacancy.cluster_id, the smallest id of the cluster. When a new
+vacancy joins several clusters they are merged.
+
+    python3 dedup.py --once
+"""
+
+import sys
+import re
+import time
+import zlib
+import hashlib
+import traceback
+
+from datetime import datetime
+
+import numpy as np
+import psycopg2.extras
+
+import db
+
+from skill_extractor import normalize_text
+
+DATA_DIR = "data"
+
+NUM_PERM = 64
+BANDS = 16
+ROWS_PER_BAND = NUM_PERM // BANDS
+SHINGLE_SIZE = 3
+# the candidate S-curve 1 - (1 - s ** ROWS_PER_BAND) ** BANDS has its middle at about
+# (1 / BANDS) ** (1 / ROWS_PER_BAND) = 0.5, well below the threshold: pairs at 0.75 are candidates
+# with p = 0.998 (0.89 at 0.6), the false candidates are dropped by the similarity of the signatures
+SIMILARITY_THRESHOLD = 0.75
+MAX_BUCKET_CLUSTERS = 100
+
+BATCH_SIZE = 5000
+RECHECK_EVERY_SEC = 60
+
+WORD_RE = re.compile(r"\w+")
+
+# the same permutations forever, otherwise stored signatures are not comparable with new ones
+_rnd = np.random.RandomState(20210601)
+PERM_A = _rnd.randint(1, 1 << 62, size=NUM_PERM, dtype=np.int64).astype(np.uint64) * np.uint64(2) + np.uint64(1)
+PERM_B = _rnd.randint(0, 1 << 62, size=NUM_PERM, dtype=np.int64).astype(np.uint64)
+EMPTY_SIGNATURE = np.full(NUM_PERM, np.iinfo(np.uint32).max, dtype=np.uint32)
+
+
+def log(*args, file=sys.stderr, **kwargs):
+    timestamp = datetime.strftime(datetime.now(), "%Y-%m-%d %H:%M:%S")
+    print(timestamp, *args, **kwargs, file=file, flush=True)
+
+
+def create_dedup_tables(cursor):
+    cursor.execute("ALTER TABLE vacancy ADD COLUMN IF NOT EXISTS cluster_id BIGINT")
+    cursor.execute("CREATE INDEX IF NOT EXISTS vacancy_cluster_id_idx ON vacancy (cluster_id)")
+
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS vacancy_minhash (
+            id BIGINT PRIMARY KEY NOT NULL,
+            signature BYTEA
+        )
+    """)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS vacancy_lsh (
+            band_key BIGINT NOT NULL,
+            vacancy_id BIGINT NOT NULL
+        )
+    """)
+    cursor.execute("CREATE INDEX IF NOT EXISTS vacancy_lsh_band_key_idx ON vacancy_lsh (band_key)")
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS dedup_meta (
+            id INT PRIMARY KEY,
+            bands INT,
+            rows_per_band INT
+        )
+    """)
+
+
+def get_shingle_hashes(name, description):
+    words = WORD_RE.findall(normalize_text(f"{name or ''} {description or ''}"))
+    if not words:
+        return np.array([], dtype=np.uint64)
+
+    # the words are hashed once, the shingles are combined from them with numpy
+    word_hashes = np.array([zlib.crc32(w.encode()) for w in words], dtype=np.uint64)
+    if len(word_hashes) < SHINGLE_SIZE:
+        return np.unique(word_hashes)
+
+    shingles = np.zeros(len(word_hashes) - SHINGLE_SIZE + 1, dtype=np.uint64)
+    for offset in range(SHINGLE_SIZE):
+        shingles = shingles * np.uint64(1000003) + word_hashes[offset:len(shingles) + offset]
+    return np.unique(shingles)
+
+
+def get_signature(shingle_hashes):
+    if not len(shingle_hashes):
+        return EMPTY_SIGNATURE
+
+    # multiply-shift hashing, the overflow of uint64 is the modulo 2 ** 64
+    with np.errstate(over="ignore"):
+        hashes = (PERM_A[:, None] * shingle_hashes[None, :] + PERM_B[:, None]) >> np.uint64(32)
+    return hashes.min(axis=1).astype(np.uint32)
+
+
+def get_band_keys(signature):
+    keys = []
+    for band in range(BANDS):
+        band_bytes = signature[band * ROWS_PER_BAND:(band + 1) * ROWS_PER_BAND].tobytes()
+        digest = hashlib.blake2b(band_bytes, digest_size=8, salt=band.to_bytes(8, "little")).digest()
+        keys.append(int.from_bytes(digest, "little", signed=True))
+    return keys
+
+
+def get_similarity(signature1, signature2):
+    return np.count_nonzero(signature1 == signature2) / NUM_PERM
+
+
+def find_root(parents, item):
+    while parents[item] != item:
+        parents[item] = parents[parents[item]]
+        item = parents[item]
+    return item
+
+
+def dedup_batch(cursor, rows):
+    """rows are (id, name, description) of vacancies without cluster_id, returns the number of duplicates"""
+    signatures = {}
+    band_keys = {}
+    lsh_rows = []
+    for vacancy_id, name, description in rows:
+        signature = get_signature(get_shingle_hashes(name, description))
+        signatures[vacancy_id] = signature
+        # vacancies without text are not duplicates of each other
+        if signature is not EMPTY_SIGNATURE:
+            band_keys[vacancy_id] = get_band_keys(signature)
+            lsh_rows.extend((key, vacancy_id) for key in band_keys[vacancy_id])
+
+    psycopg2.extras.execute_values(cursor, "INSERT INTO vacancy_minhash (id, signature) VALUES %s ON CONFLICT DO NOTHING",
+                                   [(i, s.tobytes()) for i, s in signatures.items()], page_size=1000)
+    psycopg2.extras.execute_values(cursor, "INSERT INTO vacancy_lsh (band_key, vacancy_id) VALUES %s",
+                                   lsh_rows, page_size=1000)
+    all_keys = list({key for key, _ in lsh_rows})
+
+    # one representative per cluster of every bucket, the newest clusters if there are too many
+    cursor.execute("""
+        WITH rep AS (
+            SELECT DISTINCT ON (l.band_key, v.cluster_id) l.band_key, l.vacancy_id, v.cluster_id
+            FROM vacancy_lsh l
+            JOIN vacancy v ON v.id = l.vacancy_id
+            WHERE l.band_key = ANY(%s) AND v.cluster_id IS NOT NULL
+            ORDER BY l.band_key, v.cluster_id, l.vacancy_id
+        ), capped AS (
+            SELECT rep.*, row_number() OVER (PARTITION BY band_key ORDER BY cluster_id DESC) AS pos FROM rep
+        )
+        SELECT c.band_key, c.vacancy_id, m.signature, c.cluster_id
+        FROM capped c
+        JOIN vacancy_minhash m ON m.id = c.vacancy_id
+        WHERE c.pos <= %s
+    """, (all_keys, MAX_BUCKET_CLUSTERS))
+
+    buckets = {}
+    clusters = {}
+    for band_key, vacancy_id, signature, cluster_id in cursor.fetchall():
+        buckets.setdefault(band_key, []).append(vacancy_id)
+        signatures[vacancy_id] = np.frombuffer(bytes(signature), dtype=np.uint32)
+        clusters[vacancy_id] = cluster_id
+
+    parents = {vacancy_id: vacancy_id for vacancy_id in signatures}
+    new_ids = {vacancy_id for vacancy_id, _, _ in rows}
+    for new_id, keys in band_keys.items():
+        similar = {}
+        for key in keys:
+            bucket = buckets.setdefault(key, [])
+            found = False
+            for other_id in bucket:
+                if other_id not in similar:
+                    similar[other_id] = get_similarity(signatures[new_id], signatures[other_id]) >= SIMILARITY_THRESHOLD
+                    if similar[other_id]:
+                        parents[find_root(parents, new_id)] = find_root(parents, other_id)
+                found = found or similar[other_id]
+
+            # the next vacancies of the batch are compared with it only if its cluster is not in the bucket yet
+            if not found and len(bucket) < MAX_BUCKET_CLUSTERS:
+                bucket.append(new_id)
+
+    components = {}
+    for vacancy_id in parents:
+        components.setdefault(find_root(parents, vacancy_id), []).append(vacancy_id)
+
+    new_cluster_ids = []
+    merged_clusters = []
+    duplicates = 0
+    for members in components.values():
+        members_new = [m for m in members if m in new_ids]
+        if not members_new:
+            continue
+
+        old_clusters = {clusters[m] for m in members if m not in new_ids and clusters[m] is not None}
+        cluster_id = min(old_clusters | set(members_new))
+        new_cluster_ids.extend((cluster_id, m) for m in members_new)
+        merged_clusters.extend((cluster_id, c) for c in old_clusters if c != cluster_id)
+        if len(members) > 1:
+            duplicates += len(members_new)
+
+    psycopg2.extras.execute_batch(cursor, "UPDATE vacancy SET cluster_id = %s WHERE id = %s", new_cluster_ids,
+                                  page_size=1000)
+    psycopg2.extras.execute_batch(cursor, "UPDATE vacancy SET cluster_id = %s WHERE cluster_id = %s", merged_clusters,
+                                  page_size=1000)
+
+    # a band key is kept once per cluster, a repost adds nothing to its buckets
+    cursor.execute("""
+        DELETE FROM vacancy_lsh l USING vacancy v, vacancy_lsh l2, vacancy v2
+        WHERE l.band_key = ANY(%s) AND l.vacancy_id = ANY(%s) AND v.id = l.vacancy_id
+          AND l2.band_key = l.band_key AND l2.vacancy_id < l.vacancy_id
+          AND v2.id = l2.vacancy_id AND v2.cluster_id = v.cluster_id
+    """, (all_keys, list(band_keys)))
+    return duplicates
+
+
+def rebuild_lsh(cursor):
+    """Recomputes the band keys from the stored signatures after BANDS or ROWS_PER_BAND have changed"""
+    log(f"Rebuilding the band keys for {BANDS} bands of {ROWS_PER_BAND} rows")
+    cursor.execute("TRUNCATE vacancy_lsh")
+
+    last_id = -1
+    while True:
+        cursor.execute("SELECT id, signature FROM vacancy_minhash WHERE id > %s ORDER BY id LIMIT %s",
+                       (last_id, BATCH_SIZE))
+        rows = cursor.fetchall()
+        if not rows:
+            break
+        last_id = rows[-1][0]
+
+        lsh_rows = []
+        for vacancy_id, signature in rows:
+            signature = np.frombuffer(bytes(signature), dtype=np.uint32)
+            if not np.array_equal(signature, EMPTY_SIGNATURE):
+                lsh_rows.extend((key, vacancy_id) for key in get_band_keys(signature))
+        psycopg2.extras.execute_values(cursor, "INSERT INTO vacancy_lsh (band_key, vacancy_id) VALUES %s",
+                                       lsh_rows, page_size=1000)
+
+    cursor.execute("""
+        DELETE FROM vacancy_lsh l USING (
+            SELECT l.ctid AS row_ctid,
+                   row_number() OVER (PARTITION BY l.band_key, COALESCE(v.cluster_id, v.id) ORDER BY l.vacancy_id) AS pos
+            FROM vacancy_lsh l
+            JOIN vacancy v ON v.id = l.vacancy_id
+        ) d
+        WHERE l.ctid = d.row_ctid AND d.pos > 1
+    """)
+
+
+def check_lsh_params(cursor):
+    """The stored band keys are rebuilt if they were made with other BANDS or ROWS_PER_BAND"""
+    cursor.execute("SELECT bands, rows_per_band FROM dedup_meta WHERE id = 1")
+    if cursor.fetchone() == (BANDS, ROWS_PER_BAND):
+        return
+
+    rebuild_lsh(cursor)
+    cursor.execute("""INSERT INTO dedup_meta (id, bands, rows_per_band) VALUES (1, %s, %s)
+                      ON CONFLICT (id) DO UPDATE SET bands = EXCLUDED.bands, rows_per_band = EXCLUDED.rows_per_band""",
+                   (BANDS, ROWS_PER_BAND))
+
+
+def run_once():
+    conn = db.connect()
+    cursor = conn.cursor()
+
+    create_dedup_tables(cursor)
+    check_lsh_params(cursor)
+    conn.commit()
+
+    total = 0
+    duplicates = 0
+    start = time.monotonic()
+    while True:
+        cursor.execute("SELECT id, name, description FROM vacancy WHERE cluster_id IS NULL ORDER BY id LIMIT %s",
+                       (BATCH_SIZE,))
+        rows = cursor.fetchall()
+        if not rows:
+            break
+
+        duplicates += dedup_batch(cursor, rows)
+        conn.commit()
+
+        total += len(rows)
+        log(f"Deduplicated {total} vacancies, in clusters with others {duplicates}, "
+            f"{total / (time.monotonic() - start):.0f} per sec")
+
+    cursor.close()
+    conn.close()
+
+
+def loop():
+    log(f"Starting the dedup loop")
+
+    while True:
+        try:
+            run_once()
+        except Exception:
+            log(traceback.format_exc())
+        time.sleep(RECHECK_EVERY_SEC)
+
+
+if __name__ == "__main__":
+    if "--once" in sys.argv[1:]:
+        run_once()
+    else:
+        loop()
@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+
+"""Local stand-in of the hh.ru API for benchmarks
+
+Serves /vacancies, /vacancies/{id} and /employers/{id} from generated fixtures, like the real API it
+returns at most PAGINATION_CAP items of a listing, so the crawler has to split date intervals.
+
+    python3 fake_hh_api.py --vacancies 10000 --latency 0.05 --error-rate 0.01
+    HH_API_URL=http://127.0.0.1:8766 python3 get_vacancies.py
+"""
+
+import sys
+import json
+import math
+import time
+import random
+import argparse
+import threading
+
+from datetime import datetime
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+PORT = 8766
+
+FIRST_ID = 40_000_000
+EMPLOYERS = 1000
+DAYS_BACK = 60
+PAGINATION_CAP = 2000
+
+WORDS = ("python java sql postgresql linux docker kubernetes git react javascript c++ go spark hadoop "
+         "разработка опыт команда проект задачи требования условия знание умение").split()
+AREAS = [(1, "Москва"), (2, "Санкт-Петербург"), (3, "Екатеринбург"), (4, "Новосибирск")]
+SPECIALIZATIONS = [("1.221", "Программирование, Разработка"), ("1.117", "Тестирование"),
+                   ("1.536", "CRM системы"), ("2.1", "Продажи")]
+
+
+def generate_vacancy(vacancy_id, seed=0):
+    rnd = random.Random(vacancy_id * 7919 + seed)
+
+    published_ts = time.time() - rnd.uniform(0, DAYS_BACK * 24 * 60 * 60)
+    published_at = datetime.fromtimestamp(published_ts).strftime("%Y-%m-%dT%H:%M:%S+0300")
+    area_id, area_name = rnd.choice(AREAS)
+    spec_id, spec_name = rnd.choice(SPECIALIZATIONS)
+    salary_from = rnd.choice([None, rnd.randrange(30, 300) * 1000])
+    employer_id = rnd.randrange(EMPLOYERS)
+
+    return {
+        "id": str(vacancy_id),
+        "name": " ".join(rnd.choices(WORDS, k=3)),
+        "description": "<p>" + " ".join(rnd.choices(WORDS, k=rnd.randrange(50, 400))) + "</p>",
+        "key_skills": [{"name": w} for w in rnd.sample(WORDS, 5)],
+        "schedule": {"id": "fullDay", "name": "Полный день"},
+        "accept_handicapped": False,
+        "accept_kids": False,
+        "experience": {"id": "between1And3", "name": "От 1 года до 3 лет"},
+        "specializations": [{"id": spec_id, "name": spec_name, "profarea_id": spec_id.split(".")[0],
+                             "profarea_name": "Информационные технологии"}],
+        "contacts": None,
+        "billing_type": {"id": "standard", "name": "Стандарт"},
+        "allow_messages": True,
+        "premium": False,
+        "driver_license_types": [],
+        "accept_incomplete_resumes": False,
+        "employer": {"id": str(employer_id), "name": f"Employer {employer_id}", "trusted": True,
+                     "vacancies_url": f"https://api.hh.ru/vacancies?employer_id={employer_id}",
+                     "alternate_url": f"https://hh.ru/employer/{employer_id}"},
+        "response_letter_required": False,
+        "type": {"id": "open", "name": "Открытая"},
+        "has_test": False,
+        "response_url": None,
+        "test": None,
+        "salary": {"from": salary_from, "to": None, "gross": rnd.random() < 0.5, "currency": "RUR"} if salary_from else None,
+        "archived": rnd.random() < 0.02,
+        "insider_interview": None,
+        "area": {"id": str(area_id), "name": area_name, "url": f"https://api.hh.ru/areas/{area_id}"},
+        "created_at": published_at,
+        "published_at": published_at,
+        "address": {"city": area_name, "street": "Ленина", "building": "1", "description": None,
+                    "lat": 56.8 + rnd.uniform(-0.1, 0.1), "lng": 60.6 + rnd.uniform(-0.1, 0.1)} if rnd.random() < 0.5 else None,
+        "alternate_url": f"https://hh.ru/vacancy/{vacancy_id}",
+        "apply_alternate_url": f"https://hh.ru/applicant/vacancy_response?vacancyId={vacancy_id}",
+        "code": None,
+        "department": None,
+        "employment": {"id": "full", "name": "Полная занятость"},
+    }
+
+
+class FakeApi:
+    def __init__(self, vacancies=10000, latency=0.0, error_rate=0.0, pagination_cap=PAGINATION_CAP, seed=0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.pagination_cap = pagination_cap
+        self.seed = seed
+
+        self.vacancy_ids = list(range(FIRST_ID, FIRST_ID + vacancies))
+        self.published = {vacancy_id: datetime.strptime(generate_vacancy(vacancy_id, seed)["published_at"][:19],
+                                                        "%Y-%m-%dT%H:%M:%S").timestamp()
+                          for vacancy_id in self.vacancy_ids}
+
+        self.requests = 0
+        self.lock = threading.Lock()
+
+    def list_vacancies(self, query):
+        per_page = int(query.get("per_page", ["20"])[0])
+        page = int(query.get("page", ["0"])[0])
+        date_from = datetime.fromisoformat(query["date_from"][0]).timestamp() if "date_from" in query else -math.inf
+        date_to = datetime.fromisoformat(query["date_to"][0]).timestamp() if "date_to" in query else math.inf
+
+        found = [i for i in self.vacancy_ids if date_from <= self.published[i] < date_to]
+        pages = min(math.ceil(len(found) / per_page), self.pagination_cap // per_page)
+        items = found[page * per_page:(page + 1) * per_page] if page < pages else []
+
+        return {"items": [{"id": str(i)} for i in items], "found": len(found), "pages": pages,
+                "per_page": per_page, "page": page}
+
+
+def make_handler(api):
+    class Handler(BaseHTTPRequestHandler):
+        def send_json(self, code, payload, headers=()):
+            body = json.dumps(payload).encode()
+            self.send_response(code)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            for name, value in headers:
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            with api.lock:
+                api.requests += 1
+
+            if api.latency:
+                time.sleep(api.latency)
+            if random.random() < api.error_rate:
+                self.send_json(random.choice([429, 503]), {"errors": [{"type": "too_many_requests"}]},
+                               headers=[("Retry-After", "1")])
+                return
+
+            url = urlparse(self.path)
+            parts = url.path.strip("/").split("/")
+
+            if parts == ["vacancies"]:
+                self.send_json(200, api.list_vacancies(parse_qs(url.query)))
+            elif len(parts) == 2 and parts[0] == "vacancies" and parts[1].isdigit() and int(parts[1]) in api.published:
+                self.send_json(200, generate_vacancy(int(parts[1]), api.seed))
+            elif len(parts) == 2 and parts[0] == "employers":
+                self.send_json(200, {"id": parts[1], "industries": [{"id": "7.540", "name": "Разработка ПО"}]})
+            else:
+                self.send_json(404, {"errors": [{"type": "not_found"}]})
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+def start_server(api, port=0):
+    """Starts the server in a background thread, returns it, the port is server.server_port"""
+    server = ThreadingHTTPServer(("127.0.0.1", port), make_handler(api))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, default=PORT)
+    parser.add_argument("--vacancies", type=int, default=10000)
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every response")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of 429/503 responses")
+    parser.add_argument("--pagination-cap", type=int, default=PAGINATION_CAP)
+    args = parser.parse_args()
+
+    api = FakeApi(args.vacancies, args.latency, args.error_rate, args.pagination_cap)
+    server = start_server(api, args.port)
+    print(f"Fake hh.ru API on http://127.0.0.1:{server.server_port}", file=sys.stderr)
+
+    while True:
+        time.sleep(60)
+
+
+if __name__ == "__main__":
+    main()
@@ -5,22 +5,35 @@ import traceback
 
 from datetime import datetime, date
 
-import psycopg2
 import psycopg2.extras
 
+from hdfs import InsecureClient
 from pyspark.sql import SparkSession
 
+import db
+from parquet_manifest import read_manifest, get_manifest_watermark, build_manifest, write_manifest
+from vacancy_table import write_snapshot, TABLE_PATH
+from pipeline_metrics import StageMetrics
+from pipeline_markers import write_marker, remove_marker, wait_for_marker, PIPELINE_DIR
+from profiling import profile_stage
+from salary_stats import update_sketches
 
-HOST = os.environ.get("POSTGRES_HOST", "db")
-USER = os.environ.get("POSTGRES_USER", "vacancy")
-PASSWORD = os.environ.get("POSTGRES_PASSWORD", "psql")
-DB = os.environ.get("POSTGRES_DB", "vacancy")
+
+HDFS_URL = os.environ.get("HDFS_URL", "http://namenode:9870")
+HDFS_USER = os.environ.get("HDFS_USER", "jovyan")
+
+DATA_DIR = "data"
 
 PARQUET_FILE = "/vacancy.parquet"
 ROWS_PER_FILE = 50000
 
 RECHECK_EVERY_SEC = 60
 
+EXPORT_REQUEST_MARKER = "export_request"
+EXPORT_DONE_MARKER = "export_done"
+
+metrics = StageMetrics("feeder_hadoop")
+
 def log(*args, file=sys.stderr, **kwargs):
     timestamp = datetime.strftime(datetime.now(), "%Y-%m-%d %H:%M:%S")
     print(timestamp, *args, **kwargs, file=file, flush=True)
@@ -41,33 +54,69 @@ def get_db_max_date(cursor):
     return max(dates)
 
 
-def get_parquet_max_date(spark):
+def get_parquet_max_date(client):
+    """Returns the source db watermark of the last export, it is read from the manifest without spark"""
     DEFAULT_DATE = date(year=1970, month=1, day=1)
-    fs = spark._jvm.org.apache.hadoop.fs.FileSystem.get(spark._jsc.hadoopConfiguration())
-
-    SUCCESS_FILE = f"{PARQUET_FILE}/_SUCCESS"
 
     try:
-        file = spark._jvm.org.apache.hadoop.fs.Path(SUCCESS_FILE)
-        time_ts = fs.getFileStatus(file).getModificationTime() / 1000
-        return date.fromtimestamp(time_ts)
+        watermark = get_manifest_watermark(read_manifest(client, PARQUET_FILE))
     except Exception:
         log("Exception while trying to get parquet max date")
         log(traceback.format_exc())
         return DEFAULT_DATE
 
-def run_once():
-    conn = psycopg2.connect(dbname=DB, user=USER, password=PASSWORD, host=HOST)
+    return watermark or DEFAULT_DATE
+
+
+def export_db(client, max_date_so_far):
+    log(f"Starting spark")
+    spark = SparkSession.builder.master('local').config("spark.executor.memory", "4g").config("spark.driver.memory", "4g").getOrCreate()
+
+    properties = {
+        "driver": "org.postgresql.Driver",
+        "user": db.USER,
+        "password": db.PASSWORD
+    }
+
+    log(f"Saving db to hdfs://{PARQUET_FILE}")
+    export_start = time.monotonic()
+    df = spark.read.jdbc(url=f"jdbc:postgresql://{db.HOST}/{db.DB}",table='vacancy',properties=properties)
+    df.write.option("maxRecordsPerFile", ROWS_PER_FILE).parquet(PARQUET_FILE, mode="overwrite")
+
+    # the count is taken from parquet footers, so it is cheap and matches exactly what was written.
+    # The watermark was taken before reading, so rows fed meanwhile will cause one more export later
+    rows = spark.read.parquet(PARQUET_FILE).count()
+    metrics.observe_step("export", time.monotonic() - export_start)
+    metrics.add_rows_upserted("exported", rows)
+
+    log(f"Saving snapshot {max_date_so_far} to hdfs://{TABLE_PATH}")
+    snapshot = write_snapshot(spark, spark.read.parquet(PARQUET_FILE), max_date_so_far)
+    log(f"Snapshot saved, live rows={snapshot['rows']}, changed buckets={len(snapshot['changed_buckets'])}")
+    metrics.observe_step("export_with_snapshot", time.monotonic() - export_start)
+    metrics.flush(force=True)
+
+    write_manifest(client, PARQUET_FILE, build_manifest(client, PARQUET_FILE, max_date_so_far, rows))
+    log(f"Parquet saved, rows={rows}, watermark={max_date_so_far}")
+
+
+def run_once(profile=None):
+    conn = db.connect()
     cursor = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
 
     max_date_so_far = get_db_max_date(cursor)
-
     cursor.close()
+
+    client = InsecureClient(HDFS_URL, user=HDFS_USER)
+
+    # only the snapshots fed since the last run are sketched, so it is cheap to check every time
+    try:
+        update_sketches(conn, client)
+    except Exception:
+        log("Exception while updating salary sketches")
+        log(traceback.format_exc())
     conn.close()
 
-    log(f"Checking last modtime in spark")
-    spark = SparkSession.builder.master('local').config("spark.executor.memory", "4g").config("spark.driver.memory", "4g").getOrCreate()
-    parquet_date = get_parquet_max_date(spark)
+    parquet_date = get_parquet_max_date(client)
 
     log(f"Parquet date {parquet_date}, db date {max_date_so_far}")
 
@@ -76,16 +125,14 @@ def run_once():
             log(f"Parquet date is from future")
         return
 
-    properties = {
-        "driver": "org.postgresql.Driver",
-        "user": USER,
-        "password": PASSWORD
-    }
+    # snapshot dirs belong to the crawler user, so they can be not writable from this container
+    profile_dir = os.path.join(DATA_DIR, max_date_so_far.isoformat())
+    if not os.access(profile_dir, os.W_OK):
+        profile_dir = PIPELINE_DIR
+
+    with profile_stage("feeder_hadoop", out_dir=profile_dir, enabled=profile):
+        export_db(client, max_date_so_far)
 
-    log(f"Saving db to hdfs://{PARQUET_FILE}")
-    df = spark.read.jdbc(url=f"jdbc:postgresql://{HOST}/{DB}",table='vacancy',properties=properties)
-    df.write.option("maxRecordsPerFile", ROWS_PER_FILE).parquet(PARQUET_FILE, mode="overwrite")
-    log(f"Parquet saved")
 
 def loop():
     log(f"Starting the hadoop feeder loop")
@@ -98,5 +145,26 @@ def loop():
         time.sleep(RECHECK_EVERY_SEC)
 
 
+def worker_loop():
+    """Exports on requests of pipeline_scheduler.py instead of polling db"""
+    log(f"Starting the hadoop feeder worker")
+
+    while True:
+        request = wait_for_marker(EXPORT_REQUEST_MARKER)
+        remove_marker(EXPORT_REQUEST_MARKER)
+
+        log(f"Export requested by {request['run_id']}")
+        try:
+            run_once(profile=request.get("profile"))
+            write_marker(EXPORT_DONE_MARKER, {"run_id": request["run_id"], "status": "success"})
+        except Exception:
+            log(traceback.format_exc())
+            write_marker(EXPORT_DONE_MARKER, {"run_id": request["run_id"], "status": "failed",
+                                              "error": traceback.format_exc()})
+
+
 if __name__ == "__main__":
-    loop()
+    if "--worker" in sys.argv[1:]:
+        worker_loop()
+    else:
+        loop()
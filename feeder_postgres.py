@@ -1,32 +1,68 @@
 import sys
 import os
-import csv
 import re
 import time
+import itertools
 import traceback
 
 from datetime import datetime, date
 
-import psycopg2
-import psycopg2.extras
-import dotenv
+import pyarrow as pa
+import pyarrow.csv
+import pyarrow.compute as pc
 
-from psycopg2.extensions import AsIs
+import db
 
-try:
-    dotenv.load_dotenv("postgres.env")
-except OSError:
-    pass
-
-HOST = os.environ.get("POSTGRES_HOST", "db")
-USER = os.environ.get("POSTGRES_USER", "vacancy")
-PASSWORD = os.environ.get("POSTGRES_PASSWORD", "psql")
-DB = os.environ.get("POSTGRES_DB", "vacancy")
+from hh_vacancy import COLUMN_NAMES
+from id_set import IdSet
+from geo_grid import encode_cells, create_geo_tables, update_cell_counts
+from pipeline_metrics import StageMetrics
+from profiling import profile_stage
+from skill_extractor import iter_with_terms
 
 DATA_DIR = "data"
 
 RECHECK_EVERY_SEC = 60
 
+CSV_BLOCK_SIZE = 16 * 1024 * 1024
+DB_BATCH_ROWS = 1000
+
+INDEXED_COLUMNS = ["area_id", "area_name", "added_at", "updated_at", "removed_at", "archived"]
+
+BOOL_COLUMNS = [
+    "accept_handicapped", "accept_kids", "allow_messages", "premium", "accept_incomplete_resumes",
+    "employer_trusted", "response_letter_required", "has_test", "test_required", "salary_gross", "archived",
+]
+TIMESTAMP_COLUMNS = ["created_at", "published_at"]
+
+# computed by the feeder, their changes do not mean that the vacancy was updated
+DERIVED_COLUMNS = ["added_at", "terms_found", "geo_cell"]
+
+# the columns compared with the database, id goes first
+FEED_COLUMNS = COLUMN_NAMES + ["terms_found", "geo_cell", "added_at"]
+ADDED_AT_POS = FEED_COLUMNS.index("added_at")
+
+# the hot statements of feed_csv, they are prepared once per connection
+SELECT_SQL = f"SELECT {', '.join(FEED_COLUMNS)}, updated_at FROM vacancy WHERE id = ANY($1)"
+UPDATE_SQL = (f"UPDATE vacancy SET {', '.join(f'{k} = ${pos}' for pos, k in enumerate(FEED_COLUMNS[1:], 2))}, "
+              f"updated_at = ${len(FEED_COLUMNS) + 1} WHERE id = $1")
+REMOVE_SQL = "UPDATE vacancy SET removed_at = $1 WHERE id = ANY($2)"
+INSERT_SQL = f"INSERT INTO vacancy ({', '.join(FEED_COLUMNS)}, updated_at) VALUES %s"
+
+# the other columns are strings, the timestamps are parsed after the offset is cut off
+CSV_COLUMN_TYPES = {
+    "id": pa.int64(),
+    "employer_id": pa.int64(),
+    "salary_from": pa.int64(),
+    "salary_to": pa.int64(),
+    "area_id": pa.int64(),
+    "address_lat": pa.float64(),
+    "address_lng": pa.float64(),
+    **{column: pa.bool_() for column in BOOL_COLUMNS},
+}
+
+metrics = StageMetrics("feeder_postgres")
+
 def log(*args, file=sys.stderr, **kwargs):
     timestamp = datetime.strftime(datetime.now(), "%Y-%m-%d %H:%M:%S")
     print(timestamp, *args, **kwargs, file=file, flush=True)
@@ -89,18 +125,26 @@ def create_vacancy_table(cursor):
             department_name VARCHAR(1024),
             employment_id VARCHAR(1024),
             employment_name VARCHAR(1024),
+            terms_found TEXT,
+            geo_cell BIGINT,
             added_at DATE,
             updated_at DATE,
             removed_at DATE
         )
     """)
 
-    cursor.execute("CREATE INDEX ON vacancy (area_id)")
-    cursor.execute("CREATE INDEX ON vacancy (area_name)")
-    cursor.execute("CREATE INDEX ON vacancy (added_at)")
-    cursor.execute("CREATE INDEX ON vacancy (updated_at)")
-    cursor.execute("CREATE INDEX ON vacancy (removed_at)")
-    cursor.execute("CREATE INDEX ON vacancy (archived)")
+    # computed at feed time, the tables created before have no such column
+    cursor.execute("ALTER TABLE vacancy ADD COLUMN IF NOT EXISTS terms_found TEXT")
+    create_geo_tables(cursor)
+
+    # the names are the ones postgres gave to the unnamed indexes before, every run used to add
+    # a copy like vacancy_area_id_idx1, the copies are dropped
+    for column in INDEXED_COLUMNS:
+        cursor.execute(f"CREATE INDEX IF NOT EXISTS vacancy_{column}_idx ON vacancy ({column})")
+        cursor.execute("SELECT indexname FROM pg_indexes WHERE schemaname = current_schema() AND tablename = 'vacancy' "
+                       "AND indexname ~ %s", (f"^vacancy_{column}_idx[0-9]+$", ))
+        for (name, ) in cursor.fetchall():
+            cursor.execute(f"DROP INDEX {name}")
 
 def cut_text(text, limit=128):
     text = str(text)
@@ -108,88 +152,142 @@ def cut_text(text, limit=128):
         return text
     return text[:limit] + "..."
 
-def feed_csv(csv_reader, csv_date, cursor, logfile):
-    STATS_EVERY = 1000
-    known_ids = set()
-
-    items_added = 0
-    items_updated = 0
-    items_removed = 0
-
-    for pos, csv_row in enumerate(csv_reader):
-        if pos % STATS_EVERY == 0:
-            log(f"Rows feeded={pos} added={items_added} updated={items_updated} removed={items_removed}")
-
-        csv_row["id"] = int(csv_row["id"])
-        csv_row["created_at"] = datetime.fromisoformat(csv_row["created_at"].split("+")[0])
-        csv_row["published_at"] = datetime.fromisoformat(csv_row["published_at"].split("+")[0])
-
-        for k in csv_row:
-            if not csv_row[k]:
-                csv_row[k] = None
-
-        csv_row["archived"] = (csv_row["archived"].lower() == "true")
-        if csv_row["archived"]:
-            # consider archived vacations as deleted ones
-            continue
-
-        known_ids.add(csv_row["id"])
-
-        cursor.execute("SELECT * FROM vacancy WHERE id=%s", (csv_row["id"], ))
-        db_row = cursor.fetchone()
-
-        if not db_row:
-            log(f"Row {csv_row['id']}: adding new record", file=logfile)
-
+def get_csv_schema():
+    """Returns the schema of the batches of read_csv_batches()"""
+    return pa.schema([(column, pa.timestamp("s") if column in TIMESTAMP_COLUMNS else CSV_COLUMN_TYPES.get(column, pa.string()))
+                      for column in COLUMN_NAMES])
+
+
+def read_csv_batches(filename):
+    """Yields record batches of the csv with typed columns, empty values are nulls"""
+    column_types = {column: CSV_COLUMN_TYPES.get(column, pa.string()) for column in COLUMN_NAMES}
+    reader = pyarrow.csv.open_csv(
+        filename,
+        read_options=pyarrow.csv.ReadOptions(block_size=CSV_BLOCK_SIZE),
+        # descriptions are multiline
+        parse_options=pyarrow.csv.ParseOptions(newlines_in_values=True),
+        # only the empty values are nulls, "NA" or "null" is a text like any other
+        convert_options=pyarrow.csv.ConvertOptions(column_types=column_types, null_values=[""],
+                                                   strings_can_be_null=True))
+
+    for batch in reader:
+        columns = []
+        for name, column in zip(batch.schema.names, batch.columns):
+            if name in TIMESTAMP_COLUMNS:
+                # the local time is kept, "2021-03-01T12:00:00+0300" -> 2021-03-01 12:00:00
+                column = pc.strptime(pc.utf8_slice_codeunits(column, 0, 19), format="%Y-%m-%dT%H:%M:%S", unit="s")
+            columns.append(column)
+        yield pa.RecordBatch.from_arrays(columns, names=batch.schema.names)
+
+
+def iter_rows(batches, known_ids):
+    """Yields dicts of the not archived rows, their ids are added to known_ids"""
+    for batch in batches:
+        # consider archived vacations as deleted ones
+        batch = batch.filter(pc.invert(pc.fill_null(batch.column("archived"), False)))
+        known_ids.add_many(batch.column("id").to_numpy())
+
+        # nulls become nan and get no cell
+        cells = encode_cells(batch.column("address_lat").to_numpy(zero_copy_only=False),
+                             batch.column("address_lng").to_numpy(zero_copy_only=False))
+        batch = batch.append_column("geo_cell", pa.array(cells, mask=cells < 0))
+        yield from batch.to_pylist()
+
+
+def feed_rows(rows, csv_date, cursor, logfile):
+    """Inserts and updates the rows of one batch, returns (added, updated)"""
+    db.execute_prepared(cursor, "feed_select", SELECT_SQL, ([row["id"] for row in rows], ))
+    db_rows = {db_row[0]: db_row for db_row in cursor.fetchall()}
+
+    to_insert = {}
+    to_update = []
+    updated = 0
+    for csv_row in rows:
+        db_row = db_rows.get(csv_row["id"])
+
+        if db_row is None:
+            if csv_row["id"] not in to_insert:
+                log(f"Row {csv_row['id']}: adding new record", file=logfile)
+            # the last row of a repeated id wins
             csv_row["added_at"] = csv_date
-            csv_row["updated_at"] = csv_row["added_at"]
-
-            columns = tuple(k for k in csv_row if csv_row[k])
-            values = tuple(csv_row[k] for k in columns)
-
-            cursor.execute("INSERT INTO vacancy (%s) values %s", (AsIs(','.join(columns)), values))
-            items_added += 1
+            csv_row["updated_at"] = csv_date
+            to_insert[csv_row["id"]] = csv_row
             continue
 
-        csv_row["added_at"] = min(csv_date, db_row.get("added_at", csv_date))
+        csv_row["added_at"] = min(csv_date, db_row[ADDED_AT_POS] or csv_date)
 
-        if not db_row["updated_at"] or db_row["updated_at"] > csv_date:
+        db_updated_at = db_row[-1]
+        if not db_updated_at or db_updated_at > csv_date:
             log(f"Row {csv_row['id']}: newer record detected, firing error just in case")
             log(f"Row {csv_row['id']}: newer record detected, firing error just in case", file=logfile)
             raise Exception("newer record detected")
 
         # find the differences
-        columns = tuple(k for k in csv_row if str(csv_row[k]) != str(db_row.get(k)))
-        values = tuple(csv_row[k] for k in columns)
-
-        was_update = False
+        changes = [(k, db_value) for k, db_value in zip(FEED_COLUMNS, db_row) if str(csv_row[k]) != str(db_value)]
+        if not changes:
+            continue
 
-        for column, value in zip(columns, values):
+        for column, db_value in changes:
             log(f"Row {csv_row['id']}: updating column {column} from " +
-                f"{cut_text(db_row.get(column))} to {cut_text(value)}", file=logfile)
+                f"{cut_text(db_value)} to {cut_text(csv_row[column])}", file=logfile)
+
+        # derived columns change with the extractor, not with the vacancy
+        was_update = any(column not in DERIVED_COLUMNS for column, _ in changes)
+        csv_row["updated_at"] = csv_date if was_update else db_updated_at
+        to_update.append(csv_row)
+        updated += was_update
+
+    db.execute_values(cursor, INSERT_SQL, [tuple(row[k] for k in FEED_COLUMNS) + (row["updated_at"], )
+                                           for row in to_insert.values()])
+    db.execute_batch_prepared(cursor, "feed_update", UPDATE_SQL,
+                              [tuple(row[k] for k in FEED_COLUMNS) + (row["updated_at"], ) for row in to_update])
+
+    return len(to_insert), updated
 
-            cursor.execute("UPDATE vacancy SET %s = %s WHERE id = %s ", (AsIs(column), value, csv_row["id"]))
 
-            if column != "added_at":
-                was_update = True
+def feed_csv(batches, csv_date, cursor, logfile):
+    """Feeds record batches of read_csv_batches()"""
+    STATS_EVERY = 10000
+    known_ids = IdSet()
 
-        if was_update:
-            cursor.execute("UPDATE vacancy SET updated_at = %s WHERE id = %s ", (csv_date, csv_row["id"]))
-            items_updated += 1
+    items_added = 0
+    items_updated = 0
+
+    # the description and key skills are scanned for terms in worker processes
+    rows = iter_with_terms(iter_rows(batches, known_ids))
+    fed = 0
+    while True:
+        batch = []
+        for row, terms_found in itertools.islice(rows, DB_BATCH_ROWS):
+            row["terms_found"] = terms_found
+            batch.append(row)
+        if not batch:
+            break
+
+        added, updated = feed_rows(batch, csv_date, cursor, logfile)
+        items_added += added
+        items_updated += updated
+        metrics.add_rows_upserted("added", added)
+        metrics.add_rows_upserted("updated", updated)
+
+        if fed // STATS_EVERY != (fed + len(batch)) // STATS_EVERY:
+            log(f"Rows feeded={fed + len(batch)} added={items_added} updated={items_updated}")
+            metrics.flush()
+        fed += len(batch)
 
     # mark disapeared records as removed
     cursor.execute("SELECT id, removed_at FROM vacancy WHERE added_at < %s", (csv_date,))
+    rows = cursor.fetchall()
 
-    to_remove = []
-    for row in cursor:
-        if row["id"] not in known_ids:
-            if not row["removed_at"] or csv_date < row["removed_at"]:
-                to_remove.append(row["id"])
+    disappeared = ~known_ids.contains_many([row_id for row_id, _ in rows])
+    to_remove = [row_id for (row_id, removed_at), is_disappeared in zip(rows, disappeared)
+                 if is_disappeared and (not removed_at or csv_date < removed_at)]
 
     for row_id in to_remove:
         log(f"Row {row_id}: marking as removed at {csv_date}", file=logfile)
-        cursor.execute("UPDATE vacancy SET removed_at = %s WHERE id = %s", (csv_date, row_id))
-        items_removed += 1
+    db.execute_prepared(cursor, "feed_remove", REMOVE_SQL, (csv_date, to_remove))
+    items_removed = len(to_remove)
+    metrics.add_rows_upserted("removed", items_removed)
 
     log(f"Items: added={items_added}, updated={items_updated}, removed={items_removed}")
 
@@ -209,51 +307,51 @@ def get_db_max_date(cursor):
     return max(dates)
 
 
-def run_once():
+def run_once(pool):
     DATE_RE = r"\d\d\d\d-\d\d-\d\d"
     CSV_FILENAME = "result.csv"
     LOG_FILENAME = "feeder_postgres_log.txt"
 
     log(f"Checking dirs to feed")
 
-    conn = psycopg2.connect(dbname=DB, user=USER, password=PASSWORD, host=HOST)
-    cursor = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+    with pool.connection() as conn, conn.cursor() as cursor:
+        db.ensure_created(conn, "vacancy", create_vacancy_table)
 
-    create_vacancy_table(cursor)
+        max_date_so_far = get_db_max_date(cursor)
 
-    max_date_so_far = get_db_max_date(cursor)
-
-    dirs = sorted(d for d in os.listdir() if re.fullmatch(DATE_RE, d, re.ASCII))
-
-    for curr_dir in dirs:
-        csv_dir_date = datetime.strptime(curr_dir, "%Y-%m-%d").date()
-        if csv_dir_date <= max_date_so_far:
-            continue
+        dirs = sorted(d for d in os.listdir() if re.fullmatch(DATE_RE, d, re.ASCII))
 
-        csv_filename = os.path.join(curr_dir, CSV_FILENAME)
-        log_filename = os.path.join(curr_dir, LOG_FILENAME)
-        log_filename_pretty = os.path.join(DATA_DIR, log_filename)
+        for curr_dir in dirs:
+            csv_dir_date = datetime.strptime(curr_dir, "%Y-%m-%d").date()
+            if csv_dir_date <= max_date_so_far:
+                continue
 
-        log(f"Feeding dir {curr_dir}, log file {log_filename_pretty}")
+            csv_filename = os.path.join(curr_dir, CSV_FILENAME)
+            log_filename = os.path.join(curr_dir, LOG_FILENAME)
+            log_filename_pretty = os.path.join(DATA_DIR, log_filename)
 
-        with open(log_filename, "w", encoding="utf8") as logfile:
-            with open(csv_filename, newline="", encoding="utf8") as csv_file:
-                csv_reader = csv.DictReader(csv_file)
-                feed_csv(csv_reader, csv_dir_date, cursor, logfile)
+            log(f"Feeding dir {curr_dir}, log file {log_filename_pretty}")
+            feed_start = time.monotonic()
 
-        conn.commit()
-        log(f"Finished feeding dir {curr_dir}")
+            with open(log_filename, "w", encoding="utf8") as logfile:
+                with profile_stage("feeder_postgres", out_dir=curr_dir):
+                    feed_csv(read_csv_batches(csv_filename), csv_dir_date, cursor, logfile)
+                update_cell_counts(cursor, csv_dir_date)
 
-    cursor.close()
-    conn.close()
+            conn.commit()
+            metrics.observe_step("feed", time.monotonic() - feed_start)
+            metrics.flush(force=True)
+            log(f"Finished feeding dir {curr_dir}")
 
 
 def loop():
     log(f"Starting the feeder loop")
 
+    # the connection and its prepared statements live as long as the feeder
+    pool = db.Pool(maxconn=1)
     while True:
         try:
-            run_once()
+            run_once(pool)
         except Exception:
             log(traceback.format_exc())
         time.sleep(RECHECK_EVERY_SEC)
@@ -261,4 +359,7 @@ def loop():
 
 if __name__ == "__main__":
     os.chdir(DATA_DIR)
-    loop()
+    if "--once" in sys.argv[1:]:
+        run_once(db.Pool(maxconn=1))
+    else:
+        loop()
@@ -0,0 +1,252 @@
+#!/usr/bin/env python3
+
+"""Grid cells of vacancy addresses for map views and radius searches
+
+vacancy.geo_cell is a geohash as a number: 26 bits of longitude and 26 bits of latitude interleaved,
+the longitude bit goes first like in geohash. The first bits of a cell are its parent cell, so any
+coarser cell is a range of geo_cell and the btree index on geo_cell prunes by cells:
+
+    level 20 - about 40 km, level 30 - about 1 km, level 40 - about 40 m (the number of the first bits)
+
+The feeder computes geo_cell and counts the vacancies of every snapshot per cell in geo_cell_count.
+
+    rows = find_within_radius(cursor, 56.8386, 60.6055, radius_km=5)
+    rows = find_in_bbox(cursor, 56.7, 60.4, 56.95, 60.8)
+    python3 geo_grid.py --backfill
+"""
+
+import sys
+import math
+
+from datetime import datetime
+
+import numpy as np
+
+CELL_BITS = 52
+COORD_BITS = CELL_BITS // 2
+COORD_MAX = (1 << COORD_BITS) - 1
+
+# the levels of geo_cell_count, from the country to the district
+COUNT_LEVELS = [20, 26, 30, 36]
+
+# a query covers its area with at most this number of cells, the exact filter is done by postgres
+MAX_COVER_CELLS = 64
+
+EARTH_RADIUS_KM = 6371.0
+
+GEOHASH_ALPHABET = "0123456789bcdefghjkmnpqrstuvwxyz"
+
+BACKFILL_BATCH = 10000
+
+
+def log(*args, file=sys.stderr, **kwargs):
+    timestamp = datetime.strftime(datetime.now(), "%Y-%m-%d %H:%M:%S")
+    print(timestamp, *args, **kwargs, file=file, flush=True)
+
+
+def spread_bits(x):
+    """Moves bit i of x to bit 2i"""
+    x = x.astype(np.uint64) & np.uint64(COORD_MAX)
+    for shift, mask in ((16, 0x0000FFFF0000FFFF), (8, 0x00FF00FF00FF00FF), (4, 0x0F0F0F0F0F0F0F0F),
+                        (2, 0x3333333333333333), (1, 0x5555555555555555)):
+        x = (x | (x << np.uint64(shift))) & np.uint64(mask)
+    return x
+
+
+def compact_bits(x):
+    """The inverse of spread_bits"""
+    x = x.astype(np.uint64) & np.uint64(0x5555555555555555)
+    for shift, mask in ((1, 0x3333333333333333), (2, 0x0F0F0F0F0F0F0F0F), (4, 0x00FF00FF00FF00FF),
+                        (8, 0x0000FFFF0000FFFF), (16, 0x00000000FFFFFFFF)):
+        x = (x | (x >> np.uint64(shift))) & np.uint64(mask)
+    return x
+
+
+def to_grid(lat, lng, bits=COORD_BITS):
+    """Returns the row and the column of the grid of 2^bits x 2^bits cells"""
+    size = 1 << bits
+    lat_i = np.clip(np.floor((np.asarray(lat, dtype=np.float64) + 90) / 180 * size), 0, size - 1)
+    lng_i = np.clip(np.floor((np.asarray(lng, dtype=np.float64) + 180) / 360 * size), 0, size - 1)
+    return lat_i.astype(np.int64), lng_i.astype(np.int64)
+
+
+def encode_cells(lat, lng):
+    """Returns int64 cells of the coordinates, -1 where the coordinates are unknown or wrong"""
+    lat = np.asarray(lat, dtype=np.float64)
+    lng = np.asarray(lng, dtype=np.float64)
+    valid = (np.abs(lat) <= 90) & (np.abs(lng) <= 180)
+
+    lat_i, lng_i = to_grid(np.where(valid, lat, 0), np.where(valid, lng, 0))
+    cells = ((spread_bits(lng_i) << np.uint64(1)) | spread_bits(lat_i)).astype(np.int64)
+    return np.where(valid, cells, -1)
+
+
+def get_parent(cells, level):
+    return np.asarray(cells, dtype=np.int64) >> (CELL_BITS - level)
+
+
+def get_cell_center(cells, level):
+    """Returns (lat, lng) of the centers of the cells of the level"""
+    cells = np.asarray(cells, dtype=np.int64) << (CELL_BITS - level)
+    lat_i = compact_bits(cells).astype(np.float64)
+    lng_i = compact_bits(cells >> 1).astype(np.float64)
+
+    # the longitude gets the odd bit of an odd level
+    lat_size = 180 / (1 << (level // 2))
+    lng_size = 360 / (1 << ((level + 1) // 2))
+    return lat_i / (1 << COORD_BITS) * 180 - 90 + lat_size / 2, lng_i / (1 << COORD_BITS) * 360 - 180 + lng_size / 2
+
+
+def to_geohash(cell, level=CELL_BITS // 5 * 5):
+    """Returns the geohash string of a cell, a character is 5 bits"""
+    code = int(cell) >> (CELL_BITS - level)
+    chars = []
+    for _ in range(level // 5):
+        chars.append(GEOHASH_ALPHABET[code & 31])
+        code >>= 5
+    return "".join(reversed(chars))
+
+
+def get_cover_ranges(min_lat, min_lng, max_lat, max_lng):
+    """Returns [first cell, last cell] ranges of geo_cell covering the box, adjacent ranges are merged,
+    no ranges for an inverted box"""
+    if not min_lat <= max_lat or not min_lng <= max_lng:
+        return []
+
+    for level in range(CELL_BITS, 0, -2):
+        bits = level // 2
+        lat_from, lng_from = to_grid(min_lat, min_lng, bits)
+        lat_to, lng_to = to_grid(max_lat, max_lng, bits)
+        if (lat_to - lat_from + 1) * (lng_to - lng_from + 1) <= MAX_COVER_CELLS:
+            break
+
+    lat_i, lng_i = np.meshgrid(np.arange(lat_from, lat_to + 1), np.arange(lng_from, lng_to + 1))
+    codes = np.sort(((spread_bits(lng_i.ravel()) << np.uint64(1)) | spread_bits(lat_i.ravel())).astype(np.int64))
+
+    shift = CELL_BITS - level
+    ranges = []
+    for code in codes.tolist():
+        if ranges and ranges[-1][1] + 1 == code << shift:
+            ranges[-1][1] = ((code + 1) << shift) - 1
+        else:
+            ranges.append([code << shift, ((code + 1) << shift) - 1])
+    return ranges
+
+
+def get_ranges_condition(ranges):
+    condition = " OR ".join("geo_cell BETWEEN %s AND %s" for _ in ranges)
+    return f"({condition})", [value for cell_range in ranges for value in cell_range]
+
+
+def find_in_bbox(cursor, min_lat, min_lng, max_lat, max_lng, columns=("id", "name", "address_lat", "address_lng")):
+    ranges = get_cover_ranges(min_lat, min_lng, max_lat, max_lng)
+    if not ranges:
+        return []
+
+    condition, params = get_ranges_condition(ranges)
+    cursor.execute(f"""
+        SELECT {', '.join(columns)} FROM vacancy
+        WHERE {condition} AND address_lat BETWEEN %s AND %s AND address_lng BETWEEN %s AND %s
+    """, params + [min_lat, max_lat, min_lng, max_lng])
+    return cursor.fetchall()
+
+
+def find_within_radius(cursor, lat, lng, radius_km, columns=("id", "name", "address_lat", "address_lng")):
+    """Returns the rows with distance_km as the last column, the nearest first"""
+    lat_delta = math.degrees(radius_km / EARTH_RADIUS_KM)
+    # near the poles the box is all the longitudes
+    cos_lat = math.cos(math.radians(min(89.9, abs(lat) + lat_delta)))
+    lng_delta = min(180.0, lat_delta / cos_lat)
+
+    ranges = get_cover_ranges(max(-90.0, lat - lat_delta), max(-180.0, lng - lng_delta),
+                              min(90.0, lat + lat_delta), min(180.0, lng + lng_delta))
+    if not ranges:
+        return []
+
+    condition, params = get_ranges_condition(ranges)
+    cursor.execute(f"""
+        SELECT * FROM (
+            SELECT {', '.join(columns)},
+                   2 * %s * asin(sqrt(power(sin(radians(address_lat - %s) / 2), 2) +
+                       cos(radians(%s)) * cos(radians(address_lat)) * power(sin(radians(address_lng - %s) / 2), 2)))
+                   AS distance_km
+            FROM vacancy
+            WHERE {condition}
+        ) v
+        WHERE distance_km <= %s
+        ORDER BY distance_km
+    """, [EARTH_RADIUS_KM, lat, lat, lng] + params + [radius_km])
+    return cursor.fetchall()
+
+
+def create_geo_tables(cursor):
+    cursor.execute("ALTER TABLE vacancy ADD COLUMN IF NOT EXISTS geo_cell BIGINT")
+    cursor.execute("CREATE INDEX IF NOT EXISTS vacancy_geo_cell_idx ON vacancy (geo_cell)")
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS geo_cell_count (
+            snapshot DATE NOT NULL,
+            level INT NOT NULL,
+            cell BIGINT NOT NULL,
+            vacancies INT NOT NULL,
+            PRIMARY KEY (snapshot, level, cell)
+        )
+    """)
+
+
+def update_cell_counts(cursor, snapshot):
+    """Counts the vacancies open at the snapshot date per cell of every level of COUNT_LEVELS"""
+    cursor.execute("DELETE FROM geo_cell_count WHERE snapshot = %s", (snapshot, ))
+    cursor.execute("""
+        INSERT INTO geo_cell_count (snapshot, level, cell, vacancies)
+        SELECT %s, level, geo_cell >> (%s - level), COUNT(*)
+        FROM vacancy, unnest(%s::INT[]) AS level
+        WHERE geo_cell IS NOT NULL AND added_at <= %s AND (removed_at IS NULL OR removed_at > %s)
+        GROUP BY 2, 3
+    """, (snapshot, CELL_BITS, COUNT_LEVELS, snapshot, snapshot))
+
+
+def backfill():
+    import db
+    import feeder_postgres
+
+    conn = db.connect()
+    db.ensure_created(conn, "vacancy", feeder_postgres.create_vacancy_table)
+    cursor = conn.cursor()
+
+    total = 0
+    last_id = -1
+    while True:
+        cursor.execute("""SELECT id, address_lat, address_lng FROM vacancy
+                          WHERE id > %s AND geo_cell IS NULL AND address_lat IS NOT NULL AND address_lng IS NOT NULL
+                          ORDER BY id LIMIT %s""", (last_id, BACKFILL_BATCH))
+        rows = cursor.fetchall()
+        if not rows:
+            break
+
+        ids, lat, lng = zip(*rows)
+        cells = encode_cells(lat, lng)
+        cursor.execute("""UPDATE vacancy v SET geo_cell = c.cell FROM unnest(%s::BIGINT[], %s::BIGINT[]) AS c(id, cell)
+                          WHERE v.id = c.id AND c.cell >= 0""", (list(ids), cells.tolist()))
+        conn.commit()
+
+        last_id = ids[-1]
+        total += len(rows)
+        log(f"Backfilled geo cells of {total} vacancies")
+
+    cursor.execute("""SELECT DISTINCT d FROM vacancy, unnest(ARRAY[added_at, updated_at, removed_at]) AS d
+                      WHERE d IS NOT NULL ORDER BY d""")
+    for (snapshot, ) in cursor.fetchall():
+        update_cell_counts(cursor, snapshot)
+        conn.commit()
+        log(f"Cell counts of {snapshot} updated")
+
+    cursor.close()
+    conn.close()
+
+
+if __name__ == "__main__":
+    if sys.argv[1:] == ["--backfill"]:
+        backfill()
+    else:
+        print(f"Usage: {sys.argv[0]} --backfill", file=sys.stderr)
+        sys.exit(1)
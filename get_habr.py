@@ -1,69 +1,112 @@
 import requests
-import time
 import sys
 import csv
-import traceback
+import gzip
+import codecs
 import os
 import tempfile
 
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 
+from pipeline_metrics import StageMetrics
+from http_client import HttpClient, RateController
+from habr_article import COLUMN_NAMES, extract_article, add_article_to_csv
+
 BASE_URL = "https://m.habr.com"
 POST_URL = BASE_URL + "/ru/post"
 
-BUCKET_SIZE = 100
+# a shard is a gzipped csv, {start_id}.csv.gz
+SHARD_SIZE = 10000
 MAX_ID = 1_000_000
 
 TIMEOUT = 600
 
 PROXIES = None
 
-COLUMN_NAMES = ["id", "text"]
+INITIAL_RATE = 1
+MAX_RATE = 10
 
-session = requests.session()
+# the rate controller limits the rate, the threads only hide the latency
+CONCURRENCY = 8
+CHUNK_SIZE = 64 * 1024
 
 def log(*args, **kwargs):
     timestamp = datetime.strftime(datetime.now(), "%Y-%m-%d %H:%M:%S")
     print(timestamp, *args, **kwargs, file=sys.stderr, flush=True)
 
 
+def iter_text(client, resp):
+    """Decodes the page chunk by chunk as it is downloaded, the bytes are counted on the way"""
+    decoder = codecs.getincrementaldecoder(resp.encoding or "utf8")(errors="replace")
+    for chunk in resp.iter_content(CHUNK_SIZE):
+        client.metrics.add_downloaded_bytes(len(chunk))
+        yield decoder.decode(chunk)
+    yield decoder.decode(b"", final=True)
 
-def add_article_to_csv(article_id, article_text, writer):
-    writer.writerow({
-        'id': article_id,
-        'text': article_text
-    })
-
-
-try:
-    os.mkdir("habr_data")
-except FileExistsError:
-    pass
-
-os.chdir("habr_data")
 
-for start_id in range(0, MAX_ID, BUCKET_SIZE):
-    filename = f"{start_id}.csv"
-    if os.path.exists(filename):
-        log(f"File {filename} exists, continue")
-        continue
+def fetch_article(client, post_id):
+    try:
+        # the page is parsed while it is downloaded, it is never kept whole in memory
+        with client.get(POST_URL + f"/{post_id}/", endpoint="post", stream=True) as resp:
+            if resp.status_code != 200:
+                return None
+            return extract_article(iter_text(client, resp))
+    except requests.RequestException as e:
+        log(f"Failed to get {post_id}: {e}, skipping")
+        return None
+
+
+def dump_shard(client, executor, start_id, writer):
+    post_ids = range(start_id, min(start_id + SHARD_SIZE, MAX_ID))
+    articles = executor.map(lambda post_id: fetch_article(client, post_id), post_ids)
+
+    found = 0
+    for pos, (post_id, article) in enumerate(zip(post_ids, articles)):
+        if pos % 100 == 0:
+            log(f"Dumping post_id={post_id}, articles in shard={found}")
+            client.metrics.flush()
+        if article is None:
+            continue
+
+        add_article_to_csv(post_id, article, writer)
+        client.metrics.add_rows_flattened()
+        found += 1
+    return found
+
+
+def main():
+    session = requests.session()
+    metrics = StageMetrics("get_habr")
+    client = HttpClient(session, RateController(initial_rate=INITIAL_RATE, max_rate=MAX_RATE),
+                        metrics=metrics, proxies=PROXIES, timeout=TIMEOUT, log=log)
+
+    try:
+        os.mkdir("habr_data")
+    except FileExistsError:
+        pass
+
+    os.chdir("habr_data")
+
+    with ThreadPoolExecutor(CONCURRENCY) as executor:
+        for start_id in range(0, MAX_ID, SHARD_SIZE):
+            filename = f"{start_id}.csv.gz"
+            if os.path.exists(filename):
+                log(f"File {filename} exists, continue")
+                continue
 
-    fd, tempname = tempfile.mkstemp(prefix=f"{filename}-unfinished-", dir="")
-    print(tempname)
-    os.chmod(tempname, 0o755)
+            fd, tempname = tempfile.mkstemp(prefix=f"{filename}-unfinished-", dir="")
+            os.chmod(tempname, 0o755)
 
-    with open(fd, 'w', newline='') as csv_file:
-        writer = csv.DictWriter(csv_file, fieldnames=COLUMN_NAMES)
-        writer.writeheader()
+            with open(fd, "wb") as raw_file, gzip.open(raw_file, "wt", newline="", encoding="utf8") as csv_file:
+                writer = csv.DictWriter(csv_file, fieldnames=COLUMN_NAMES)
+                writer.writeheader()
+                found = dump_shard(client, executor, start_id, writer)
 
-        for post_id in range(start_id, start_id+BUCKET_SIZE):
-            log(f"Dumping post_id={post_id}")
-            resp = session.get(POST_URL + f"/{post_id}/", proxies=PROXIES, timeout=TIMEOUT)
-            if resp.status_code != 200:
-                log(f"Failed to get {post_id}, skipping")
-                continue
+            os.rename(tempname, filename)
+            log(f"Shard {filename} saved, articles={found}")
+            metrics.flush(force=True)
 
-            article = resp.text
-            add_article_to_csv(post_id, article, writer)
 
-    os.rename(tempname, filename)
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,138 @@
+"""Extraction of the title, text, tags and date of a habr.com article from the page html
+
+The page goes through a streaming parser that keeps only these parts, the markup, comments and
+sidebars are dropped without building the tree of the page.
+"""
+
+from html.parser import HTMLParser
+
+COLUMN_NAMES = ["id", "title", "published_at", "tags", "text"]
+
+# both the old and the new design of habr
+BODY_IDS = {"post-content-body"}
+BODY_CLASSES = {"post__text", "article-formatted-body"}
+TAG_LINK_CLASSES = {"post__tag", "tm-tags-list__link", "tm-separated-list__item"}
+
+BLOCK_TAGS = {"p", "br", "div", "li", "pre", "blockquote", "h1", "h2", "h3", "h4", "h5", "h6", "tr"}
+SKIP_TAGS = {"script", "style", "noscript"}
+
+
+class ArticleParser(HTMLParser):
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.title = None
+        self.published_at = None
+        self.tags = []
+        self.text = []
+
+        self.meta_title = None
+        self.meta_published_at = None
+        self.meta_keywords = None
+
+        self.in_title = False
+        self.title_parts = []
+        self.in_tag_link = False
+        self.tag_parts = []
+        self.skip_depth = 0
+
+        # the body ends when the element it started with is closed
+        self.body_tag = None
+        self.body_depth = 0
+
+    def handle_starttag(self, tag, attrs):
+        attrs = dict(attrs)
+        classes = set((attrs.get("class") or "").split())
+
+        if tag == "meta":
+            name = attrs.get("property") or attrs.get("name")
+            if name == "og:title":
+                self.meta_title = attrs.get("content")
+            elif name == "article:published_time":
+                self.meta_published_at = attrs.get("content")
+            elif name == "keywords":
+                self.meta_keywords = attrs.get("content")
+            return
+
+        if tag in SKIP_TAGS:
+            self.skip_depth += 1
+            return
+
+        if self.body_tag is None and not self.text and (attrs.get("id") in BODY_IDS or classes & BODY_CLASSES):
+            self.body_tag = tag
+            self.body_depth = 1
+            return
+
+        if self.body_tag is not None:
+            if tag == self.body_tag:
+                self.body_depth += 1
+            if tag in BLOCK_TAGS:
+                self.text.append("\n")
+            return
+
+        if tag == "h1" and self.title is None:
+            self.in_title = True
+        elif tag == "time" and self.published_at is None and attrs.get("datetime"):
+            self.published_at = attrs["datetime"]
+        elif tag == "a" and classes & TAG_LINK_CLASSES:
+            self.in_tag_link = True
+
+    def handle_endtag(self, tag):
+        if tag in SKIP_TAGS:
+            self.skip_depth = max(0, self.skip_depth - 1)
+            return
+
+        if self.body_tag is not None:
+            if tag == self.body_tag:
+                self.body_depth -= 1
+                if self.body_depth == 0:
+                    self.body_tag = None
+            if tag in BLOCK_TAGS:
+                self.text.append("\n")
+            return
+
+        if tag == "h1" and self.in_title:
+            self.in_title = False
+            self.title = " ".join("".join(self.title_parts).split())
+        elif tag == "a" and self.in_tag_link:
+            self.in_tag_link = False
+            tag_name = " ".join("".join(self.tag_parts).split())
+            if tag_name and tag_name not in self.tags:
+                self.tags.append(tag_name)
+            self.tag_parts = []
+
+    def handle_data(self, data):
+        if self.skip_depth:
+            return
+        if self.body_tag is not None:
+            self.text.append(data)
+        elif self.in_title:
+            self.title_parts.append(data)
+        elif self.in_tag_link:
+            self.tag_parts.append(data)
+
+    def get_article(self):
+        lines = (" ".join(line.split()) for line in "".join(self.text).split("\n"))
+        tags = self.tags or [t.strip() for t in (self.meta_keywords or "").split(",") if t.strip()]
+        return {
+            "title": self.title or self.meta_title,
+            "published_at": self.published_at or self.meta_published_at,
+            "tags": "\n".join(tags),
+            "text": "\n".join(line for line in lines if line),
+        }
+
+
+def extract_article(chunks):
+    """chunks is an iterable of str parts of the page, returns None if the page has no article"""
+    parser = ArticleParser()
+    for chunk in chunks:
+        parser.feed(chunk)
+    parser.close()
+
+    article = parser.get_article()
+    if not article["text"]:
+        return None
+    return article
+
+
+def add_article_to_csv(article_id, article, writer):
+    writer.writerow({"id": article_id, **article})
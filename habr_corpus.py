@@ -0,0 +1,241 @@
+#!/usr/bin/env python3
+
+"""Prepares the habr_data articles for language model training
+
+The articles are tokenized in parallel into a vocabulary with counts and a flat array of token ids:
+
+    habr_corpus/tokens.bin   - uint32 token ids of all documents one after another
+    habr_corpus/offsets.npy  - int64, document i is tokens[offsets[i]:offsets[i + 1]]
+    habr_corpus/doc_ids.npy  - int64 habr post ids of the documents
+    habr_corpus/vocab.tsv    - token and count, the line number is the token id
+
+Terms of synonims.txt and blocks.txt like "c++", "asp.net" or "machine_learning" are protected: they
+are single tokens and always are in the vocabulary whatever their counts.
+
+    python3 habr_corpus.py --processes 4
+    corpus = load_corpus("habr_corpus"); corpus.get_document(0)   # memory mapped, nothing is parsed
+"""
+
+import sys
+import os
+import re
+import csv
+import glob
+import gzip
+import json
+import shutil
+import argparse
+import multiprocessing
+
+from collections import Counter
+from datetime import datetime
+
+import numpy as np
+
+from habr_article import extract_article
+from get_habr import SHARD_SIZE
+from skill_extractor import read_blocks, read_synonims
+
+DATA_DIR = "habr_data"
+CORPUS_DIR = "habr_corpus"
+
+UNKNOWN_TOKEN = "<unk>"
+MIN_COUNT = 5
+MAX_VOCAB = 500_000
+TOKEN_DTYPE = np.uint32
+
+# "c++", "c#", ".net", "asp.net", "node.js", "docker-compose" are single tokens
+TOKEN_RE = re.compile(r"(?:(?<!\w)\.)?\w+(?:[.\-]\w+)*[+#]*")
+
+phrases = None
+max_phrase_len = 1
+vocab = None
+
+
+def log(*args, file=sys.stderr, **kwargs):
+    timestamp = datetime.strftime(datetime.now(), "%Y-%m-%d %H:%M:%S")
+    print(timestamp, *args, **kwargs, file=file, flush=True)
+
+
+def get_protected_terms():
+    """Returns {tuple of plain tokens: protected token}"""
+    terms = {}
+    for form in read_synonims(read_blocks()):
+        words = tuple(TOKEN_RE.findall(form.replace("_", " ").lower()))
+        if words:
+            terms[words] = "_".join(words)
+    return terms
+
+
+def tokenize(text, phrases, max_len):
+    words = TOKEN_RE.findall(text.lower())
+
+    # the longest protected phrase starting at the position wins
+    tokens = []
+    pos = 0
+    while pos < len(words):
+        for length in range(min(max_len, len(words) - pos), 1, -1):
+            phrase = phrases.get(tuple(words[pos:pos + length]))
+            if phrase:
+                tokens.append(phrase)
+                pos += length
+                break
+        else:
+            tokens.append(words[pos])
+            pos += 1
+    return tokens
+
+
+def iter_documents(filename):
+    """Yields (post id, text), the old raw html buckets {start_id}.csv are supported too"""
+    csv.field_size_limit(sys.maxsize)
+    if filename.endswith(".gz"):
+        with gzip.open(filename, "rt", newline="", encoding="utf8") as f:
+            for row in csv.DictReader(f):
+                yield int(row["id"]), f"{row['title'] or ''}\n{row['text']}"
+    else:
+        with open(filename, newline="", encoding="utf8") as f:
+            for row in csv.DictReader(f):
+                article = extract_article([row["text"]])
+                if article:
+                    yield int(row["id"]), f"{article['title'] or ''}\n{article['text']}"
+
+
+def init_worker(protected, vocab_tokens=None):
+    global phrases, max_phrase_len, vocab
+    phrases = {words: token for words, token in protected.items() if len(words) > 1}
+    max_phrase_len = max((len(words) for words in phrases), default=1)
+    if vocab_tokens is not None:
+        vocab = {token: token_id for token_id, token in enumerate(vocab_tokens)}
+
+
+def count_file(filename):
+    counts = Counter()
+    for _, text in iter_documents(filename):
+        counts.update(tokenize(text, phrases, max_phrase_len))
+    return counts
+
+
+def encode_file(filename):
+    unknown_id = vocab[UNKNOWN_TOKEN]
+    doc_ids, lengths, tokens = [], [], []
+    for doc_id, text in iter_documents(filename):
+        ids = [vocab.get(token, unknown_id) for token in tokenize(text, phrases, max_phrase_len)]
+        doc_ids.append(doc_id)
+        lengths.append(len(ids))
+        tokens.append(np.array(ids, dtype=TOKEN_DTYPE))
+
+    tokens = np.concatenate(tokens) if tokens else np.array([], dtype=TOKEN_DTYPE)
+    return np.array(doc_ids, dtype=np.int64), np.array(lengths, dtype=np.int64), tokens
+
+
+def build_vocab(counts, protected, min_count=MIN_COUNT, max_vocab=MAX_VOCAB):
+    """Returns a list of tokens, the special and protected ones go first"""
+    tokens = [UNKNOWN_TOKEN] + sorted(set(protected.values()))
+    known = set(tokens)
+    for token, count in counts.most_common():
+        if len(tokens) >= max_vocab or count < min_count:
+            break
+        if token not in known:
+            tokens.append(token)
+    return tokens
+
+
+def get_start_id(filename):
+    return int(os.path.basename(filename).split(".")[0])
+
+
+def get_data_files(data_dir=DATA_DIR):
+    """Returns the shards and the old 100-id buckets sorted by start id,
+    the buckets inside the range of a shard are skipped, the shard has their posts too"""
+    shards = glob.glob(os.path.join(data_dir, "*.csv.gz"))
+    shard_ids = {get_start_id(filename) for filename in shards}
+    buckets = [filename for filename in glob.glob(os.path.join(data_dir, "*.csv"))
+               if get_start_id(filename) // SHARD_SIZE * SHARD_SIZE not in shard_ids]
+    return sorted(shards + buckets, key=get_start_id)
+
+
+def build_corpus(data_dir=DATA_DIR, corpus_dir=CORPUS_DIR, processes=None, min_count=MIN_COUNT):
+    filenames = get_data_files(data_dir)
+    protected = get_protected_terms()
+
+    log(f"Counting tokens in {len(filenames)} files")
+    counts = Counter()
+    with multiprocessing.Pool(processes, initializer=init_worker, initargs=(protected,)) as pool:
+        for file_counts in pool.imap_unordered(count_file, filenames):
+            counts.update(file_counts)
+
+    vocab_tokens = build_vocab(counts, protected, min_count)
+    log(f"Vocabulary of {len(vocab_tokens)} tokens, {len(counts)} distinct tokens seen")
+
+    # the corpus is built aside, the readers see the old one or the new one
+    tmp_dir = corpus_dir + ".unfinished"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+
+    with open(os.path.join(tmp_dir, "vocab.tsv"), "w", encoding="utf8") as f:
+        for token in vocab_tokens:
+            f.write(f"{token}\t{counts.get(token, 0)}\n")
+
+    all_doc_ids, all_lengths = [], []
+    total = 0
+    with open(os.path.join(tmp_dir, "tokens.bin"), "wb") as tokens_file, \
+            multiprocessing.Pool(processes, initializer=init_worker, initargs=(protected, vocab_tokens)) as pool:
+        # imap keeps the order of files, so documents are sorted by post id
+        for doc_ids, lengths, tokens in pool.imap(encode_file, filenames):
+            tokens.tofile(tokens_file)
+            all_doc_ids.append(doc_ids)
+            all_lengths.append(lengths)
+            total += len(tokens)
+
+    lengths = np.concatenate(all_lengths) if all_lengths else np.array([], dtype=np.int64)
+    np.save(os.path.join(tmp_dir, "offsets.npy"), np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64))
+    np.save(os.path.join(tmp_dir, "doc_ids.npy"),
+            np.concatenate(all_doc_ids) if all_doc_ids else np.array([], dtype=np.int64))
+
+    with open(os.path.join(tmp_dir, "meta.json"), "w") as f:
+        json.dump({"documents": len(lengths), "tokens": total, "vocab_size": len(vocab_tokens),
+                   "token_dtype": np.dtype(TOKEN_DTYPE).name, "created_at": datetime.now().isoformat(timespec="seconds")}, f)
+
+    shutil.rmtree(corpus_dir, ignore_errors=True)
+    os.rename(tmp_dir, corpus_dir)
+    log(f"Corpus saved to {corpus_dir}, documents={len(lengths)}, tokens={total}")
+
+
+class Corpus:
+    def __init__(self, corpus_dir=CORPUS_DIR):
+        self.tokens = np.memmap(os.path.join(corpus_dir, "tokens.bin"), dtype=TOKEN_DTYPE, mode="r")
+        self.offsets = np.load(os.path.join(corpus_dir, "offsets.npy"), mmap_mode="r")
+        self.doc_ids = np.load(os.path.join(corpus_dir, "doc_ids.npy"), mmap_mode="r")
+        with open(os.path.join(corpus_dir, "vocab.tsv"), encoding="utf8") as f:
+            self.vocab = [line.split("\t")[0] for line in f]
+        self.token_ids = {token: token_id for token_id, token in enumerate(self.vocab)}
+
+    def __len__(self):
+        return len(self.doc_ids)
+
+    def get_document(self, pos):
+        """Returns a view of the token ids, nothing is copied"""
+        return self.tokens[self.offsets[pos]:self.offsets[pos + 1]]
+
+    def decode(self, token_ids):
+        return [self.vocab[token_id] for token_id in token_ids]
+
+
+def load_corpus(corpus_dir=CORPUS_DIR):
+    return Corpus(corpus_dir)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--data-dir", default=DATA_DIR)
+    parser.add_argument("--corpus-dir", default=CORPUS_DIR)
+    parser.add_argument("--processes", type=int)
+    parser.add_argument("--min-count", type=int, default=MIN_COUNT)
+    args = parser.parse_args()
+
+    build_corpus(args.data_dir, args.corpus_dir, args.processes, args.min_count)
+
+
+if __name__ == "__main__":
+    main()
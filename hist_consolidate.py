@@ -0,0 +1,256 @@
+#!/usr/bin/env python3
+
+"""Compacts the hist_data buckets into a parquet dataset and loads them into postgres
+
+get_hist_vacancies.py writes thousands of small {start_id}.csv buckets. Every PART_BUCKETS consecutive
+buckets are compacted into one part, split by the year of created_at:
+
+    hist_parquet/created_year=2015/part-{part_start_id}.parquet
+    hist_parquet/_index.csv     - start_id, end_id, part_id, rows of every compacted bucket
+
+A part is rewritten when new buckets of its id range appear. The buckets of the index are loaded into
+the hist_vacancy table, the loaded ones are recorded in hist_bucket, so both steps are incremental.
+
+    python3 hist_consolidate.py --once
+    python3 hist_consolidate.py --once --no-postgres
+    dataset = pyarrow.dataset.dataset("hist_parquet", partitioning="hive")
+"""
+
+import sys
+import os
+import io
+import re
+import csv
+import glob
+import time
+import shutil
+import argparse
+import traceback
+
+from datetime import datetime
+
+import pyarrow as pa
+import pyarrow.csv
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+import db
+
+from hh_vacancy import COLUMN_NAMES
+from feeder_postgres import create_vacancy_table, read_csv_batches, get_csv_schema
+
+HIST_DIR = "hist_data"
+PARQUET_DIR = "hist_parquet"
+INDEX_NAME = "_index.csv"
+
+BUCKET_SIZE = 10000
+PART_BUCKETS = 20
+PART_SIZE = BUCKET_SIZE * PART_BUCKETS
+
+# the rows without created_at go to created_year=0
+UNKNOWN_YEAR = 0
+
+RECHECK_EVERY_SEC = 60 * 60
+
+
+def log(*args, file=sys.stderr, **kwargs):
+    timestamp = datetime.strftime(datetime.now(), "%Y-%m-%d %H:%M:%S")
+    print(timestamp, *args, **kwargs, file=file, flush=True)
+
+
+def get_part_id(start_id):
+    return start_id // PART_SIZE * PART_SIZE
+
+
+def get_bucket_files(hist_dir=HIST_DIR):
+    """Returns {start_id: filename} of the finished buckets"""
+    buckets = {}
+    for name in os.listdir(hist_dir):
+        if re.fullmatch(r"\d+\.csv", name, re.ASCII):
+            buckets[int(name.split(".")[0])] = os.path.join(hist_dir, name)
+    return buckets
+
+
+def read_index(parquet_dir=PARQUET_DIR):
+    """Returns {start_id: index row}"""
+    try:
+        with open(os.path.join(parquet_dir, INDEX_NAME), newline="") as f:
+            return {int(row["start_id"]): {k: int(v) for k, v in row.items()} for row in csv.DictReader(f)}
+    except FileNotFoundError:
+        return {}
+
+
+def write_index(index, parquet_dir=PARQUET_DIR):
+    filename = os.path.join(parquet_dir, INDEX_NAME)
+    with open(filename + ".unfinished", "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=["start_id", "end_id", "part_id", "rows"])
+        writer.writeheader()
+        for start_id in sorted(index):
+            writer.writerow(index[start_id])
+    os.replace(filename + ".unfinished", filename)
+
+
+def get_part_files(part_id, parquet_dir=PARQUET_DIR):
+    return sorted(glob.glob(os.path.join(parquet_dir, "created_year=*", f"part-{part_id}.parquet")))
+
+
+def read_part(part_id, parquet_dir=PARQUET_DIR, id_ranges=None):
+    """Returns the table of the part, only the rows of the (start_id, end_id) ranges if they are given"""
+    schema = get_csv_schema()
+    tables = [pq.read_table(filename, schema=schema) for filename in get_part_files(part_id, parquet_dir)]
+    table = pa.concat_tables(tables) if tables else schema.empty_table()
+
+    if id_ranges is not None:
+        mask = pa.array([False] * len(table), type=pa.bool_())
+        for start_id, end_id in id_ranges:
+            in_range = pc.and_(pc.greater_equal(table["id"], start_id), pc.less(table["id"], end_id))
+            mask = pc.or_(mask, in_range)
+        table = table.filter(mask)
+    return table
+
+
+def read_bucket(filename):
+    return pa.Table.from_batches(list(read_csv_batches(filename)), schema=get_csv_schema())
+
+
+def write_part(part_id, table, parquet_dir=PARQUET_DIR):
+    """Replaces the files of the part with the table split by year"""
+    years = pc.fill_null(pc.year(table["created_at"]), UNKNOWN_YEAR)
+
+    # the new files are written aside, then the old ones are replaced
+    tmp_dir = os.path.join(parquet_dir, f"part-{part_id}.unfinished")
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+
+    new_files = {}
+    for year in pc.unique(years).to_pylist():
+        tmp_filename = os.path.join(tmp_dir, f"{year}.parquet")
+        pq.write_table(table.filter(pc.equal(years, year)).sort_by("id"), tmp_filename)
+        new_files[os.path.join(parquet_dir, f"created_year={year}", f"part-{part_id}.parquet")] = tmp_filename
+
+    for filename in get_part_files(part_id, parquet_dir):
+        if filename not in new_files:
+            os.remove(filename)
+    for filename, tmp_filename in new_files.items():
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        os.replace(tmp_filename, filename)
+    shutil.rmtree(tmp_dir)
+
+
+def consolidate(hist_dir=HIST_DIR, parquet_dir=PARQUET_DIR):
+    """Compacts the buckets missing in the index, returns the number of new buckets"""
+    os.makedirs(parquet_dir, exist_ok=True)
+    index = read_index(parquet_dir)
+
+    new_buckets = {}
+    for start_id, filename in get_bucket_files(hist_dir).items():
+        if start_id not in index:
+            new_buckets.setdefault(get_part_id(start_id), []).append((start_id, filename))
+
+    for part_id, buckets in sorted(new_buckets.items()):
+        # the rows of the buckets missing in the index are dropped, they could be written before a failure
+        indexed = [(b["start_id"], b["end_id"]) for b in index.values() if b["part_id"] == part_id]
+        tables = [read_part(part_id, parquet_dir, indexed)]
+        for start_id, filename in sorted(buckets):
+            table = read_bucket(filename)
+            index[start_id] = {"start_id": start_id, "end_id": start_id + BUCKET_SIZE,
+                               "part_id": part_id, "rows": len(table)}
+            tables.append(table)
+
+        table = pa.concat_tables(tables)
+        write_part(part_id, table, parquet_dir)
+        write_index(index, parquet_dir)
+        log(f"Part {part_id}: {len(buckets)} new buckets, {len(table)} rows")
+
+    return sum(len(buckets) for buckets in new_buckets.values())
+
+
+def create_hist_tables(cursor):
+    create_vacancy_table(cursor)
+
+    # the columns of the snapshots, the snapshot dates stay empty
+    cursor.execute("CREATE TABLE IF NOT EXISTS hist_vacancy (LIKE vacancy, PRIMARY KEY (id))")
+    cursor.execute("CREATE INDEX IF NOT EXISTS hist_vacancy_created_at_idx ON hist_vacancy (created_at)")
+
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS hist_bucket (
+            start_id BIGINT PRIMARY KEY,
+            end_id BIGINT NOT NULL,
+            rows INT NOT NULL,
+            loaded_at TIMESTAMP NOT NULL
+        )
+    """)
+
+
+def copy_table(cursor, table):
+    buffer = io.BytesIO()
+    pyarrow.csv.write_csv(table, buffer)
+    buffer.seek(0)
+    cursor.copy_expert(f"COPY hist_vacancy ({', '.join(table.column_names)}) FROM STDIN WITH (FORMAT csv, HEADER true)",
+                       buffer)
+
+
+def load_postgres(conn, parquet_dir=PARQUET_DIR):
+    """Loads the compacted buckets that are not loaded yet, a part is one transaction"""
+    db.ensure_created(conn, "hist_vacancy", create_hist_tables)
+
+    with conn.cursor() as cursor:
+        cursor.execute("SELECT start_id FROM hist_bucket")
+        loaded = {row[0] for row in cursor.fetchall()}
+
+    to_load = {}
+    for start_id, bucket in read_index(parquet_dir).items():
+        if start_id not in loaded:
+            to_load.setdefault(bucket["part_id"], []).append(bucket)
+
+    for part_id, buckets in sorted(to_load.items()):
+        id_ranges = [(bucket["start_id"], bucket["end_id"]) for bucket in buckets]
+        table = read_part(part_id, parquet_dir, id_ranges).select(COLUMN_NAMES)
+
+        with conn.cursor() as cursor:
+            # the rows of a bucket loaded before the failure are replaced
+            for start_id, end_id in id_ranges:
+                cursor.execute("DELETE FROM hist_vacancy WHERE id >= %s AND id < %s", (start_id, end_id))
+            copy_table(cursor, table)
+            db.execute_values(
+                cursor, "INSERT INTO hist_bucket (start_id, end_id, rows, loaded_at) VALUES %s",
+                [(bucket["start_id"], bucket["end_id"], bucket["rows"], datetime.now()) for bucket in buckets])
+        conn.commit()
+        log(f"Part {part_id}: {len(buckets)} buckets loaded into postgres, {len(table)} rows")
+
+
+def run_once(to_postgres=True):
+    new_buckets = consolidate()
+    log(f"Consolidated {new_buckets} new buckets")
+
+    if to_postgres:
+        conn = db.connect()
+        load_postgres(conn)
+        conn.close()
+
+
+def loop(to_postgres=True):
+    log(f"Starting the hist consolidation loop")
+
+    while True:
+        try:
+            run_once(to_postgres)
+        except Exception:
+            log(traceback.format_exc())
+        time.sleep(RECHECK_EVERY_SEC)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--once", action="store_true")
+    parser.add_argument("--no-postgres", action="store_true")
+    args = parser.parse_args()
+
+    if args.once:
+        run_once(not args.no_postgres)
+    else:
+        loop(not args.no_postgres)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,148 @@
+"""HTTP client shared by the crawlers: retries, jittered exponential backoff and AIMD rate control
+
+The request rate grows additively while responses are healthy and is cut multiplicatively on
+throttling (429, 503), so the crawler stays just under the limit of the API.
+Errors that are not worth retrying (like 404) are returned to the caller as is.
+"""
+
+import time
+import random
+import threading
+
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+
+import requests
+
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+THROTTLE_STATUSES = {429, 503}
+
+
+class RateController:
+    """Thread-safe AIMD limiter of requests per second"""
+
+    def __init__(self, initial_rate=1.0, min_rate=0.1, max_rate=10.0, increase_step=0.05, decrease_factor=0.5):
+        self.rate = initial_rate
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.increase_step = increase_step
+        self.decrease_factor = decrease_factor
+
+        self.next_time = 0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        with self.lock:
+            now = time.monotonic()
+            wait_time = max(0, self.next_time - now)
+            self.next_time = max(now, self.next_time) + 1 / self.rate
+        time.sleep(wait_time)
+
+    def on_success(self):
+        with self.lock:
+            self.rate = min(self.max_rate, self.rate + self.increase_step)
+
+    def on_throttle(self):
+        with self.lock:
+            self.rate = max(self.min_rate, self.rate * self.decrease_factor)
+
+    def pause(self, seconds):
+        """Nobody sends requests for the given time, used for Retry-After"""
+        with self.lock:
+            self.next_time = max(self.next_time, time.monotonic() + seconds)
+
+
+def parse_retry_after(value):
+    if not value:
+        return None
+    try:
+        return max(0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0, (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+
+class HttpClient:
+    def __init__(self, session=None, rate_controller=None, metrics=None, proxies=None, timeout=60,
+                 max_retries=8, backoff_base=1.0, backoff_max=300.0, log=None):
+        self.session = session or requests.session()
+        self.rate_controller = rate_controller or RateController()
+        self.metrics = metrics
+        self.proxies = proxies
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.log = log or (lambda *args: None)
+
+        # for profiling: time spent in requests and in waiting for the rate limit and backoffs
+        self.network_secs = 0.0
+        self.wait_secs = 0.0
+
+    def get_backoff(self, attempt):
+        # "full jitter": concurrent clients do not retry in sync
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+    def sleep(self, seconds):
+        self.wait_secs += seconds
+        time.sleep(seconds)
+
+    def get(self, url, endpoint="", **kwargs):
+        """Returns the last response if retries are exhausted, raises if there was no response at all
+
+        With stream=True the body is not read here, the caller counts its bytes with metrics.add_downloaded_bytes.
+        """
+        kwargs.setdefault("proxies", self.proxies)
+        kwargs.setdefault("timeout", self.timeout)
+
+        for attempt in range(self.max_retries + 1):
+            last_attempt = (attempt == self.max_retries)
+
+            wait_start = time.monotonic()
+            self.rate_controller.acquire()
+            start = time.monotonic()
+            self.wait_secs += start - wait_start
+            try:
+                resp = self.session.get(url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                self.network_secs += time.monotonic() - start
+                if self.metrics:
+                    self.metrics.observe_request(endpoint, "error", time.monotonic() - start)
+                if last_attempt:
+                    raise
+
+                backoff = self.get_backoff(attempt)
+                self.log(f"Error {e} on {url}, retrying in {backoff:.1f} secs")
+                self.sleep(backoff)
+                continue
+
+            self.network_secs += time.monotonic() - start
+            if self.metrics:
+                size = 0 if kwargs.get("stream") else len(resp.content)
+                self.metrics.observe_request(endpoint, resp.status_code, time.monotonic() - start, size)
+
+            if resp.status_code not in RETRY_STATUSES:
+                self.rate_controller.on_success()
+                return resp
+
+            if resp.status_code in THROTTLE_STATUSES:
+                self.rate_controller.on_throttle()
+
+            if last_attempt:
+                return resp
+            # a streamed body is not needed, the connection goes back to the session
+            resp.close()
+
+            retry_after = parse_retry_after(resp.headers.get("Retry-After"))
+            if retry_after is not None:
+                backoff = min(retry_after, self.backoff_max)
+                self.rate_controller.pause(backoff)
+            else:
+                backoff = self.get_backoff(attempt)
+
+            self.log(f"Status {resp.status_code} on {url}, rate {self.rate_controller.rate:.2f}/s, "
+                     f"retrying in {backoff:.1f} secs")
+            self.sleep(backoff)
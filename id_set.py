@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+
+"""Compact set of vacancy ids, one bit per id
+
+40 million ids take 5 MB instead of hundreds of MB of python ints in a set. The sets are saved as
+compressed npz, so the ids of different runs can be compared:
+
+    python3 id_set.py data/2021-03-01/vacancy_ids.npz data/2021-03-08/vacancy_ids.npz
+"""
+
+import os
+import argparse
+
+import numpy as np
+
+GROW_BYTES = 1024 * 1024
+
+POPCOUNT = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+
+class IdSet:
+    def __init__(self, bits=None):
+        self.bits = np.zeros(0, dtype=np.uint8) if bits is None else bits
+
+    def grow(self, max_id):
+        size = max_id // 8 + 1
+        if size > len(self.bits):
+            # grows by big steps, the ids come mostly in the increasing order
+            self.bits = np.concatenate([self.bits, np.zeros(size - len(self.bits) + GROW_BYTES, dtype=np.uint8)])
+
+    def add(self, item_id):
+        item_id = int(item_id)
+        if item_id < 0:
+            raise Exception(f"Negative id {item_id}")
+        self.grow(item_id)
+        self.bits[item_id >> 3] |= 1 << (item_id & 7)
+
+    def add_many(self, ids):
+        ids = np.asarray(ids, dtype=np.int64)
+        if not len(ids):
+            return
+        if ids.min() < 0:
+            raise Exception(f"Negative id {ids.min()}")
+        self.grow(int(ids.max()))
+        np.bitwise_or.at(self.bits, ids >> 3, (1 << (ids & 7)).astype(np.uint8))
+
+    def __contains__(self, item_id):
+        item_id = int(item_id)
+        if item_id < 0 or item_id >> 3 >= len(self.bits):
+            return False
+        return bool(self.bits[item_id >> 3] >> (item_id & 7) & 1)
+
+    def contains_many(self, ids):
+        """Returns a bool array, True for the ids in the set"""
+        ids = np.asarray(ids, dtype=np.int64)
+        found = (ids >= 0) & (ids >> 3 < len(self.bits))
+        valid = ids[found]
+        found[found] = ((self.bits[valid >> 3] >> (valid & 7)) & 1) == 1
+        return found
+
+    def __len__(self):
+        return int(POPCOUNT[self.bits].sum(dtype=np.int64))
+
+    def to_array(self):
+        """Returns the sorted ids"""
+        return np.flatnonzero(np.unpackbits(self.bits, bitorder="little"))
+
+    def get_aligned(self, other):
+        size = max(len(self.bits), len(other.bits))
+        return (np.pad(self.bits, (0, size - len(self.bits))),
+                np.pad(other.bits, (0, size - len(other.bits))))
+
+    def __or__(self, other):
+        a, b = self.get_aligned(other)
+        return IdSet(a | b)
+
+    def __and__(self, other):
+        a, b = self.get_aligned(other)
+        return IdSet(a & b)
+
+    def __sub__(self, other):
+        a, b = self.get_aligned(other)
+        return IdSet(a & ~b)
+
+    def save(self, filename):
+        with open(filename + ".unfinished", "wb") as f:
+            np.savez_compressed(f, bits=np.trim_zeros(self.bits, "b"))
+        os.replace(filename + ".unfinished", filename)
+
+
+def load_id_set(filename):
+    with np.load(filename) as f:
+        return IdSet(f["bits"].copy())
+
+
+def load_or_create_id_set(filename):
+    if os.path.exists(filename):
+        return load_id_set(filename)
+    return IdSet()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("old")
+    parser.add_argument("new")
+    parser.add_argument("--show", type=int, default=10, help="ids of each kind to print")
+    args = parser.parse_args()
+
+    old, new = load_id_set(args.old), load_id_set(args.new)
+    for name, ids in (("removed", old - new), ("added", new - old), ("kept", old & new)):
+        sample = " ".join(str(i) for i in ids.to_array()[:args.show])
+        print(f"{name}={len(ids)} {sample}")
+
+
+if __name__ == "__main__":
+    main()
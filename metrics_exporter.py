@@ -4,91 +4,98 @@ import time
 import traceback
 import re
 import socket
+import threading
 
+from concurrent.futures import ThreadPoolExecutor
 from datetime import date, datetime
 
 import hdfs
-import psycopg2
-import psycopg2.extras
 
 from hdfs import InsecureClient
 from prometheus_client import start_http_server
 from prometheus_client.core import GaugeMetricFamily, CounterMetricFamily, REGISTRY
 
-HOST = os.environ.get("POSTGRES_HOST", "db")
-USER = os.environ.get("POSTGRES_USER", "vacancy")
-PASSWORD = os.environ.get("POSTGRES_PASSWORD", "psql")
-DB = os.environ.get("POSTGRES_DB", "vacancy")
+import db
+
+from parquet_manifest import read_manifest, get_manifest_watermark
+from pipeline_metrics import read_stage_metrics
+
+HDFS_URL = os.environ.get("HDFS_URL", "http://namenode:9870")
 
 PARQUET_FILE = "/vacancy.parquet"
 
+DATA_DIR = "data/"
+
 DEFAULT_DATE = date(year=1970, month=1, day=1)
 
+REFRESH_EVERY_SEC = 30
+
+SERVICES = [
+    ("datanode", "datanode", 9864),
+    ("historyserver", "historyserver", 8188),
+    ("namenode", "namenode", 9000),
+    ("nodemanager", "nodemanager", 8042),
+    ("resourcemanager", "resourcemanager", 8088),
+    ("apache", "apache", 443),
+    ("db", "db", 5432),
+    ("jupyter", "jupyter", 8888),
+]
+
 def log(*args, file=sys.stderr, **kwargs):
     timestamp = datetime.strftime(datetime.now(), "%Y-%m-%d %H:%M:%S")
     print(timestamp, *args, **kwargs, file=file, flush=True)
 
 def get_file_names():
     DATE_RE = r"\d\d\d\d-\d\d-\d\d"
-    DATA_DIR = "data/"
 
     return sorted(d for d in os.listdir(DATA_DIR) if re.fullmatch(DATE_RE, d, re.ASCII))
-    
 
-def get_file_dates():
-    dirs = get_file_names()
-    dates = [datetime.strptime(d, "%Y-%m-%d").date() for d in dirs]
 
-    return dates
-    
-
-def get_file_max_date():
-    dates = get_file_dates()
-    if not dates:
-        return DEFAULT_DATE
-
-    return max(dates)
+def get_file_dates(dirs):
+    return [datetime.strptime(d, "%Y-%m-%d").date() for d in dirs]
 
 
-def get_last_csv_size():
-    DATA_DIR = "data/"
+def get_last_csv_size(dirs):
     FILENAME = "result.csv"
     try:
-        dirs = get_file_names()
         if not dirs:
             return 0
         last_dir = max(dirs)
-        
+
         return os.path.getsize(os.path.join(DATA_DIR, last_dir, FILENAME))
     except Exception as e:
         log(e)
         return 0
 
 
+db_pool = db.Pool(maxconn=2)
+
 def get_db_max_date():
     try:
-        conn = psycopg2.connect(dbname=DB, user=USER, password=PASSWORD, host=HOST)
-        with conn.cursor(cursor_factory=psycopg2.extras.DictCursor) as cursor:
-            cursor.execute("select max(added_at),max(updated_at),max(removed_at) from vacancy;")
-            row = cursor.fetchone()
-            if not row:
-                return DEFAULT_DATE
-        conn.close()
-        dates = [d for d in row if d]
-        if not dates:
-            return DEFAULT_DATE
-        return max(dates)
+        row = db_pool.query("select max(added_at),max(updated_at),max(removed_at) from vacancy;")[0]
     except Exception as e:
         log(f"Exception {e} on get_db_max_date")
         return DEFAULT_DATE
 
+    if not row:
+        return DEFAULT_DATE
+    dates = [d for d in row if d]
+    if not dates:
+        return DEFAULT_DATE
+    return max(dates)
+
 
-def get_hdfs_max_date():
-    SUCCESS_FILE = f"{PARQUET_FILE}/_SUCCESS"
+hdfs_client = InsecureClient(HDFS_URL, user='metrics', timeout=10)
 
+def get_hdfs_max_date():
     try:
-        client = InsecureClient('http://namenode:9870', user='metrics')
-        time_ts = client.status(SUCCESS_FILE)["modificationTime"] / 1000
+        watermark = get_manifest_watermark(read_manifest(hdfs_client, PARQUET_FILE))
+        if watermark:
+            return watermark
+
+        # exports made before manifests were introduced have only _SUCCESS file
+        SUCCESS_FILE = f"{PARQUET_FILE}/_SUCCESS"
+        time_ts = hdfs_client.status(SUCCESS_FILE)["modificationTime"] / 1000
         return date.fromtimestamp(time_ts)
     except Exception:
         log("Exception while trying to get parquet max date")
@@ -103,62 +110,114 @@ def get_now_date():
 def check_tcp_connection(host, port):
     TIMEOUT = 0.1
     try:
-        socket.create_connection((host, port), timeout=TIMEOUT)
-        return True
+        with socket.create_connection((host, port), timeout=TIMEOUT):
+            return True
     except Exception as e:
         log(e)
         return False
-        
+
+
+def collect_snapshot(executor):
+    """Does all slow probes concurrently, it is called only by the refresher thread"""
+    services_up = {name: executor.submit(check_tcp_connection, host, port) for name, host, port in SERVICES}
+    db_date = executor.submit(get_db_max_date)
+    hdfs_date = executor.submit(get_hdfs_max_date)
+
+    try:
+        file_names = get_file_names()
+    except Exception as e:
+        log(e)
+        file_names = []
+
+    file_dates = get_file_dates(file_names)
+
+    try:
+        stage_metrics = read_stage_metrics()
+    except Exception:
+        log(traceback.format_exc())
+        stage_metrics = []
+
+    return {
+        "file_date": max(file_dates) if file_dates else DEFAULT_DATE,
+        "file_dates_count": len(file_dates),
+        "last_csv_size": get_last_csv_size(file_names),
+        "db_date": db_date.result(),
+        "hdfs_date": hdfs_date.result(),
+        "services_up": {name: future.result() for name, future in services_up.items()},
+        "stage_metrics": stage_metrics,
+        "refreshed_at": time.time(),
+    }
+
+
+class Refresher(threading.Thread):
+    def __init__(self):
+        super().__init__(daemon=True)
+        self.executor = ThreadPoolExecutor(max_workers=len(SERVICES) + 2)
+        self.snapshot = None
+
+    def refresh(self):
+        # the dict is replaced as a whole, so scrapes never see a partially updated one
+        self.snapshot = collect_snapshot(self.executor)
+
+    def run(self):
+        while True:
+            try:
+                self.refresh()
+            except Exception:
+                log(traceback.format_exc())
+            time.sleep(REFRESH_EVERY_SEC)
+
 
 class CustomCollector(object):
+    def __init__(self, refresher):
+        self.refresher = refresher
+
     def collect(self):
+        snapshot = self.refresher.snapshot
+        if snapshot is None:
+            return
+
+        yield GaugeMetricFamily("vacancy_metrics_staleness_seconds", "Seconds since the metrics were refreshed",
+                                value=time.time() - snapshot["refreshed_at"])
+
         c = GaugeMetricFamily("vacancy_lastdata", "Last vacancy data update in days from now", labels=["source"])
 
-        file_date = get_file_max_date()
-        db_date = get_db_max_date()
-        hdfs_date = get_hdfs_max_date()
         now_date = get_now_date()
 
-        if file_date != DEFAULT_DATE:
-            c.add_metric(["file"], (now_date - file_date).days)
-        if db_date != DEFAULT_DATE:
-            c.add_metric(["db"], (now_date - db_date).days)
-        if hdfs_date != DEFAULT_DATE:
-            c.add_metric(["hdfs"], (now_date - hdfs_date).days)
+        if snapshot["file_date"] != DEFAULT_DATE:
+            c.add_metric(["file"], (now_date - snapshot["file_date"]).days)
+        if snapshot["db_date"] != DEFAULT_DATE:
+            c.add_metric(["db"], (now_date - snapshot["db_date"]).days)
+        if snapshot["hdfs_date"] != DEFAULT_DATE:
+            c.add_metric(["hdfs"], (now_date - snapshot["hdfs_date"]).days)
 
         yield c
 
         c2 = GaugeMetricFamily("vacancy_services_up", "Service is up", labels=["service"])
 
-        c2.add_metric(["datanode"], check_tcp_connection("datanode", 9864))
-        c2.add_metric(["historyserver"], check_tcp_connection("historyserver", 8188))
-        c2.add_metric(["namenode"], check_tcp_connection("namenode", 9000))
-        c2.add_metric(["nodemanager"], check_tcp_connection("nodemanager", 8042))
-        c2.add_metric(["resourcemanager"], check_tcp_connection("resourcemanager", 8088))
-        c2.add_metric(["apache"], check_tcp_connection("apache", 443))
-        c2.add_metric(["db"], check_tcp_connection("db", 5432))
-        c2.add_metric(["jupyter"], check_tcp_connection("jupyter", 8888))
+        for name, is_up in snapshot["services_up"].items():
+            c2.add_metric([name], is_up)
 
         yield c2
 
         c3 = CounterMetricFamily("vacancy_days_downloaded", "Number of days downloaded", labels=["service"])
-        
-        file_dates = get_file_dates()
-        if file_dates:
-            c3.add_metric(["file"], len(file_dates))
+
+        if snapshot["file_dates_count"]:
+            c3.add_metric(["file"], snapshot["file_dates_count"])
             yield c3
-        
-        yield GaugeMetricFamily("vacancy_last_csv_size", "The size of last CSV", value=get_last_csv_size())
 
+        yield GaugeMetricFamily("vacancy_last_csv_size", "The size of last CSV", value=snapshot["last_csv_size"])
+
+        # per-stage metrics dumped by the crawlers and the feeders
+        yield from snapshot["stage_metrics"]
 
-REGISTRY.register(CustomCollector())
-start_http_server(9144)
 
+refresher = Refresher()
+refresher.start()
+
+REGISTRY.register(CustomCollector(refresher))
+start_http_server(9144)
 
-#print(f"{get_file_max_date()=}")
-#print(f"{get_db_max_date()=}")
-#print(f"{get_hdfs_max_date()=}")
-#print(f"{get_now_date()=}")
 
 while True:
     time.sleep(60)
@@ -0,0 +1,59 @@
+import json
+import posixpath
+
+from datetime import datetime, date
+
+from hdfs.util import HdfsError
+
+MANIFEST_NAME = "_manifest.json"
+MANIFEST_VERSION = 1
+
+
+def get_manifest_path(parquet_path):
+    return posixpath.join(parquet_path, MANIFEST_NAME)
+
+
+def read_manifest(client, parquet_path):
+    """Returns the export manifest or None if there is no one (e.g. no export was made yet)"""
+    try:
+        with client.read(get_manifest_path(parquet_path), encoding="utf8") as reader:
+            return json.load(reader)
+    except HdfsError:
+        return None
+
+
+def get_manifest_watermark(manifest):
+    if not manifest or not manifest.get("watermark"):
+        return None
+    return date.fromisoformat(manifest["watermark"])
+
+
+def build_manifest(client, parquet_path, watermark: date, rows: int):
+    files = []
+    for name, status in sorted(client.list(parquet_path, status=True)):
+        # spark service files like _SUCCESS and .crc are not data
+        if name.startswith("_") or name.startswith(".") or status["type"] != "FILE":
+            continue
+
+        file_path = posixpath.join(parquet_path, name)
+        checksum = client.checksum(file_path)
+
+        files.append({
+            "name": name,
+            "size": status["length"],
+            "checksum_algorithm": checksum["algorithm"],
+            "checksum": checksum["bytes"],
+        })
+
+    return {
+        "version": MANIFEST_VERSION,
+        "watermark": watermark.isoformat(),
+        "rows": rows,
+        "files": files,
+        "created_at": datetime.now().isoformat(timespec="seconds"),
+    }
+
+
+def write_manifest(client, parquet_path, manifest):
+    client.write(get_manifest_path(parquet_path), data=json.dumps(manifest, indent=1),
+                 encoding="utf8", overwrite=True)
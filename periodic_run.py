@@ -9,6 +9,8 @@ import time
 import traceback
 import tempfile
 
+from profiling import PROFILE_ENV
+
 DAYS_BETWEEN_DOWNLOADS = 7
 RECHECK_EVERY_SEC = 60
 
@@ -39,7 +41,7 @@ def get_time_to_wait():
     return 0
 
 
-def run_once():
+def run_once(timeout=MAX_RUN_SECS):
     dir_prefix = datetime.datetime.strftime(datetime.datetime.now(), "%Y-%m-%d")
 
     tempdir = tempfile.mkdtemp(prefix=f"{dir_prefix}-unfinished-", dir="")
@@ -51,7 +53,8 @@ def run_once():
     log(f"Capturing stdout and stderr to {log_file_pretty}")
 
     with open(log_file, "wb") as f:
-        process = subprocess.run(RUN_CMD, timeout=MAX_RUN_SECS, cwd=tempdir,
+        # VACANCY_PROFILE is passed through the environment
+        process = subprocess.run(RUN_CMD, timeout=timeout, cwd=tempdir,
                                  stdout=f, stderr=subprocess.STDOUT)
 
         success = (process.returncode == 0)
@@ -62,6 +65,8 @@ def run_once():
         else:
             log(f"Bad return code: {process.returncode}, see log in {log_file_pretty}")
 
+        return success
+
 
 def loop():
     log(f"Starting the main loop")
@@ -82,5 +87,7 @@ def loop():
 
 
 if __name__ == "__main__":
+    if "--profile" in sys.argv[1:]:
+        os.environ[PROFILE_ENV] = "1"
     os.chdir(DATA_DIR)
     loop()
@@ -0,0 +1,59 @@
+"""Completion markers used to trigger pipeline stages living in other containers
+
+A marker is a small json file in PIPELINE_DIR, it is written atomically, so a reader never sees
+a partial one. Waiting is a stat() of one file per TRIGGER_POLL_SEC, it costs nothing compared
+to the polling of db and hdfs.
+"""
+
+import os
+import json
+import time
+import tempfile
+
+PIPELINE_DIR = os.environ.get("PIPELINE_DIR",
+                              os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "pipeline"))
+
+TRIGGER_POLL_SEC = 1
+
+
+def get_marker_path(name, pipeline_dir=PIPELINE_DIR):
+    return os.path.join(pipeline_dir, f"{name}.json")
+
+
+def write_marker(name, payload, pipeline_dir=PIPELINE_DIR):
+    os.makedirs(pipeline_dir, exist_ok=True)
+
+    fd, tempname = tempfile.mkstemp(prefix=f"{name}-unfinished-", dir=pipeline_dir)
+    with open(fd, "w", encoding="utf8") as f:
+        json.dump(payload, f)
+    os.chmod(tempname, 0o666)
+    os.replace(tempname, get_marker_path(name, pipeline_dir))
+
+
+def read_marker(name, pipeline_dir=PIPELINE_DIR):
+    try:
+        with open(get_marker_path(name, pipeline_dir), encoding="utf8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def remove_marker(name, pipeline_dir=PIPELINE_DIR):
+    try:
+        os.remove(get_marker_path(name, pipeline_dir))
+    except FileNotFoundError:
+        pass
+
+
+def wait_for_marker(name, timeout=None, check=None, pipeline_dir=PIPELINE_DIR):
+    """Waits until the marker appears and check(payload) is true, returns the payload or None on timeout"""
+    deadline = time.monotonic() + timeout if timeout is not None else None
+
+    while True:
+        payload = read_marker(name, pipeline_dir)
+        if payload is not None and (check is None or check(payload)):
+            return payload
+
+        if deadline is not None and time.monotonic() > deadline:
+            return None
+        time.sleep(TRIGGER_POLL_SEC)
@@ -0,0 +1,91 @@
+"""Per-stage pipeline instrumentation
+
+Every stage (crawlers and feeders) keeps its own registry and periodically dumps it in the Prometheus
+text format to METRICS_DIR/{stage}.prom, metrics_exporter.py serves all these files on its endpoint.
+Only counters and histograms are recorded, requests/s and rows/s are rate() over them.
+"""
+
+import os
+import time
+
+from prometheus_client import CollectorRegistry, Counter, Histogram, write_to_textfile
+from prometheus_client.parser import text_string_to_metric_families
+
+METRICS_DIR = os.environ.get("PIPELINE_METRICS_DIR",
+                             os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "metrics"))
+METRICS_EXT = ".prom"
+
+FLUSH_EVERY_SEC = 15
+
+REQUEST_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 600)
+DURATION_BUCKETS = (1, 10, 60, 300, 900, 1800, 3600, 3 * 3600, 6 * 3600, 12 * 3600, 24 * 3600)
+
+
+class StageMetrics:
+    def __init__(self, stage, metrics_dir=METRICS_DIR):
+        self.stage = stage
+        self.path = os.path.join(metrics_dir, f"{stage}{METRICS_EXT}")
+        self.last_flush = 0
+
+        self.registry = CollectorRegistry()
+
+        self.request_seconds = Histogram("vacancy_pipeline_request_seconds", "HTTP request latency",
+                                         ["stage", "endpoint"], registry=self.registry, buckets=REQUEST_BUCKETS)
+        self.responses = Counter("vacancy_pipeline_responses", "HTTP responses by status",
+                                 ["stage", "endpoint", "status"], registry=self.registry)
+        self.downloaded_bytes = Counter("vacancy_pipeline_downloaded_bytes", "Bytes downloaded",
+                                        ["stage"], registry=self.registry)
+        self.rows_flattened = Counter("vacancy_pipeline_rows_flattened", "Rows written to csv",
+                                      ["stage"], registry=self.registry)
+        self.rows_upserted = Counter("vacancy_pipeline_rows_upserted", "Rows changed in db",
+                                     ["stage", "action"], registry=self.registry)
+        self.step_seconds = Histogram("vacancy_pipeline_step_seconds", "Duration of pipeline steps like an export",
+                                      ["stage", "step"], registry=self.registry, buckets=DURATION_BUCKETS)
+
+    def observe_request(self, endpoint, status, seconds, size=0):
+        self.request_seconds.labels(self.stage, endpoint).observe(seconds)
+        self.responses.labels(self.stage, endpoint, str(status)).inc()
+        self.downloaded_bytes.labels(self.stage).inc(size)
+
+    def add_downloaded_bytes(self, size):
+        self.downloaded_bytes.labels(self.stage).inc(size)
+
+    def add_rows_flattened(self, count=1):
+        self.rows_flattened.labels(self.stage).inc(count)
+
+    def add_rows_upserted(self, action, count=1):
+        self.rows_upserted.labels(self.stage, action).inc(count)
+
+    def observe_step(self, step, seconds):
+        self.step_seconds.labels(self.stage, step).observe(seconds)
+
+    def flush(self, force=False):
+        if not force and time.monotonic() - self.last_flush < FLUSH_EVERY_SEC:
+            return
+        self.last_flush = time.monotonic()
+
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        write_to_textfile(self.path, self.registry)
+
+
+def read_stage_metrics(metrics_dir=METRICS_DIR):
+    """Reads metric families of all stages, families with the same name are merged"""
+    families = {}
+
+    if not os.path.isdir(metrics_dir):
+        return []
+
+    for name in sorted(os.listdir(metrics_dir)):
+        if not name.endswith(METRICS_EXT):
+            continue
+
+        with open(os.path.join(metrics_dir, name), encoding="utf8") as f:
+            text = f.read()
+
+        for family in text_string_to_metric_families(text):
+            if family.name in families:
+                families[family.name].samples.extend(family.samples)
+            else:
+                families[family.name] = family
+
+    return list(families.values())
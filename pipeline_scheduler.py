@@ -0,0 +1,194 @@
+#!/usr/bin/env python3
+
+"""Runs the pipeline crawl -> postgres feed -> dedup -> stats -> parquet export as dependent stages
+
+A stage starts right after the previous one has finished, the parquet export lives in the spark
+container and is triggered with a marker (see pipeline_markers.py and feeder_hadoop.py --worker).
+Every attempt of every stage is recorded in the pipeline_run table. The timeout of a stage is for all
+its attempts together, so a broken stage does not hold the pipeline for attempts * timeout.
+"""
+
+import sys
+import os
+import time
+import subprocess
+import traceback
+
+from collections import namedtuple
+from datetime import datetime
+
+import db
+import periodic_run
+
+from pipeline_markers import write_marker, remove_marker, wait_for_marker
+from profiling import PROFILE_ENV, is_enabled as is_profiling_enabled
+
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+DATA_DIR = "data"
+
+RECHECK_EVERY_SEC = 60
+RETRY_PAUSE_SEC = 60
+
+FEEDER_POSTGRES_CMD = ["python3", "-u", os.path.join(ROOT_DIR, "feeder_postgres.py"), "--once"]
+DEDUP_CMD = ["python3", "-u", os.path.join(ROOT_DIR, "dedup.py"), "--once"]
+STATS_CMD = ["python3", "-u", os.path.join(ROOT_DIR, "stats_aggregates.py")]
+
+EXPORT_REQUEST_MARKER = "export_request"
+EXPORT_DONE_MARKER = "export_done"
+
+Stage = namedtuple("Stage", ["name", "func", "timeout", "attempts"])
+
+
+def log(*args, file=sys.stderr, **kwargs):
+    timestamp = datetime.strftime(datetime.now(), "%Y-%m-%d %H:%M:%S")
+    print(timestamp, *args, **kwargs, file=file, flush=True)
+
+
+def create_pipeline_run_table(cursor):
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS pipeline_run (
+            id SERIAL PRIMARY KEY,
+            run_id VARCHAR(64),
+            stage VARCHAR(64),
+            attempt INT,
+            started_at TIMESTAMP,
+            finished_at TIMESTAMP,
+            status VARCHAR(16),
+            error TEXT
+        )
+    """)
+    cursor.execute("CREATE INDEX IF NOT EXISTS pipeline_run_run_id_idx ON pipeline_run (run_id)")
+
+
+def record_stage_run(run_id, stage, attempt, started_at, finished_at, status, error=None):
+    try:
+        conn = db.connect()
+        db.ensure_created(conn, "pipeline_run", create_pipeline_run_table)
+        with conn:
+            with conn.cursor() as cursor:
+                cursor.execute("""INSERT INTO pipeline_run (run_id, stage, attempt, started_at, finished_at, status, error)
+                                  VALUES (%s, %s, %s, %s, %s, %s, %s)""",
+                               (run_id, stage, attempt, started_at, finished_at, status, error))
+        conn.close()
+    except Exception:
+        # the history is not a reason to stop the pipeline
+        log(f"Failed to record stage {stage} of run {run_id}")
+        log(traceback.format_exc())
+
+
+def run_crawl(run_id, attempt, timeout):
+    if not periodic_run.run_once(timeout=timeout):
+        raise Exception("Crawler failed")
+
+
+def run_feed_postgres(run_id, attempt, timeout):
+    subprocess.run(FEEDER_POSTGRES_CMD, timeout=timeout, cwd=ROOT_DIR, check=True)
+
+
+def run_dedup(run_id, attempt, timeout):
+    subprocess.run(DEDUP_CMD, timeout=timeout, cwd=ROOT_DIR, check=True)
+
+
+def run_stats(run_id, attempt, timeout):
+    subprocess.run(STATS_CMD, timeout=timeout, cwd=ROOT_DIR, check=True)
+
+
+def run_export_parquet(run_id, attempt, timeout):
+    request_id = f"{run_id}/{attempt}"
+
+    remove_marker(EXPORT_DONE_MARKER)
+    write_marker(EXPORT_REQUEST_MARKER, {"run_id": request_id, "profile": is_profiling_enabled()})
+
+    done = wait_for_marker(EXPORT_DONE_MARKER, timeout=timeout, check=lambda p: p["run_id"] == request_id)
+    if done is None:
+        raise Exception(f"Export was not finished in {timeout} secs")
+    if done["status"] != "success":
+        raise Exception(f"Export failed: {done.get('error')}")
+
+
+STAGES = [
+    Stage("crawl", run_crawl, timeout=periodic_run.MAX_RUN_SECS, attempts=3),
+    Stage("feed_postgres", run_feed_postgres, timeout=12 * 60 * 60, attempts=3),
+    Stage("dedup", run_dedup, timeout=12 * 60 * 60, attempts=3),
+    Stage("stats", run_stats, timeout=2 * 60 * 60, attempts=3),
+    Stage("export_parquet", run_export_parquet, timeout=12 * 60 * 60, attempts=3),
+]
+
+
+def run_stage(stage, run_id):
+    deadline = time.monotonic() + stage.timeout
+    for attempt in range(1, stage.attempts + 1):
+        # an attempt gets what is left of the stage timeout
+        timeout = deadline - time.monotonic()
+        if timeout <= 0:
+            log(f"Run {run_id}: stage {stage.name} is out of its {stage.timeout} secs")
+            return False
+
+        log(f"Run {run_id}: starting stage {stage.name}, attempt {attempt}, {timeout:.0f} secs left")
+        started_at = datetime.now()
+        try:
+            stage.func(run_id, attempt, timeout)
+        except Exception:
+            error = traceback.format_exc()
+            log(f"Run {run_id}: stage {stage.name} failed")
+            log(error)
+            record_stage_run(run_id, stage.name, attempt, started_at, datetime.now(), "failed", error)
+
+            if attempt < stage.attempts:
+                time.sleep(min(RETRY_PAUSE_SEC, max(0, deadline - time.monotonic())))
+            continue
+
+        log(f"Run {run_id}: stage {stage.name} finished in {(datetime.now() - started_at).total_seconds():.0f} secs")
+        record_stage_run(run_id, stage.name, attempt, started_at, datetime.now(), "success")
+        return True
+    return False
+
+
+def run_pipeline(stages):
+    """Returns the stages left unfinished, the failed one and the ones after it"""
+    run_id = datetime.strftime(datetime.now(), "%Y-%m-%dT%H:%M:%S")
+
+    for pos, stage in enumerate(stages):
+        if not run_stage(stage, run_id):
+            log(f"Run {run_id}: stage {stage.name} failed, skipping the rest")
+            return stages[pos:]
+    return []
+
+
+def loop():
+    log(f"Starting the pipeline scheduler")
+
+    # a crawl could be finished while the scheduler was down, so the rest of the pipeline is run first.
+    # The feed and the export do nothing if everything is up to date
+    unfinished = STAGES[1:]
+
+    while True:
+        try:
+            wait_time = periodic_run.get_time_to_wait()
+            if wait_time == 0:
+                log(f"Launching pipeline")
+                unfinished = run_pipeline(STAGES)
+                # a failed crawl is retried as a due one, there is nothing new for the rest
+                if unfinished and unfinished[0] is STAGES[0]:
+                    unfinished = []
+                    time.sleep(RECHECK_EVERY_SEC)
+            elif unfinished:
+                # the stages after a good crawl are resumed until they pass, not at the next crawl
+                log(f"Resuming stages {', '.join(stage.name for stage in unfinished)}")
+                unfinished = run_pipeline(unfinished)
+                if unfinished:
+                    time.sleep(RECHECK_EVERY_SEC)
+            else:
+                log(f"Next run in {int(wait_time)} secs")
+                time.sleep(min(wait_time, RECHECK_EVERY_SEC))
+        except Exception:
+            log(traceback.format_exc())
+            time.sleep(RECHECK_EVERY_SEC)
+
+
+if __name__ == "__main__":
+    # the crawler and the feeder get it through the environment, the export through the marker
+    if "--profile" in sys.argv[1:]:
+        os.environ[PROFILE_ENV] = "1"
+    os.chdir(DATA_DIR)
+    loop()
@@ -0,0 +1,76 @@
+"""Optional profiling of pipeline stages, enabled with VACANCY_PROFILE=1
+
+For every stage it writes next to the log of the snapshot:
+    profile_{stage}.prof  - cProfile stats, open with snakeviz or pstats
+    profile_{stage}.txt   - the top of the stats by cumulative time
+    profile_timings.jsonl - wall and cpu time of every stage, plus network waits if they are known
+"""
+
+import os
+import io
+import json
+import time
+import pstats
+import cProfile
+
+from contextlib import contextmanager
+from datetime import datetime
+
+PROFILE_ENV = "VACANCY_PROFILE"
+TIMINGS_FILENAME = "profile_timings.jsonl"
+TOP_FUNCTIONS = 50
+
+
+def is_enabled():
+    return os.environ.get(PROFILE_ENV) == "1"
+
+
+@contextmanager
+def profile_stage(stage, out_dir=".", enabled=None, extra_timings=None):
+    """extra_timings is a function returning a dict, it is called when the stage is finished"""
+    if enabled is None:
+        enabled = is_enabled()
+
+    if not enabled:
+        yield
+        return
+
+    profiler = cProfile.Profile()
+    wall_start = time.perf_counter()
+    cpu_start = time.process_time()
+
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+
+        timings = {
+            "stage": stage,
+            "finished_at": datetime.now().isoformat(timespec="seconds"),
+            "wall_secs": time.perf_counter() - wall_start,
+            "cpu_secs": time.process_time() - cpu_start,
+        }
+        if extra_timings:
+            timings.update(extra_timings())
+        if "network_secs" in timings:
+            # for the crawlers it is the flattening and writing csv
+            timings["other_secs"] = (timings["wall_secs"] - timings["network_secs"] -
+                                     timings.get("rate_limit_and_backoff_secs", 0))
+
+        profiler.dump_stats(os.path.join(out_dir, f"profile_{stage}.prof"))
+
+        report = io.StringIO()
+        pstats.Stats(profiler, stream=report).sort_stats("cumulative").print_stats(TOP_FUNCTIONS)
+        with open(os.path.join(out_dir, f"profile_{stage}.txt"), "w", encoding="utf8") as f:
+            f.write(report.getvalue())
+
+        with open(os.path.join(out_dir, TIMINGS_FILENAME), "a", encoding="utf8") as f:
+            f.write(json.dumps(timings) + "\n")
+
+
+def get_http_timings(client):
+    return {
+        "network_secs": client.network_secs,
+        "rate_limit_and_backoff_secs": client.wait_secs,
+    }
@@ -0,0 +1,263 @@
+#!/usr/bin/env python3
+
+"""Archive of the raw api responses of vacancies and employers
+
+The crawlers flatten responses into COLUMN_NAMES, the archive keeps the responses themselves, so a new
+column can be added by re-flattening the old snapshots instead of crawling them again.
+
+An object is addressed by the sha256 of its canonical json and compressed with zstd using a dictionary
+trained on the responses, an unchanged vacancy in the next snapshot costs only an entry in the index.
+Several crawlers write to the same file, so every put is its own short transaction:
+
+    object (hash, dict_id, raw_size, data)
+    entry  (snapshot, kind, key, hash)     - kind is "vacancy" or "employer", key is its id
+    zdict  (dict_id, data, created_at)     - dict_id 0 means no dictionary
+
+    python3 raw_archive.py stats
+    python3 raw_archive.py train                                   # a new dictionary for new objects
+    python3 raw_archive.py reflatten 2021-03-01 --output result.csv
+    python3 raw_archive.py get vacancy 43014385 --snapshot 2021-03-01
+"""
+
+import sys
+import os
+import csv
+import json
+import sqlite3
+import hashlib
+import argparse
+
+from datetime import datetime
+
+import zstandard
+
+from hh_vacancy import COLUMN_NAMES, flatten_hh_vacancy, format_employer_industries
+
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+ARCHIVE_FILENAME = os.environ.get("RAW_ARCHIVE", os.path.join(ROOT_DIR, "data", "raw_archive.sqlite"))
+
+ZSTD_LEVEL = 9
+DICT_SIZE = 112 * 1024
+TRAIN_SAMPLES = 2000
+MIN_TRAIN_SAMPLES = 100
+LOCK_TIMEOUT_SEC = 60
+
+# all the buckets of the historical scan are one snapshot
+HIST_SNAPSHOT = "hist"
+
+
+def log(*args, file=sys.stderr, **kwargs):
+    timestamp = datetime.strftime(datetime.now(), "%Y-%m-%d %H:%M:%S")
+    print(timestamp, *args, **kwargs, file=file, flush=True)
+
+
+def get_snapshot_name(path="."):
+    """data/2021-03-01-unfinished-abc -> 2021-03-01, the crawlers run in such temporary dirs"""
+    return os.path.basename(os.path.abspath(path)).split("-unfinished-")[0]
+
+
+def to_canonical_json(obj):
+    return json.dumps(obj, ensure_ascii=False, sort_keys=True, separators=(",", ":")).encode("utf8")
+
+
+class RawArchive:
+    def __init__(self, filename=ARCHIVE_FILENAME, snapshot=None):
+        self.snapshot = snapshot
+        self.conn = sqlite3.connect(filename, timeout=LOCK_TIMEOUT_SEC)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        # a commit per put, in the wal mode it is durable enough without fsync of every transaction
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS object (
+                hash TEXT PRIMARY KEY,
+                dict_id INTEGER NOT NULL,
+                raw_size INTEGER NOT NULL,
+                data BLOB NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS entry (
+                snapshot TEXT NOT NULL,
+                kind TEXT NOT NULL,
+                key TEXT NOT NULL,
+                hash TEXT NOT NULL,
+                PRIMARY KEY (snapshot, kind, key)
+            );
+            CREATE TABLE IF NOT EXISTS zdict (
+                dict_id INTEGER PRIMARY KEY,
+                data BLOB NOT NULL,
+                created_at TEXT NOT NULL
+            );
+        """)
+
+        self.dicts = {}
+        self.compressor = None
+        self.dict_id = 0
+        row = self.conn.execute("SELECT MAX(dict_id) FROM zdict").fetchone()
+        if row[0] is not None:
+            self.use_dict(row[0])
+
+        # until there is a dictionary the first objects are written without it and kept to train it
+        self.samples = []
+
+    def get_dict(self, dict_id):
+        if dict_id not in self.dicts:
+            data = self.conn.execute("SELECT data FROM zdict WHERE dict_id = ?", (dict_id,)).fetchone()[0]
+            self.dicts[dict_id] = zstandard.ZstdCompressionDict(data)
+        return self.dicts[dict_id]
+
+    def use_dict(self, dict_id):
+        self.dict_id = dict_id
+        self.compressor = zstandard.ZstdCompressor(level=ZSTD_LEVEL, dict_data=self.get_dict(dict_id))
+
+    def train(self, samples):
+        """Saves a new dictionary trained on the samples, the new objects are compressed with it"""
+        zdict = zstandard.train_dictionary(DICT_SIZE, samples)
+        cursor = self.conn.execute("INSERT INTO zdict (data, created_at) VALUES (?, ?)",
+                                   (zdict.as_bytes(), datetime.now().isoformat(timespec="seconds")))
+        self.conn.commit()
+        self.use_dict(cursor.lastrowid)
+        log(f"Trained dictionary {self.dict_id} on {len(samples)} samples, {len(zdict.as_bytes())} bytes")
+
+    def has_object(self, obj_hash):
+        return self.conn.execute("SELECT 1 FROM object WHERE hash = ?", (obj_hash,)).fetchone() is not None
+
+    def write_object(self, obj_hash, data):
+        if self.compressor is None:
+            compressed = zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(data)
+        else:
+            compressed = self.compressor.compress(data)
+        self.conn.execute("INSERT OR IGNORE INTO object (hash, dict_id, raw_size, data) VALUES (?, ?, ?, ?)",
+                          (obj_hash, self.dict_id, len(data), compressed))
+
+    def train_on_samples(self, min_samples):
+        if self.compressor is None and len(self.samples) >= min_samples:
+            self.train(self.samples)
+        self.samples = []
+
+    def put(self, kind, key, obj):
+        data = to_canonical_json(obj)
+        obj_hash = hashlib.sha256(data).hexdigest()
+
+        if not self.has_object(obj_hash):
+            self.write_object(obj_hash, data)
+            if self.compressor is None:
+                self.samples.append(data)
+                if len(self.samples) >= TRAIN_SAMPLES:
+                    self.train_on_samples(TRAIN_SAMPLES)
+
+        self.conn.execute("INSERT OR REPLACE INTO entry (snapshot, kind, key, hash) VALUES (?, ?, ?, ?)",
+                          (self.snapshot, kind, str(key), obj_hash))
+        # the write lock is not kept while the crawler waits for the api
+        self.conn.commit()
+
+    def close(self):
+        self.train_on_samples(MIN_TRAIN_SAMPLES)
+        self.conn.commit()
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def decompress(self, dict_id, data):
+        if dict_id == 0:
+            return zstandard.ZstdDecompressor().decompress(data)
+        return zstandard.ZstdDecompressor(dict_data=self.get_dict(dict_id)).decompress(data)
+
+    def get(self, kind, key, snapshot=None):
+        """Returns the object of the snapshot, the latest one if the snapshot is not given"""
+        row = self.conn.execute("""
+            SELECT o.dict_id, o.data FROM entry e JOIN object o ON o.hash = e.hash
+            WHERE e.kind = ? AND e.key = ? AND (? IS NULL OR e.snapshot = ?)
+            ORDER BY e.snapshot DESC LIMIT 1
+        """, (kind, str(key), snapshot, snapshot)).fetchone()
+        return json.loads(self.decompress(*row)) if row else None
+
+    def iter_snapshot(self, snapshot, kind):
+        """Yields (key, object) of the snapshot sorted by the numeric key"""
+        rows = self.conn.execute("""
+            SELECT e.key, o.dict_id, o.data FROM entry e JOIN object o ON o.hash = e.hash
+            WHERE e.snapshot = ? AND e.kind = ?
+            ORDER BY CAST(e.key AS INTEGER)
+        """, (snapshot, kind))
+        for key, dict_id, data in rows:
+            yield key, json.loads(self.decompress(dict_id, data))
+
+    def get_samples(self, count=TRAIN_SAMPLES):
+        rows = self.conn.execute("SELECT dict_id, data FROM object ORDER BY random() LIMIT ?", (count,))
+        return [self.decompress(dict_id, data) for dict_id, data in rows]
+
+    def get_stats(self):
+        snapshots = self.conn.execute("""
+            SELECT snapshot, kind, COUNT(*) FROM entry GROUP BY 1, 2 ORDER BY 1, 2
+        """).fetchall()
+        objects, raw_size, size = self.conn.execute("""
+            SELECT COUNT(*), COALESCE(SUM(raw_size), 0), COALESCE(SUM(LENGTH(data)), 0) FROM object
+        """).fetchone()
+        return snapshots, objects, raw_size, size
+
+
+def reflatten(archive, snapshot, writer):
+    """Writes the rows of the snapshot as the crawler would, returns the number of rows"""
+    employers = {}
+    for key, employer in archive.iter_snapshot(snapshot, "employer"):
+        employers[key] = format_employer_industries(employer)
+
+    count = 0
+    for key, vacancy in archive.iter_snapshot(snapshot, "vacancy"):
+        employer_id = vacancy["employer"].get("id")
+        writer.writerow(flatten_hh_vacancy(vacancy, employers.get(str(employer_id)) if employer_id else None))
+        count += 1
+    return count
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--archive", default=ARCHIVE_FILENAME)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    subparsers.add_parser("stats")
+    subparsers.add_parser("train")
+
+    reflatten_parser = subparsers.add_parser("reflatten")
+    reflatten_parser.add_argument("snapshot")
+    reflatten_parser.add_argument("--output", default="result.csv")
+
+    get_parser = subparsers.add_parser("get")
+    get_parser.add_argument("kind", choices=["vacancy", "employer"])
+    get_parser.add_argument("key")
+    get_parser.add_argument("--snapshot")
+
+    args = parser.parse_args()
+
+    with RawArchive(args.archive) as archive:
+        if args.command == "stats":
+            snapshots, objects, raw_size, size = archive.get_stats()
+            for snapshot, kind, count in snapshots:
+                print(f"{snapshot} {kind}: {count}")
+            print(f"objects={objects} raw_size={raw_size} compressed_size={size} "
+                  f"ratio={raw_size / size if size else 0:.1f}")
+
+        elif args.command == "train":
+            samples = archive.get_samples()
+            if len(samples) < MIN_TRAIN_SAMPLES:
+                raise Exception(f"Too few objects to train a dictionary: {len(samples)}")
+            archive.train(samples)
+
+        elif args.command == "reflatten":
+            with open(args.output, "w", newline="") as csv_file:
+                writer = csv.DictWriter(csv_file, fieldnames=COLUMN_NAMES)
+                writer.writeheader()
+                count = reflatten(archive, args.snapshot, writer)
+            log(f"Snapshot {args.snapshot} re-flattened to {args.output}, rows={count}")
+
+        elif args.command == "get":
+            obj = archive.get(args.kind, args.key, args.snapshot)
+            if obj is None:
+                raise Exception(f"No {args.kind} {args.key} in the archive")
+            print(json.dumps(obj, ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,248 @@
+#!/usr/bin/env python3
+
+"""Salary quantiles by period, area, experience and skill from mergeable sketches
+
+Salaries are brought to net roubles per month with the rates of currency_rates.csv. The sketch of a
+cell (month of publication, area, experience, term) is a histogram over logarithmic buckets, the
+value of a bucket is known with RELATIVE_ACCURACY. Sketches are merged by adding the counts, so the
+sketches of every snapshot are computed once from the vacancies added in it and stored in
+/salary_sketch/snapshot=YYYY-MM-DD.parquet, a query just sums the buckets of the needed cells.
+
+    python3 salary_stats.py --update                          # done by feeder_hadoop.py after exports
+    python3 salary_stats.py --term python --by experience     # median and p90 by experience
+
+Usage in jupyter:
+    from salary_stats import salary_quantiles
+    salary_quantiles(term="python", areas=["Москва"], periods=("2020-01", "2020-12"), by=["experience"])
+"""
+
+import sys
+import os
+import io
+import math
+import argparse
+import posixpath
+
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+RATES_FILENAME = os.path.join(ROOT_DIR, "currency_rates.csv")
+
+SKETCH_PATH = "/salary_sketch"
+
+# personal income tax, salaries marked as gross are converted to net
+INCOME_TAX = 0.13
+# the rest is a mistake, like a salary per hour or in thousands
+MIN_SALARY = 3000
+MAX_SALARY = 10_000_000
+
+RELATIVE_ACCURACY = 0.01
+GAMMA = (1 + RELATIVE_ACCURACY) / (1 - RELATIVE_ACCURACY)
+LOG_GAMMA = math.log(GAMMA)
+
+ALL_TERMS = "*"
+CELL_COLUMNS = ["period", "area", "experience", "term"]
+
+FETCH_ROWS = 50000
+
+
+def log(*args, file=sys.stderr, **kwargs):
+    timestamp = datetime.strftime(datetime.now(), "%Y-%m-%d %H:%M:%S")
+    print(timestamp, *args, **kwargs, file=file, flush=True)
+
+
+def read_rates(filename=RATES_FILENAME):
+    """Returns {currency: roubles per unit}"""
+    rates = pd.read_csv(filename)
+    return dict(zip(rates["currency"], rates["rate"]))
+
+
+def normalize_salaries(df, rates):
+    """Returns net monthly salaries in roubles, NaN if the salary is unknown or not plausible"""
+    salary_from = pd.to_numeric(df["salary_from"], errors="coerce").to_numpy(dtype=float)
+    salary_to = pd.to_numeric(df["salary_to"], errors="coerce").to_numpy(dtype=float)
+
+    # the middle of the range if both bounds are known
+    salary = np.where(np.isnan(salary_from), salary_to,
+                      np.where(np.isnan(salary_to), salary_from, (salary_from + salary_to) / 2))
+    salary = salary * df["salary_currency"].map(rates).to_numpy(dtype=float)
+
+    gross = df["salary_gross"].fillna(False).to_numpy(dtype=bool)
+    salary = np.where(gross, salary * (1 - INCOME_TAX), salary)
+
+    with np.errstate(invalid="ignore"):
+        return np.where((salary >= MIN_SALARY) & (salary <= MAX_SALARY), salary, np.nan)
+
+
+def to_buckets(values):
+    return np.ceil(np.log(values) / LOG_GAMMA).astype(np.int32)
+
+
+def from_buckets(buckets):
+    return 2 * GAMMA ** np.asarray(buckets, dtype=float) / (GAMMA + 1)
+
+
+def build_sketches(df, rates):
+    """df is vacancies from db, returns counts by cell and bucket"""
+    salary = normalize_salaries(df, rates)
+    known = ~np.isnan(salary)
+
+    cells = pd.DataFrame({
+        "period": pd.to_datetime(df["published_at"][known]).dt.strftime("%Y-%m"),
+        "area": df["area_name"][known].fillna(""),
+        "experience": df["experience_name"][known].fillna(""),
+        "terms": df["terms_found"][known].fillna(""),
+        "bucket": to_buckets(salary[known]),
+    })
+
+    # every vacancy is counted once in ALL_TERMS and once in every term found
+    all_terms = cells.drop(columns="terms").assign(term=ALL_TERMS)
+    by_term = (cells.assign(term=cells["terms"].str.split()).drop(columns="terms")
+               .explode("term").dropna(subset=["term"]))
+
+    return (pd.concat([all_terms, by_term], ignore_index=True)
+            .groupby(CELL_COLUMNS + ["bucket"]).size().rename("count").reset_index())
+
+
+def merge_sketches(parts):
+    if not parts:
+        return pd.DataFrame(columns=CELL_COLUMNS + ["bucket", "count"])
+    return pd.concat(parts, ignore_index=True).groupby(CELL_COLUMNS + ["bucket"])["count"].sum().reset_index()
+
+
+def get_sketch_filename(snapshot_date):
+    return f"snapshot={snapshot_date.isoformat()}.parquet"
+
+
+def get_sketched_dates(client):
+    names = client.list(SKETCH_PATH) if client.status(SKETCH_PATH, strict=False) else []
+    return {datetime.strptime(name, "snapshot=%Y-%m-%d.parquet").date()
+            for name in names if name.startswith("snapshot=") and name.endswith(".parquet")}
+
+
+def sketch_snapshot(conn, snapshot_date, rates):
+    # the server side cursor streams the rows, a snapshot does not have to fit in memory
+    parts = []
+    with conn.cursor(name="salary_sketch") as cursor:
+        cursor.itersize = FETCH_ROWS
+        cursor.execute("""SELECT salary_from, salary_to, salary_gross, salary_currency, published_at, area_name,
+                                 experience_name, terms_found
+                          FROM vacancy
+                          WHERE added_at = %s AND (salary_from IS NOT NULL OR salary_to IS NOT NULL)""",
+                       (snapshot_date,))
+        columns = None
+        while True:
+            rows = cursor.fetchmany(FETCH_ROWS)
+            if not rows:
+                break
+            columns = columns or [c.name for c in cursor.description]
+            parts.append(build_sketches(pd.DataFrame(rows, columns=columns), rates))
+            if len(parts) > 1:
+                parts = [merge_sketches(parts)]
+    return merge_sketches(parts)
+
+
+def write_sketch(client, sketch, snapshot_date):
+    # sorted by term, so the statistics of row groups let a query for one term skip the rest
+    sketch = sketch.sort_values(["term", "period"])
+    buffer = io.BytesIO()
+    pq.write_table(pa.Table.from_pandas(sketch, preserve_index=False), buffer, row_group_size=100000)
+
+    path = posixpath.join(SKETCH_PATH, get_sketch_filename(snapshot_date))
+    # the reader sees either nothing or the whole file
+    client.write(path + ".tmp", data=buffer.getvalue(), overwrite=True)
+    client.rename(path + ".tmp", path)
+
+
+def update_sketches(conn, client):
+    """Sketches the snapshots fed into db since the last update"""
+    rates = read_rates()
+    sketched = get_sketched_dates(client)
+
+    with conn.cursor() as cursor:
+        cursor.execute("SELECT DISTINCT added_at FROM vacancy WHERE added_at IS NOT NULL ORDER BY added_at")
+        snapshot_dates = [row[0] for row in cursor.fetchall()]
+
+    for snapshot_date in snapshot_dates:
+        if snapshot_date in sketched:
+            continue
+        sketch = sketch_snapshot(conn, snapshot_date, rates)
+        write_sketch(client, sketch, snapshot_date)
+        log(f"Salary sketch of snapshot {snapshot_date} saved, cells={len(sketch)}")
+    conn.rollback()
+
+
+def get_quantiles(buckets, counts, quantiles):
+    order = np.argsort(buckets)
+    buckets, cumulative = np.asarray(buckets)[order], np.cumsum(np.asarray(counts)[order])
+    ranks = np.asarray(quantiles) * (cumulative[-1] - 1)
+    return from_buckets(buckets[np.searchsorted(cumulative, ranks, side="right")])
+
+
+def salary_quantiles(quantiles=(0.5, 0.9), term=ALL_TERMS, periods=None, areas=None, experiences=None, by=(),
+                     path=SKETCH_PATH, filesystem=None):
+    """Returns a DataFrame with the number of vacancies and the salary quantiles for every group of by
+
+    periods is a range of months like ("2020-01", "2020-12"), by is a list of CELL_COLUMNS
+    """
+    if filesystem is None:
+        from skill_cube import get_hdfs_filesystem
+        filesystem = get_hdfs_filesystem()
+
+    row_filter = ds.field("term") == term
+    if periods:
+        row_filter &= (ds.field("period") >= periods[0]) & (ds.field("period") <= periods[1])
+    if areas is not None:
+        row_filter &= ds.field("area").isin(areas)
+    if experiences is not None:
+        row_filter &= ds.field("experience").isin(experiences)
+
+    by = list(by)
+    dataset = ds.dataset(path, filesystem=filesystem, format="parquet")
+    counts = (dataset.to_table(columns=by + ["bucket", "count"], filter=row_filter).to_pandas()
+              .groupby(by + ["bucket"])["count"].sum().reset_index())
+
+    result = []
+    for key, group in (counts.groupby(by) if by else [((), counts)]):
+        if group.empty:
+            continue
+        values = get_quantiles(group["bucket"].to_numpy(), group["count"].to_numpy(), quantiles)
+        row = dict(zip(by, key if isinstance(key, tuple) else (key,)))
+        row["vacancies"] = int(group["count"].sum())
+        row.update({f"p{round(q * 100)}": round(value) for q, value in zip(quantiles, values)})
+        result.append(row)
+    return pd.DataFrame(result)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--update", action="store_true", help="sketch the snapshots added to db")
+    parser.add_argument("--term", default=ALL_TERMS)
+    parser.add_argument("--area", action="append")
+    parser.add_argument("--periods", nargs=2, help="first and last month like 2020-01 2020-12")
+    parser.add_argument("--by", action="append", default=[], choices=CELL_COLUMNS)
+    args = parser.parse_args()
+
+    if args.update:
+        from hdfs import InsecureClient
+
+        import db
+        import feeder_hadoop
+
+        conn = db.connect()
+        update_sketches(conn, InsecureClient(feeder_hadoop.HDFS_URL, user=feeder_hadoop.HDFS_USER))
+        conn.close()
+        return
+
+    with pd.option_context("display.width", 200, "display.max_columns", 50):
+        print(salary_quantiles(term=args.term, periods=args.periods, areas=args.area, by=args.by))
+
+
+if __name__ == "__main__":
+    main()
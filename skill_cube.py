@@ -0,0 +1,283 @@
+#!/usr/bin/env python3
+
+"""Counts of vacancies by skill x profession x year x area over the parquet export
+
+The cube is computed in one pass over /vacancy.parquet: only the needed columns are read, the year
+range is pushed down to the parquet reader and terms are counted with numpy over dictionary codes.
+The result is cached in CACHE_DIR by the version of the export, so the next questions to the same
+export are answered from a small local file.
+
+Usage in jupyter:
+    from skill_cube import load_cube, top_terms
+    cube = load_cube()
+    top_terms(cube, group="Базы данных", profession="Программирование, Разработка", years=(2015, 2021))
+
+The profession is the name of the hh.ru specialization. A vacancy with several specializations is
+counted in each of them and once in ALL_PROFESSIONS.
+"""
+
+import sys
+import os
+import json
+import hashlib
+import argparse
+import posixpath
+
+from datetime import datetime
+from urllib.parse import urlparse
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+HDFS_URL = os.environ.get("HDFS_URL", "http://namenode:9870")
+HDFS_USER = os.environ.get("HDFS_USER", "jovyan")
+
+PARQUET_PATH = "/vacancy.parquet"
+# written by feeder_hadoop.py, see parquet_manifest.py
+MANIFEST_NAME = "_manifest.json"
+
+CACHE_DIR = os.environ.get("SKILL_CUBE_CACHE_DIR", os.path.expanduser("~/.cache/skill_cube"))
+CUBE_VERSION = 1
+
+COLUMNS = ["terms_found", "specializations", "published_at", "area_name"]
+ALL_PROFESSIONS = "*"
+
+# "1.221 Программирование, Разработка 1 Информационные технологии", see hh_vacancy.py
+SPECIALIZATION_RE = r"^(?P<id>[\d.]+) (?P<name>.*) (?P<profarea_id>\d+) (?P<profarea_name>.*)$"
+
+# the cell key is packed into one int64
+TERM_BITS = 20
+PROFESSION_BITS = 13
+YEAR_BITS = 12
+AREA_BITS = 18
+
+# partial counts are merged when there are that many keys pending, it bounds the memory
+MERGE_EVERY_KEYS = 10_000_000
+
+
+def log(*args, file=sys.stderr, **kwargs):
+    timestamp = datetime.strftime(datetime.now(), "%Y-%m-%d %H:%M:%S")
+    print(timestamp, *args, **kwargs, file=file, flush=True)
+
+
+def get_hdfs_filesystem(hdfs_url=HDFS_URL, user=HDFS_USER):
+    """WebHDFS supports ranged reads, so only the needed column chunks are downloaded"""
+    import fsspec
+
+    url = urlparse(hdfs_url)
+    return fsspec.filesystem("webhdfs", host=url.hostname, port=url.port, user=user)
+
+
+def get_dataset_version(path, filesystem=None):
+    """Returns a hash of the export manifest or, if there is no manifest, of the list of files"""
+    if filesystem is not None:
+        manifest_path = posixpath.join(path, MANIFEST_NAME)
+        if filesystem.exists(manifest_path):
+            manifest = json.loads(filesystem.cat(manifest_path))
+            state = [manifest["watermark"], manifest["files"]]
+        else:
+            state = sorted((f["name"], f["size"]) for f in filesystem.ls(path, detail=True))
+    else:
+        state = sorted((name, os.path.getsize(os.path.join(path, name)), os.path.getmtime(os.path.join(path, name)))
+                       for name in os.listdir(path))
+
+    return hashlib.sha1(json.dumps([CUBE_VERSION, state]).encode()).hexdigest()
+
+
+class Dictionary:
+    """Maps strings to codes that are the same for all batches"""
+
+    def __init__(self):
+        self.values = [""]
+        self.codes = {"": 0}
+
+    def get_code(self, value):
+        code = self.codes.get(value)
+        if code is None:
+            code = self.codes[value] = len(self.values)
+            self.values.append(value)
+        return code
+
+    def encode(self, array):
+        # the strings are looked up once per batch dictionary, the rows are mapped with numpy
+        array = pc.dictionary_encode(pc.fill_null(array, ""))
+        mapping = np.array([self.get_code(v) for v in array.dictionary.to_pylist()], dtype=np.int64)
+        return mapping[array.indices.to_numpy(zero_copy_only=False)]
+
+
+def pack_keys(terms, professions, years, areas):
+    return (((terms << PROFESSION_BITS | professions) << YEAR_BITS | years) << AREA_BITS) | areas
+
+
+def unpack_keys(keys):
+    areas = keys & ((1 << AREA_BITS) - 1)
+    keys = keys >> AREA_BITS
+    years = keys & ((1 << YEAR_BITS) - 1)
+    keys = keys >> YEAR_BITS
+    professions = keys & ((1 << PROFESSION_BITS) - 1)
+    terms = keys >> PROFESSION_BITS
+    return terms, professions, years, areas
+
+
+def merge_counts(parts):
+    keys = np.concatenate([k for k, _ in parts])
+    counts = np.concatenate([c for _, c in parts])
+    keys, inverse = np.unique(keys, return_inverse=True)
+    return keys, np.bincount(inverse, weights=counts).astype(np.int64)
+
+
+def count_batch(batch, terms_dict, professions_dict, areas_dict):
+    """Returns the unique cell keys of the batch and the numbers of vacancies in them"""
+    num_rows = batch.num_rows
+
+    terms = pc.split_pattern(pc.fill_null(batch["terms_found"], ""), " ")
+    term_rows = pc.list_parent_indices(terms).to_numpy()
+    term_codes = terms_dict.encode(pc.list_flatten(terms))
+
+    # the empty string is code 0, it is left from empty terms_found
+    found = term_codes != 0
+    term_rows, term_codes = term_rows[found], term_codes[found]
+
+    # every row has at least one line, maybe an empty one, so no vacancy is lost
+    specializations = pc.split_pattern(pc.fill_null(batch["specializations"], ""), "\n")
+    specialization_rows = pc.list_parent_indices(specializations).to_numpy()
+    names = pc.extract_regex(pc.list_flatten(specializations), SPECIALIZATION_RE).field("name")
+    profession_codes = professions_dict.encode(names)
+
+    years = pc.fill_null(pc.year(batch["published_at"]), 0).to_numpy(zero_copy_only=False).astype(np.int64)
+    area_codes = areas_dict.encode(batch["area_name"])
+
+    # terms x professions of the same row, both are sorted by row
+    per_row = np.bincount(specialization_rows, minlength=num_rows)
+    row_offsets = np.cumsum(per_row) - per_row
+    repeats = per_row[term_rows]
+
+    pair_rows = np.repeat(term_rows, repeats)
+    pair_terms = np.repeat(term_codes, repeats)
+    pos_in_row = np.arange(len(pair_rows)) - np.repeat(np.cumsum(repeats) - repeats, repeats)
+    pair_professions = profession_codes[row_offsets[pair_rows] + pos_in_row]
+
+    all_code = professions_dict.get_code(ALL_PROFESSIONS)
+    keys = np.concatenate([
+        pack_keys(pair_terms, pair_professions, years[pair_rows], area_codes[pair_rows]),
+        pack_keys(term_codes, np.full_like(term_codes, all_code), years[term_rows], area_codes[term_rows]),
+    ])
+
+    keys, counts = np.unique(keys, return_counts=True)
+    return keys, counts
+
+
+def compute_cube(path=PARQUET_PATH, filesystem=None, years=None):
+    """Returns a DataFrame term, profession, year, area, vacancies"""
+    dataset = ds.dataset(path, filesystem=filesystem, format="parquet")
+
+    row_filter = None
+    if years:
+        first_year, last_year = years
+        # plain comparisons are checked against the row group statistics, so row groups are skipped
+        row_filter = ((ds.field("published_at") >= datetime(first_year, 1, 1)) &
+                      (ds.field("published_at") < datetime(last_year + 1, 1, 1)))
+
+    terms_dict, professions_dict, areas_dict = Dictionary(), Dictionary(), Dictionary()
+
+    parts = []
+    pending_keys = 0
+    rows = 0
+    for batch in dataset.to_batches(columns=COLUMNS, filter=row_filter):
+        if not batch.num_rows:
+            continue
+        parts.append(count_batch(batch, terms_dict, professions_dict, areas_dict))
+        pending_keys += len(parts[-1][0])
+        rows += batch.num_rows
+
+        if pending_keys > MERGE_EVERY_KEYS:
+            parts = [merge_counts(parts)]
+            pending_keys = len(parts[0][0])
+
+    for name, dictionary, bits in (("terms", terms_dict, TERM_BITS), ("professions", professions_dict, PROFESSION_BITS),
+                                   ("areas", areas_dict, AREA_BITS)):
+        if len(dictionary.values) >= 1 << bits:
+            raise Exception(f"Too many {name} for the cube key: {len(dictionary.values)}")
+
+    keys, counts = merge_counts(parts) if parts else (np.array([], dtype=np.int64), np.array([], dtype=np.int64))
+    terms, professions, years, areas = unpack_keys(keys)
+
+    log(f"Computed the skill cube over {rows} vacancies, {len(keys)} cells")
+    return pd.DataFrame({
+        "term": pd.Categorical.from_codes(terms, terms_dict.values),
+        "profession": pd.Categorical.from_codes(professions, professions_dict.values),
+        "year": years.astype(np.int16),
+        "area": pd.Categorical.from_codes(areas, areas_dict.values),
+        "vacancies": counts,
+    })
+
+
+def load_cube(path=PARQUET_PATH, local=False, years=None, cache_dir=CACHE_DIR):
+    """Returns the cube from the cache or computes it, local=True reads the export from a local dir"""
+    filesystem = None if local else get_hdfs_filesystem()
+
+    version = get_dataset_version(path, filesystem)
+    if years:
+        version += f"-{years[0]}-{years[1]}"
+    cache_filename = os.path.join(cache_dir, f"skill_cube_{version}.parquet")
+
+    if os.path.exists(cache_filename):
+        return pq.read_table(cache_filename).to_pandas()
+
+    cube = compute_cube(path, filesystem, years)
+
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_filename = cache_filename + ".tmp"
+    pq.write_table(pa.Table.from_pandas(cube, preserve_index=False), tmp_filename)
+    os.replace(tmp_filename, cache_filename)
+    return cube
+
+
+def top_terms(cube, terms=None, group=None, profession=ALL_PROFESSIONS, years=None, areas=None, top=10):
+    """Returns a DataFrame of vacancy counts, the top terms by rows and years by columns
+
+    group is a group of blocks.txt like "Базы данных", the terms are canonical ones like in terms_found
+    """
+    if group is not None:
+        from skill_extractor import read_blocks
+        terms = read_blocks()[group]
+
+    mask = cube["profession"] == profession
+    if terms is not None:
+        mask &= cube["term"].isin(terms)
+    if years is not None:
+        mask &= (cube["year"] >= years[0]) & (cube["year"] <= years[1])
+    if areas is not None:
+        mask &= cube["area"].isin(areas)
+
+    by_year = (cube[mask].groupby(["term", "year"], observed=True)["vacancies"].sum()
+               .unstack(fill_value=0))
+    if by_year.empty:
+        return by_year
+    return by_year.loc[by_year.sum(axis=1).sort_values(ascending=False).index[:top]]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--local", help="a local dir with the parquet export instead of HDFS")
+    parser.add_argument("--group", help="a group of blocks.txt")
+    parser.add_argument("--profession", default=ALL_PROFESSIONS)
+    parser.add_argument("--years", type=int, nargs=2)
+    parser.add_argument("--top", type=int, default=10)
+    args = parser.parse_args()
+
+    if args.local:
+        cube = load_cube(args.local, local=True)
+    else:
+        cube = load_cube()
+
+    with pd.option_context("display.width", 200, "display.max_columns", 50):
+        print(top_terms(cube, group=args.group, profession=args.profession, years=args.years, top=args.top))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,241 @@
+#!/usr/bin/env python3
+
+"""Finds skills and terms from example_notebook/blocks.txt and synonims.txt in vacancies
+
+All the surface forms of all terms are compiled into one Aho-Corasick automaton, so a vacancy is
+scanned once whatever the number of terms. Every form is mapped to its canonical term: the term of
+blocks.txt if the synonims line contains one, else the first word of the line. The result is the
+space separated list of canonical terms in the notebook format, like "c++ git python".
+
+    python3 skill_extractor.py "Опыт работы с Python, PostgreSQL и C++"
+    python3 skill_extractor.py --backfill   # fill terms_found of the vacancies fed before
+"""
+
+import sys
+import os
+import re
+import html
+import itertools
+import time
+import multiprocessing
+
+from collections import deque
+from datetime import datetime
+
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+BLOCKS_FILENAME = os.path.join(ROOT_DIR, "example_notebook", "blocks.txt")
+SYNONIMS_FILENAME = os.path.join(ROOT_DIR, "example_notebook", "synonims.txt")
+
+# the rows are sent to the worker processes in chunks, one row is too little work
+CHUNK_SIZE = 64
+BATCH_SIZE = 4096
+BACKFILL_BATCH = 10000
+
+TAG_RE = re.compile(r"<[^>]*>")
+SPACE_RE = re.compile(r"\s+")
+
+# "c++" and "c#" are words, so "c" is not found inside them
+WORD_EXTRA_CHARS = "+#"
+
+extractor = None
+
+
+def log(*args, file=sys.stderr, **kwargs):
+    timestamp = datetime.strftime(datetime.now(), "%Y-%m-%d %H:%M:%S")
+    print(timestamp, *args, **kwargs, file=file, flush=True)
+
+
+def is_word_char(c):
+    return c.isalnum() or c in WORD_EXTRA_CHARS
+
+
+def normalize_term(term):
+    return SPACE_RE.sub(" ", term.replace("_", " ")).strip().lower()
+
+
+def normalize_text(text):
+    return SPACE_RE.sub(" ", html.unescape(TAG_RE.sub(" ", text))).lower()
+
+
+def read_blocks(filename=BLOCKS_FILENAME):
+    """Returns {group: [term, ...]}, the groups marked with "*" (short words, places) are skipped"""
+    groups = {}
+    with open(filename, encoding="utf8") as f:
+        for line in f:
+            group, *terms = line.strip("\n").split("/")
+            if group.startswith("*"):
+                continue
+            groups[group] = [t for t in terms if t]
+    return groups
+
+
+def read_synonims(blocks, filename=SYNONIMS_FILENAME):
+    """Returns {surface form: canonical term}, the terms of blocks are forms of themselves"""
+    block_terms = {t for terms in blocks.values() for t in terms}
+    forms = {t: t for t in block_terms}
+
+    with open(filename, encoding="utf8") as f:
+        for line in f:
+            words = [w for w in line.strip("\n").split("/") if w]
+            if not words:
+                continue
+
+            # the head may be a list like "c#,.net|c#_.net", the first item is the name
+            head = words[0].split("|")[0].split(",")[0]
+            canonical = next((w for w in words if w in block_terms), head)
+
+            for word in words:
+                if "," in word or "|" in word:
+                    continue
+                forms.setdefault(word, canonical)
+            forms.setdefault(head, canonical)
+    return forms
+
+
+class Extractor:
+    """Aho-Corasick automaton over normalized surface forms"""
+
+    def __init__(self, forms):
+        self.goto = [{}]
+        self.fail = [0]
+        self.out = [[]]
+
+        for form, canonical in forms.items():
+            pattern = normalize_term(form)
+            if pattern:
+                self.add_pattern(pattern, canonical)
+        self.build_fail_links()
+
+    def add_pattern(self, pattern, canonical):
+        state = 0
+        for c in pattern:
+            next_state = self.goto[state].get(c)
+            if next_state is None:
+                next_state = len(self.goto)
+                self.goto[state][c] = next_state
+                self.goto.append({})
+                self.fail.append(0)
+                self.out.append([])
+            state = next_state
+
+        # the boundaries are checked only where the pattern itself starts or ends with a letter,
+        # so ".net" is found in "asp.net"
+        self.out[state].append((len(pattern), canonical, is_word_char(pattern[0]), is_word_char(pattern[-1])))
+
+    def build_fail_links(self):
+        queue = deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for c, next_state in self.goto[state].items():
+                queue.append(next_state)
+
+                fail = self.fail[state]
+                while fail and c not in self.goto[fail]:
+                    fail = self.fail[fail]
+                self.fail[next_state] = self.goto[fail].get(c, 0)
+                self.out[next_state] = self.out[next_state] + self.out[self.fail[next_state]]
+
+    def find(self, text):
+        """Returns the set of canonical terms found in the normalized text"""
+        found = set()
+        goto, fail, out = self.goto, self.fail, self.out
+
+        state = 0
+        for pos, c in enumerate(text):
+            while state and c not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(c, 0)
+
+            for length, canonical, check_start, check_end in out[state]:
+                if canonical in found:
+                    continue
+                start = pos - length + 1
+                if check_start and start > 0 and is_word_char(text[start - 1]):
+                    continue
+                if check_end and pos + 1 < len(text) and is_word_char(text[pos + 1]):
+                    continue
+                found.add(canonical)
+        return found
+
+    def extract(self, description, key_skills):
+        # key skills are separated with "\n", the separator keeps terms from gluing together
+        text = normalize_text(f"{description or ''} | {key_skills or ''}".replace("\n", " | "))
+        return " ".join(sorted(self.find(text)))
+
+
+def load_extractor():
+    blocks = read_blocks()
+    return Extractor(read_synonims(blocks))
+
+
+def get_term_groups():
+    """Returns {canonical term: [group, ...]}, replaces the linear search_synonim of the notebook"""
+    term_groups = {}
+    for group, terms in read_blocks().items():
+        for term in terms:
+            term_groups.setdefault(term, []).append(group)
+    return term_groups
+
+
+def init_worker():
+    global extractor
+    extractor = load_extractor()
+
+
+def extract_row(row):
+    return extractor.extract(row.get("description"), row.get("key_skills"))
+
+
+def iter_with_terms(rows, processes=None):
+    """Yields (row, terms_found) keeping the order, rows are dicts with description and key_skills"""
+    if processes == 1:
+        init_worker()
+        for row in rows:
+            yield row, extract_row(row)
+        return
+
+    with multiprocessing.Pool(processes, initializer=init_worker) as pool:
+        # imap would read all the rows ahead, batches keep the memory bounded
+        rows = iter(rows)
+        while True:
+            batch = list(itertools.islice(rows, BATCH_SIZE))
+            if not batch:
+                break
+            yield from zip(batch, pool.map(extract_row, batch, chunksize=CHUNK_SIZE))
+
+
+def backfill(processes=None):
+    import psycopg2.extras
+
+    import db
+    import feeder_postgres
+
+    conn = db.connect()
+    db.ensure_created(conn, "vacancy", feeder_postgres.create_vacancy_table)
+    cursor = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+
+    total = 0
+    start = time.monotonic()
+    while True:
+        cursor.execute("SELECT id, description, key_skills FROM vacancy WHERE terms_found IS NULL LIMIT %s",
+                       (BACKFILL_BATCH,))
+        rows = [dict(row) for row in cursor.fetchall()]
+        if not rows:
+            break
+
+        psycopg2.extras.execute_batch(cursor, "UPDATE vacancy SET terms_found = %s WHERE id = %s",
+                                      [(terms_found, row["id"]) for row, terms_found in iter_with_terms(rows, processes)])
+        conn.commit()
+
+        total += len(rows)
+        log(f"Backfilled {total} vacancies, {total / (time.monotonic() - start):.0f} per sec")
+
+    cursor.close()
+    conn.close()
+
+
+if __name__ == "__main__":
+    if sys.argv[1:] == ["--backfill"]:
+        backfill()
+    else:
+        print(load_extractor().extract(" ".join(sys.argv[1:]), ""))
@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+
+"""Compares two snapshots data/YYYY-MM-DD/result.csv without the database
+
+Every snapshot is read in batches of rows, every value is hashed into a 64-bit number, so a snapshot
+takes 8 bytes per cell in memory whatever the length of descriptions. The rows are sorted by id
+and matched with a sorted merge. Archived vacancies are treated as removed like feeder_postgres.py
+does.
+
+    python3 snapshot_diff.py data/2021-03-01 data/2021-03-08
+    python3 snapshot_diff.py data/2021-03-01 data/2021-03-08 --output delta.npz
+
+The delta file is a compressed npz: the column names, added_ids, removed_ids, changed_ids and
+changed_columns, a bitmask of the changed columns for every changed id (np.unpackbits with
+bitorder="little" gives a bool per column).
+"""
+
+import sys
+import os
+import csv
+import argparse
+
+from datetime import datetime
+
+import numpy as np
+
+CSV_FILENAME = "result.csv"
+BATCH_ROWS = 10000
+
+
+def log(*args, file=sys.stderr, **kwargs):
+    timestamp = datetime.strftime(datetime.now(), "%Y-%m-%d %H:%M:%S")
+    print(timestamp, *args, **kwargs, file=file, flush=True)
+
+
+def get_csv_filename(path):
+    return os.path.join(path, CSV_FILENAME) if os.path.isdir(path) else path
+
+
+def hash_batch(rows, columns):
+    """Returns ids and a matrix of value hashes, one column of the matrix per column"""
+    ids = np.array([int(row["id"]) for row in rows], dtype=np.int64)
+    hashes = np.empty((len(rows), len(columns)), dtype=np.int64)
+    for pos, column in enumerate(columns):
+        # the hashes of str are salted per process, it is fine as both snapshots are hashed here
+        hashes[:, pos] = np.fromiter((hash(row[column] or "") for row in rows), dtype=np.int64, count=len(rows))
+    return ids, hashes
+
+
+def read_snapshot(path, columns=None):
+    """Returns (columns, ids sorted, hashes in the order of ids), the last row of an id wins"""
+    csv.field_size_limit(sys.maxsize)
+
+    all_ids, all_hashes = [], []
+    with open(get_csv_filename(path), newline="", encoding="utf8") as csv_file:
+        reader = csv.DictReader(csv_file)
+        if columns is None:
+            columns = [c for c in reader.fieldnames if c != "id"]
+
+        batch = []
+        for row in reader:
+            # archived vacancies are removed ones for the feeder
+            if (row.get("archived") or "").lower() == "true":
+                continue
+            batch.append(row)
+            if len(batch) >= BATCH_ROWS:
+                ids, hashes = hash_batch(batch, columns)
+                all_ids.append(ids)
+                all_hashes.append(hashes)
+                batch = []
+        if batch:
+            ids, hashes = hash_batch(batch, columns)
+            all_ids.append(ids)
+            all_hashes.append(hashes)
+
+    if not all_ids:
+        return columns, np.array([], dtype=np.int64), np.empty((0, len(columns)), dtype=np.int64)
+
+    ids = np.concatenate(all_ids)
+    hashes = np.concatenate(all_hashes)
+
+    # stable sort keeps the order of rows of the same id, the last one is taken
+    order = np.argsort(ids, kind="stable")
+    ids, hashes = ids[order], hashes[order]
+    last = np.append(ids[1:] != ids[:-1], True)
+    return columns, ids[last], hashes[last]
+
+
+def diff_snapshots(old_path, new_path):
+    columns, old_ids, old_hashes = read_snapshot(old_path)
+    new_columns, new_ids, new_hashes = read_snapshot(new_path)
+    if new_columns != columns:
+        raise Exception(f"Snapshots have different columns: {columns} and {new_columns}")
+
+    _, old_pos, new_pos = np.intersect1d(old_ids, new_ids, assume_unique=True, return_indices=True)
+
+    changed_cells = old_hashes[old_pos] != new_hashes[new_pos]
+    changed_rows = changed_cells.any(axis=1)
+
+    return {
+        "columns": np.array(columns),
+        "added_ids": np.setdiff1d(new_ids, old_ids, assume_unique=True),
+        "removed_ids": np.setdiff1d(old_ids, new_ids, assume_unique=True),
+        "changed_ids": new_ids[new_pos][changed_rows],
+        "changed_columns": np.packbits(changed_cells[changed_rows], axis=1, bitorder="little"),
+    }
+
+
+def write_delta(filename, delta):
+    np.savez_compressed(filename, **delta)
+
+
+def read_delta(filename):
+    with np.load(filename) as f:
+        delta = {name: f[name] for name in f.files}
+    return delta
+
+
+def get_changed_columns(delta, pos):
+    """Returns the names of the changed columns of delta["changed_ids"][pos]"""
+    mask = np.unpackbits(delta["changed_columns"][pos], count=len(delta["columns"]), bitorder="little")
+    return [str(c) for c in delta["columns"][mask.astype(bool)]]
+
+
+def print_summary(delta):
+    print(f"added={len(delta['added_ids'])} removed={len(delta['removed_ids'])} changed={len(delta['changed_ids'])}")
+    if not len(delta["changed_ids"]):
+        return
+
+    changes = np.unpackbits(delta["changed_columns"], axis=1, count=len(delta["columns"]),
+                            bitorder="little").sum(axis=0, dtype=np.int64)
+    for column, count in sorted(zip(delta["columns"], changes), key=lambda c: -c[1]):
+        if count:
+            print(f"    {column}: {count}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("old", help="snapshot dir or csv")
+    parser.add_argument("new", help="snapshot dir or csv")
+    parser.add_argument("--output", help="save the delta as npz")
+    args = parser.parse_args()
+
+    log(f"Comparing {args.old} and {args.new}")
+    delta = diff_snapshots(args.old, args.new)
+    print_summary(delta)
+
+    if args.output:
+        write_delta(args.output, delta)
+        log(f"Delta saved to {args.output}, {os.path.getsize(args.output)} bytes")
+
+
+if __name__ == "__main__":
+    main()
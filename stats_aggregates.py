@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+
+"""Precomputed aggregates of the vacancy table for stats_api.py
+
+Every snapshot the aggregates are recomputed into new tables that replace the old ones in one
+transaction, the readers see either the old aggregates or the new ones. stats_meta.version is the
+date of the snapshot, the api drops its cache when it changes.
+
+    stats_vacancies (period, area_name, vacancies, unique_vacancies)
+    stats_skills    (period, area_name, term, vacancies)
+    stats_salary    (period, area_name, experience_name, bucket, vacancies)
+
+period is the month of publication like "2021-03". unique_vacancies counts dedup.py clusters, a cluster
+spanning several months or areas is counted in each of them. Salaries are net roubles per month,
+bucket is the number of the logarithmic interval of the salary, both are the ones of salary_stats.py.
+"""
+
+import sys
+
+from datetime import datetime
+
+import psycopg2.extras
+
+import db
+
+from salary_stats import INCOME_TAX, MIN_SALARY, MAX_SALARY, LOG_GAMMA, read_rates
+
+AGGREGATES = [
+    ("stats_vacancies", """
+        SELECT to_char(published_at, 'YYYY-MM') AS period, area_name, COUNT(*) AS vacancies,
+               COUNT(DISTINCT COALESCE(cluster_id, id)) AS unique_vacancies
+        FROM vacancy
+        GROUP BY 1, 2
+    """, ["period", "area_name"]),
+
+    ("stats_skills", """
+        SELECT to_char(published_at, 'YYYY-MM') AS period, area_name, term, COUNT(*) AS vacancies
+        FROM vacancy, unnest(string_to_array(terms_found, ' ')) AS term
+        WHERE terms_found <> ''
+        GROUP BY 1, 2, 3
+    """, ["period", "area_name"]),
+
+    ("stats_salary", """
+        WITH salary AS (
+            SELECT to_char(v.published_at, 'YYYY-MM') AS period, v.area_name, v.experience_name,
+                   COALESCE((v.salary_from + v.salary_to) / 2.0, v.salary_from, v.salary_to) * r.rate *
+                   (CASE WHEN v.salary_gross THEN 1 - %(income_tax)s ELSE 1 END) AS salary
+            FROM vacancy v
+            JOIN currency_rate r ON r.currency = v.salary_currency
+            WHERE v.salary_from IS NOT NULL OR v.salary_to IS NOT NULL
+        )
+        SELECT period, area_name, experience_name, CEIL(LN(salary) / %(log_gamma)s)::INT AS bucket,
+               COUNT(*) AS vacancies
+        FROM salary
+        WHERE salary BETWEEN %(min_salary)s AND %(max_salary)s
+        GROUP BY 1, 2, 3, 4
+    """, ["period", "area_name"]),
+]
+
+
+def log(*args, file=sys.stderr, **kwargs):
+    timestamp = datetime.strftime(datetime.now(), "%Y-%m-%d %H:%M:%S")
+    print(timestamp, *args, **kwargs, file=file, flush=True)
+
+
+def create_stats_meta_table(cursor):
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS stats_meta (
+            id INT PRIMARY KEY,
+            version VARCHAR(64),
+            refreshed_at TIMESTAMP
+        )
+    """)
+
+
+def get_version(cursor):
+    cursor.execute("SELECT GREATEST(MAX(added_at), MAX(updated_at), MAX(removed_at)) FROM vacancy")
+    max_date = cursor.fetchone()[0]
+    return max_date.isoformat() if max_date else ""
+
+
+def refresh_aggregates(conn):
+    params = {"income_tax": INCOME_TAX, "log_gamma": LOG_GAMMA,
+              "min_salary": MIN_SALARY, "max_salary": MAX_SALARY}
+
+    with conn.cursor() as cursor:
+        create_stats_meta_table(cursor)
+
+        cursor.execute("CREATE TEMP TABLE currency_rate (currency VARCHAR(64), rate DOUBLE PRECISION) ON COMMIT DROP")
+        psycopg2.extras.execute_values(cursor, "INSERT INTO currency_rate (currency, rate) VALUES %s",
+                                       [(currency, float(rate)) for currency, rate in read_rates().items()])
+
+        version = get_version(cursor)
+
+        for name, select, index_columns in AGGREGATES:
+            log(f"Computing {name}")
+            cursor.execute(f"DROP TABLE IF EXISTS {name}_new")
+            cursor.execute(f"CREATE TABLE {name}_new AS {select}", params)
+
+        # the old tables are replaced at the commit
+        for name, select, index_columns in AGGREGATES:
+            cursor.execute(f"DROP TABLE IF EXISTS {name}")
+            cursor.execute(f"ALTER TABLE {name}_new RENAME TO {name}")
+            cursor.execute(f"CREATE INDEX {name}_idx ON {name} ({', '.join(index_columns)})")
+
+        cursor.execute("""INSERT INTO stats_meta (id, version, refreshed_at) VALUES (1, %s, %s)
+                          ON CONFLICT (id) DO UPDATE SET version = EXCLUDED.version,
+                                                         refreshed_at = EXCLUDED.refreshed_at""",
+                       (version, datetime.now()))
+    conn.commit()
+    log(f"Stats aggregates refreshed, version {version}")
+
+
+if __name__ == "__main__":
+    conn = db.connect()
+    refresh_aggregates(conn)
+    conn.close()
@@ -0,0 +1,312 @@
+#!/usr/bin/env python3
+
+"""Read-only HTTP api over the aggregates of stats_aggregates.py
+
+    GET /skills?area=Екатеринбург&period_from=2021-03&period_to=2021-03&top=10&group=Базы данных
+    GET /salary?area=Москва&period_from=2021-01&experience=Нет опыта
+    GET /vacancies?area=Москва&period_from=2020-01&by=period
+    GET /cells?level=30&bbox=56.7,60.4,56.95,60.8&snapshot=2021-03-08
+
+All parameters are optional, periods are months like "2021-03". Responses are cached in memory
+until they expire or a new snapshot is aggregated.
+"""
+
+import sys
+import os
+import json
+import math
+import time
+import threading
+import traceback
+
+from collections import OrderedDict
+from datetime import datetime
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qsl
+
+import psycopg2
+
+import db
+
+from salary_stats import from_buckets, get_quantiles
+from skill_extractor import read_blocks
+from geo_grid import COUNT_LEVELS, CELL_BITS, get_cover_ranges, get_cell_center, to_geohash
+
+PORT = int(os.environ.get("STATS_API_PORT", 8090))
+
+POOL_SIZE = 8
+CACHE_SIZE = 4096
+CACHE_TTL_SEC = 600
+VERSION_CHECK_SEC = 10
+
+MAX_TOP = 1000
+QUANTILES = (0.1, 0.25, 0.5, 0.75, 0.9)
+
+
+def log(*args, file=sys.stderr, **kwargs):
+    timestamp = datetime.strftime(datetime.now(), "%Y-%m-%d %H:%M:%S")
+    print(timestamp, *args, **kwargs, file=file, flush=True)
+
+
+class BadRequest(Exception):
+    pass
+
+
+class ResponseCache:
+    """LRU with a time to live, it is cleared as a whole when the aggregates change"""
+
+    def __init__(self, size=CACHE_SIZE, ttl=CACHE_TTL_SEC):
+        self.size = size
+        self.ttl = ttl
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+        self.version_lock = threading.Lock()
+        self.version = None
+        self.checked_at = 0
+
+    def get(self, key):
+        with self.lock:
+            item = self.items.get(key)
+            if item is None:
+                return None
+            expires_at, value = item
+            if expires_at < time.monotonic():
+                del self.items[key]
+                return None
+            self.items.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            self.items[key] = (time.monotonic() + self.ttl, value)
+            self.items.move_to_end(key)
+            while len(self.items) > self.size:
+                self.items.popitem(last=False)
+
+    def check_version(self, get_version):
+        """Clears the cache if the version has changed, the version is asked at most every VERSION_CHECK_SEC"""
+        if time.monotonic() - self.checked_at < VERSION_CHECK_SEC:
+            return self.version
+
+        # only one thread asks db, the others use the known version meanwhile
+        if not self.version_lock.acquire(blocking=False):
+            return self.version
+        try:
+            self.checked_at = time.monotonic()
+            # db is asked without the cache lock, so gets and puts are not blocked by it
+            version = get_version()
+            with self.lock:
+                if version != self.version:
+                    log(f"Stats version {self.version} -> {version}, clearing the cache")
+                    self.items.clear()
+                    self.version = version
+        finally:
+            self.version_lock.release()
+        return self.version
+
+
+db_pool = db.Pool(POOL_SIZE)
+cache = ResponseCache()
+
+
+def query(sql, params=()):
+    return db_pool.query(sql, params)
+
+
+def get_version():
+    try:
+        rows = query("SELECT version FROM stats_meta WHERE id = 1")
+    except psycopg2.Error:
+        return None
+    return rows[0][0] if rows else None
+
+
+def get_filter(params, columns=("period", "area_name")):
+    """Returns the WHERE clause and its params for the common parameters"""
+    conditions = ["TRUE"]
+    values = []
+    if "period_from" in params:
+        conditions.append("period >= %s")
+        values.append(params["period_from"])
+    if "period_to" in params:
+        conditions.append("period <= %s")
+        values.append(params["period_to"])
+    if "area" in params:
+        conditions.append("area_name = %s")
+        values.append(params["area"])
+    if "experience" in params and "experience_name" in columns:
+        conditions.append("experience_name = %s")
+        values.append(params["experience"])
+    return " AND ".join(conditions), values
+
+
+def get_int_param(params, name, default, max_value, min_value=1):
+    try:
+        value = int(params.get(name, default))
+    except ValueError:
+        raise BadRequest(f"{name} must be an integer")
+    if value < min_value:
+        raise BadRequest(f"{name} must be at least {min_value}")
+    return min(max_value, value)
+
+
+def get_skills(params):
+    where, values = get_filter(params)
+    if "group" in params:
+        terms = read_blocks().get(params["group"])
+        if terms is None:
+            raise BadRequest(f"unknown group {params['group']}")
+        where += " AND term = ANY(%s)"
+        values.append(terms)
+
+    top = get_int_param(params, "top", 10, MAX_TOP)
+    rows = query(f"""SELECT term, SUM(vacancies) FROM stats_skills WHERE {where}
+                     GROUP BY term ORDER BY 2 DESC, 1 LIMIT %s""", values + [top])
+    return {"skills": [{"term": term, "vacancies": int(vacancies)} for term, vacancies in rows]}
+
+
+def get_salary(params):
+    where, values = get_filter(params, columns=("period", "area_name", "experience_name"))
+    rows = query(f"""SELECT bucket, SUM(vacancies) FROM stats_salary WHERE {where}
+                     GROUP BY bucket ORDER BY bucket""", values)
+    rows = [(bucket, int(count)) for bucket, count in rows]
+
+    total = sum(count for _, count in rows)
+    quantiles = {}
+    if total:
+        values = get_quantiles([bucket for bucket, _ in rows], [count for _, count in rows], QUANTILES)
+        quantiles = {f"p{round(q * 100)}": round(value) for q, value in zip(QUANTILES, values.tolist())}
+
+    return {
+        "vacancies": total,
+        "quantiles": quantiles,
+        "histogram": [{"salary": round(value), "vacancies": count}
+                      for value, (_, count) in zip(from_buckets([bucket for bucket, _ in rows]).tolist(), rows)],
+    }
+
+
+def get_vacancies(params):
+    where, values = get_filter(params)
+    by = params.get("by")
+    if by not in (None, "period", "area"):
+        raise BadRequest("by must be period or area")
+
+    if by is None:
+        rows = query(f"SELECT SUM(vacancies), SUM(unique_vacancies) FROM stats_vacancies WHERE {where}", values)
+        return {"vacancies": int(rows[0][0] or 0), "unique_vacancies": int(rows[0][1] or 0)}
+
+    column = "period" if by == "period" else "area_name"
+    rows = query(f"""SELECT {column}, SUM(vacancies), SUM(unique_vacancies) FROM stats_vacancies WHERE {where}
+                     GROUP BY 1 ORDER BY 1""", values)
+    return {"by": by, "groups": [{by: key, "vacancies": int(vacancies), "unique_vacancies": int(unique)}
+                                 for key, vacancies, unique in rows]}
+
+
+def get_cells(params):
+    level = get_int_param(params, "level", COUNT_LEVELS[0], CELL_BITS)
+    if level not in COUNT_LEVELS:
+        raise BadRequest(f"level must be one of {COUNT_LEVELS}")
+
+    where = "level = %s"
+    values = [level]
+    if "snapshot" in params:
+        try:
+            snapshot = datetime.strptime(params["snapshot"], "%Y-%m-%d").date()
+        except ValueError:
+            raise BadRequest("snapshot must be a date like 2021-03-08")
+        where += " AND snapshot = %s"
+        values.append(snapshot)
+    else:
+        where += " AND snapshot = (SELECT MAX(snapshot) FROM geo_cell_count)"
+
+    if "bbox" in params:
+        try:
+            min_lat, min_lng, max_lat, max_lng = (float(v) for v in params["bbox"].split(","))
+        except ValueError:
+            raise BadRequest("bbox must be min_lat,min_lng,max_lat,max_lng")
+        if not all(math.isfinite(v) for v in (min_lat, min_lng, max_lat, max_lng)):
+            raise BadRequest("bbox must be finite numbers")
+        if min_lat > max_lat or min_lng > max_lng:
+            raise BadRequest("bbox min must not be greater than max")
+        # the cover ranges are of the finest cells, the cells of the level are their prefixes
+        shift = CELL_BITS - level
+        ranges = get_cover_ranges(min_lat, min_lng, max_lat, max_lng)
+        where += " AND (" + " OR ".join("cell BETWEEN %s AND %s" for _ in ranges) + ")"
+        values += [value >> shift for cell_range in ranges for value in cell_range]
+
+    rows = query(f"SELECT cell, vacancies FROM geo_cell_count WHERE {where} ORDER BY cell", values)
+    if not rows:
+        return {"level": level, "cells": []}
+
+    lat, lng = get_cell_center([cell for cell, _ in rows], level)
+    return {"level": level, "cells": [
+        {"cell": cell, "geohash": to_geohash(cell << (CELL_BITS - level), level // 5 * 5),
+         "lat": round(cell_lat, 5), "lng": round(cell_lng, 5), "vacancies": vacancies}
+        for (cell, vacancies), cell_lat, cell_lng in zip(rows, lat.tolist(), lng.tolist())]}
+
+
+ENDPOINTS = {
+    "/skills": get_skills,
+    "/salary": get_salary,
+    "/vacancies": get_vacancies,
+    "/cells": get_cells,
+}
+
+
+class Handler(BaseHTTPRequestHandler):
+    # keep-alive, the load test and the dashboards send many small requests
+    protocol_version = "HTTP/1.1"
+
+    def send_json(self, code, payload):
+        body = json.dumps(payload, ensure_ascii=False).encode()
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path == "/health":
+            self.send_json(200, {"version": cache.version})
+            return
+
+        endpoint = ENDPOINTS.get(url.path)
+        if endpoint is None:
+            self.send_json(404, {"error": "not found"})
+            return
+
+        params = dict(parse_qsl(url.query))
+        version = cache.check_version(get_version)
+        if version is None:
+            self.send_json(503, {"error": "stats are not computed yet"})
+            return
+
+        key = (url.path, tuple(sorted(params.items())))
+        response = cache.get(key)
+        if response is None:
+            try:
+                response = {"version": version, **endpoint(params)}
+            except BadRequest as e:
+                self.send_json(400, {"error": str(e)})
+                return
+            except Exception:
+                log(traceback.format_exc())
+                self.send_json(500, {"error": "internal error"})
+                return
+            cache.put(key, response)
+
+        self.send_json(200, response)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def main():
+    server = ThreadingHTTPServer(("0.0.0.0", PORT), Handler)
+    log(f"Stats api on port {PORT}")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
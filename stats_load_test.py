@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+
+"""Load test of stats_api.py
+
+    python3 stats_load_test.py --url http://127.0.0.1:8090 --threads 32 --seconds 30
+
+Requests are picked at random from a mix of endpoints and parameters, so both cached and not yet
+cached responses are measured.
+"""
+
+import sys
+import time
+import random
+import argparse
+import threading
+
+from datetime import date
+
+import requests
+
+AREAS = ["Москва", "Санкт-Петербург", "Екатеринбург", "Новосибирск", "Казань"]
+GROUPS = ["Языки программирования", "Базы данных", "Системы контроля версий"]
+EXPERIENCES = ["Нет опыта", "От 1 года до 3 лет", "От 3 до 6 лет", "Более 6 лет"]
+
+
+def get_random_path(rnd):
+    year = rnd.randrange(2015, date.today().year + 1)
+    month = rnd.randrange(1, 13)
+    period = f"period_from={year}-{month:02d}&period_to={year}-{month:02d}"
+    area = f"area={rnd.choice(AREAS)}"
+
+    return rnd.choice([
+        f"/skills?{area}&{period}&top=10",
+        f"/skills?{area}&group={rnd.choice(GROUPS)}&period_from={year}-01",
+        f"/salary?{area}&{period}",
+        f"/salary?{area}&experience={rnd.choice(EXPERIENCES)}",
+        f"/vacancies?{area}&by=period",
+        f"/vacancies?{period}&by=area",
+    ])
+
+
+def worker(url, deadline, seed, latencies, errors):
+    rnd = random.Random(seed)
+    session = requests.session()
+    while time.monotonic() < deadline:
+        start = time.monotonic()
+        try:
+            resp = session.get(url + get_random_path(rnd), timeout=30)
+            ok = resp.status_code == 200
+        except requests.RequestException:
+            ok = False
+        latencies.append(time.monotonic() - start)
+        if not ok:
+            errors.append(1)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--url", default="http://127.0.0.1:8090")
+    parser.add_argument("--threads", type=int, default=16)
+    parser.add_argument("--seconds", type=float, default=30)
+    args = parser.parse_args()
+
+    latencies, errors = [], []
+    deadline = time.monotonic() + args.seconds
+    threads = [threading.Thread(target=worker, args=(args.url, deadline, seed, latencies, errors))
+               for seed in range(args.threads)]
+
+    start = time.monotonic()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.monotonic() - start
+
+    latencies.sort()
+    if not latencies:
+        print("No requests were made", file=sys.stderr)
+        return
+
+    def percentile(q):
+        return latencies[min(len(latencies) - 1, int(q * len(latencies)))] * 1000
+
+    print(f"requests={len(latencies)} errors={len(errors)} rps={len(latencies) / elapsed:.1f} "
+          f"p50={percentile(0.5):.1f}ms p95={percentile(0.95):.1f}ms p99={percentile(0.99):.1f}ms")
+
+
+if __name__ == "__main__":
+    main()
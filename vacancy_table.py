@@ -0,0 +1,191 @@
+"""Snapshot-versioned vacancy table on HDFS
+
+Data files are immutable and are never rewritten. Vacancies are spread by id over NUM_BUCKETS buckets,
+every export rewrites only buckets with changes since the previous snapshot into a new data dir and
+commits a manifest into the log. The manifest lists the live files of every bucket, so reading
+the table as of some date means reading only the files from one manifest.
+
+Layout:
+    /vacancy_table/data/YYYY-MM-DD/bucket=N/part-*.parquet
+    /vacancy_table/_log/YYYY-MM-DD.json
+
+Usage in jupyter:
+    table = VacancyTable(spark)
+    table.snapshots()
+    df = table.as_of(date(2021, 3, 1))
+"""
+
+import json
+import posixpath
+
+from datetime import datetime, date
+
+TABLE_PATH = "/vacancy_table"
+DATA_DIR = "data"
+LOG_DIR = "_log"
+
+NUM_BUCKETS = 64
+MANIFEST_VERSION = 1
+
+
+def _get_fs(spark):
+    return spark._jvm.org.apache.hadoop.fs.FileSystem.get(spark._jsc.hadoopConfiguration())
+
+
+def _get_path(spark, path):
+    return spark._jvm.org.apache.hadoop.fs.Path(path)
+
+
+def _list_names(spark, path):
+    fs = _get_fs(spark)
+    jpath = _get_path(spark, path)
+    if not fs.exists(jpath):
+        return []
+    return sorted(status.getPath().getName() for status in fs.listStatus(jpath))
+
+
+def _read_text(spark, path):
+    stream = _get_fs(spark).open(_get_path(spark, path))
+    try:
+        return spark._jvm.org.apache.commons.io.IOUtils.toString(stream, "UTF-8")
+    finally:
+        stream.close()
+
+
+def _write_text_atomic(spark, path, text):
+    fs = _get_fs(spark)
+    temp_path = _get_path(spark, path + ".tmp")
+
+    stream = fs.create(temp_path, True)
+    try:
+        stream.write(bytearray(text.encode("utf8")))
+    finally:
+        stream.close()
+
+    if not fs.rename(temp_path, _get_path(spark, path)):
+        raise Exception(f"Failed to commit {path}")
+
+
+def get_manifest_path(table_path, snapshot_date):
+    return posixpath.join(table_path, LOG_DIR, f"{snapshot_date.isoformat()}.json")
+
+
+def list_snapshots(spark, table_path=TABLE_PATH):
+    snapshots = []
+    for name in _list_names(spark, posixpath.join(table_path, LOG_DIR)):
+        if name.endswith(".json"):
+            snapshots.append(date.fromisoformat(name[:-len(".json")]))
+    return snapshots
+
+
+def read_snapshot_manifest(spark, snapshot_date, table_path=TABLE_PATH):
+    return json.loads(_read_text(spark, get_manifest_path(table_path, snapshot_date)))
+
+
+def find_snapshot(snapshots, as_of_date):
+    """Returns the last snapshot made not later than as_of_date or None"""
+    suitable = [s for s in snapshots if s <= as_of_date]
+    if not suitable:
+        return None
+    return max(suitable)
+
+
+def get_manifest_files(manifest):
+    return [f for bucket in manifest["buckets"].values() for f in bucket["files"]]
+
+
+def write_snapshot(spark, df, snapshot_date, table_path=TABLE_PATH):
+    """Commits a new snapshot of the vacancy dataframe with the added_at/updated_at/removed_at columns.
+
+    Only the latest state of every vacancy is known, so if several snapshots were fed into db since
+    the previous export, only the last of them can be versioned
+    """
+    from pyspark.sql import functions as F
+
+    snapshots = list_snapshots(spark, table_path)
+    if snapshot_date in snapshots:
+        return read_snapshot_manifest(spark, snapshot_date, table_path)
+
+    parent_date = find_snapshot(snapshots, snapshot_date)
+    parent = read_snapshot_manifest(spark, parent_date, table_path) if parent_date else None
+
+    df = df.withColumn("bucket", F.col("id") % NUM_BUCKETS)
+
+    if parent:
+        changed = df.filter((F.col("added_at") > F.lit(parent_date)) |
+                            (F.col("updated_at") > F.lit(parent_date)) |
+                            (F.col("removed_at") > F.lit(parent_date)))
+        changed_buckets = sorted(row["bucket"] for row in changed.select("bucket").distinct().collect())
+    else:
+        changed_buckets = list(range(NUM_BUCKETS))
+
+    live = df.filter(F.col("removed_at").isNull() | (F.col("removed_at") > F.lit(snapshot_date)))
+    live = live.filter(F.col("bucket").isin(changed_buckets))
+
+    data_path = posixpath.join(table_path, DATA_DIR, snapshot_date.isoformat())
+    if changed_buckets:
+        live.repartition("bucket").write.partitionBy("bucket").parquet(data_path, mode="overwrite")
+
+    bucket_rows = {row["bucket"]: row["count"] for row in live.groupBy("bucket").count().collect()}
+
+    buckets = dict(parent["buckets"]) if parent else {}
+    for bucket in changed_buckets:
+        bucket_path = posixpath.join(data_path, f"bucket={bucket}")
+        files = [posixpath.join(bucket_path, name) for name in _list_names(spark, bucket_path)
+                 if name.endswith(".parquet")]
+        buckets[str(bucket)] = {"rows": bucket_rows.get(bucket, 0), "files": files}
+
+    manifest = {
+        "version": MANIFEST_VERSION,
+        "snapshot": snapshot_date.isoformat(),
+        "parent": parent_date.isoformat() if parent_date else None,
+        "rows": sum(bucket["rows"] for bucket in buckets.values()),
+        "changed_buckets": changed_buckets,
+        "buckets": buckets,
+        "created_at": datetime.now().isoformat(timespec="seconds"),
+    }
+
+    # the manifest is the commit point, data files without a manifest are never read
+    _write_text_atomic(spark, get_manifest_path(table_path, snapshot_date), json.dumps(manifest, indent=1))
+    return manifest
+
+
+class VacancyTable:
+    def __init__(self, spark, table_path=TABLE_PATH):
+        self.spark = spark
+        self.table_path = table_path
+
+    def snapshots(self):
+        return list_snapshots(self.spark, self.table_path)
+
+    def manifest_as_of(self, as_of_date):
+        snapshot_date = find_snapshot(self.snapshots(), as_of_date)
+        if not snapshot_date:
+            raise Exception(f"No snapshots made before {as_of_date}")
+        return read_snapshot_manifest(self.spark, snapshot_date, self.table_path)
+
+    def files_as_of(self, as_of_date):
+        return get_manifest_files(self.manifest_as_of(as_of_date))
+
+    def as_of(self, as_of_date):
+        """Dataframe of vacancies live at the snapshot made not later than as_of_date"""
+        files = self.files_as_of(as_of_date)
+        if not files:
+            raise Exception(f"Snapshot for {as_of_date} has no data files")
+        return self.spark.read.parquet(*files)
+
+    def diff_files(self, date_a, date_b):
+        """Returns (files only in a, files only in b), vacancies from other files are the same"""
+        files_a = set(self.files_as_of(date_a))
+        files_b = set(self.files_as_of(date_b))
+        return sorted(files_a - files_b), sorted(files_b - files_a)
+
+    def diff(self, date_a, date_b):
+        """Returns (vacancies only in a, vacancies only in b) reading only the changed buckets"""
+        only_a, only_b = self.diff_files(date_a, date_b)
+        df_a = self.spark.read.parquet(*only_a) if only_a else None
+        df_b = self.spark.read.parquet(*only_b) if only_b else None
+
+        if df_a is None or df_b is None:
+            return df_a, df_b
+        return df_a.exceptAll(df_b), df_b.exceptAll(df_a)